@@ -7,22 +7,23 @@ Conecta ao broker (5555) e ao proxy (5558)
 
 import zmq
 import time
-import sys
 import os
 import random
 
-# Adiciona o diretório common_utils ao path
-sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'common_utils'))
-
-from logical_clock import LogicalClock
-from messaging import create_message, parse_message, update_logical_clock
+from common_utils.logical_clock import LogicalClock
+from common_utils.messaging import create_message, parse_message
+from common_utils.logger import get_logger
 
 # Configurações
 BROKER_FRONTEND = "tcp://broker:5555"
 PROXY_FRONTEND = "tcp://proxy:5558"
+BATCH_SIZE = 10  # mensagens enviadas por lote
+BATCH_REPLY_TIMEOUT = 5000  # ms para aguardar confirmações de um lote
+CHANNEL_REFRESH_BATCHES = 5  # lotes enviados entre atualizações da lista de canais
+ZMQ_IO_THREADS = 2  # threads de I/O do contexto ZeroMQ
 
 # Mensagens padrão que o bot pode enviar
-BOT_MESSAGES = [
+BOT_MESSAGES = (
     "Olá a todos! 👋",
     "Como estão as coisas por aqui?",
     "Alguém sabe de novidades?",
@@ -43,7 +44,7 @@ BOT_MESSAGES = [
     "Faz sentido o que você disse!",
     "Ótimo ponto de vista!",
     "Nunca tinha pensado por esse ângulo!"
-]
+)
 
 class BBSBot:
     """Bot automático para o sistema BBS"""
@@ -61,13 +62,20 @@ class BBSBot:
         else:
             self.bot_id = f"{random.randint(1000, 9999)}_{int(time.time())}"
         self.username = f"bot_{self.bot_id}"
+        self.log = get_logger(f"BOT:{self.username}")
         self.clock = LogicalClock()
         
         # Contexto ZeroMQ
-        self.context = zmq.Context()
+        self.context = zmq.Context(io_threads=ZMQ_IO_THREADS)
         
-        # Socket REQ para broker
+        # Socket REQ para broker (login e consulta de canais)
         self.req_socket = self.context.socket(zmq.REQ)
+        self._tune_socket(self.req_socket)
+        
+        # Socket DEALER para broker (publicações em pipeline, sem lockstep REQ/REP)
+        self.dealer_socket = self.context.socket(zmq.DEALER)
+        self.dealer_socket.setsockopt(zmq.LINGER, 0)
+        self._tune_socket(self.dealer_socket)
         
         # Socket SUB para proxy (para ouvir canais)
         self.sub_socket = self.context.socket(zmq.SUB)
@@ -75,22 +83,34 @@ class BBSBot:
         # Lista de canais conhecidos
         self.channels = []
         
-        print(f"[BOT:{self.username}] Bot inicializado (clock: {self.clock.get_time()})")
+        self.log.info("Bot inicializado (clock: %d)", self.clock.get_time())
+    
+    @staticmethod
+    def _tune_socket(socket):
+        """
+        Configura um socket de saída para baixa latência
+        
+        IMMEDIATE evita enfileirar mensagens para conexões ainda não
+        estabelecidas; o ZeroMQ já ativa TCP_NODELAY em todo transporte TCP.
+        """
+        socket.setsockopt(zmq.TCP_KEEPALIVE, 1)
+        socket.setsockopt(zmq.IMMEDIATE, 1)
     
     def connect(self):
         """Conecta aos serviços"""
         try:
             # Conecta ao broker
             self.req_socket.connect(BROKER_FRONTEND)
-            print(f"[BOT:{self.username}] Conectado ao broker em {BROKER_FRONTEND}")
+            self.dealer_socket.connect(BROKER_FRONTEND)
+            self.log.info("Conectado ao broker em %s", BROKER_FRONTEND)
             
             # Conecta ao proxy
             self.sub_socket.connect(PROXY_FRONTEND)
-            print(f"[BOT:{self.username}] Conectado ao proxy em {PROXY_FRONTEND}")
+            self.log.info("Conectado ao proxy em %s", PROXY_FRONTEND)
             
             return True
         except Exception as e:
-            print(f"[BOT:{self.username}] Erro ao conectar: {e}")
+            self.log.error("Erro ao conectar: %s", e)
             return False
     
     def login(self):
@@ -107,19 +127,19 @@ class BBSBot:
             
             if response and response.get('data'):
                 data = response['data']
-                update_logical_clock(self.clock, data.get('clock', 0))
+                self.clock.update(data.get('clock', 0))
                 
                 if data.get('status') == 'sucesso':
-                    print(f"[BOT:{self.username}] Login realizado com sucesso")
+                    self.log.info("Login realizado com sucesso")
                     return True
                 else:
                     
-                    print(f"[BOT:{self.username}] Erro no login: {data.get('description', 'Desconhecido')}")
+                    self.log.warning("Erro no login: %s", data.get('description', 'Desconhecido'))
             
             return False
             
         except Exception as e:
-            print(f"[BOT:{self.username}] Erro ao fazer login: {e}")
+            self.log.error("Erro ao fazer login: %s", e)
             return False
     
     def get_channels(self):
@@ -134,17 +154,17 @@ class BBSBot:
             
             if response and response.get('data'):
                 data = response['data']
-                update_logical_clock(self.clock, data.get('clock', 0))
+                self.clock.update(data.get('clock', 0))
                 
                 if data.get('channels'):
                     self.channels = data['channels']
-                    print(f"[BOT:{self.username}] {len(self.channels)} canais encontrados")
+                    self.log.info("%d canais encontrados", len(self.channels))
                     return True
             
             return False
             
         except Exception as e:
-            print(f"[BOT:{self.username}] Erro ao obter canais: {e}")
+            self.log.error("Erro ao obter canais: %s", e)
             return False
     
     def create_default_channels(self):
@@ -164,27 +184,31 @@ class BBSBot:
                 
                 if response and response.get('data'):
                     data = response['data']
-                    update_logical_clock(self.clock, data.get('clock', 0))
+                    self.clock.update(data.get('clock', 0))
                     
                     if data.get('status') == 'sucesso':
-                        print(f"[BOT:{self.username}] Canal #{channel} criado")
+                        self.log.info("Canal #%s criado", channel)
                 
                 # Pequeno delay entre criações
                 time.sleep(0.5)
                 
             except Exception as e:
-                print(f"[BOT:{self.username}] Erro ao criar canal {channel}: {e}")
+                self.log.error("Erro ao criar canal %s: %s", channel, e)
     
     def publish_message(self, channel, message_text):
         """
-        Publica mensagem em um canal
+        Envia mensagem para um canal sem aguardar a resposta
+        
+        O DEALER envia o frame delimitador vazio esperado pelo REP do
+        servidor, então várias publicações podem ficar em voo ao mesmo tempo.
+        As respostas são coletadas depois por collect_replies().
         
         Args:
             channel: Nome do canal
             message_text: Texto da mensagem
         
         Returns:
-            True se publicado com sucesso
+            True se a mensagem foi enfileirada para envio
         """
         try:
             data = {
@@ -194,47 +218,88 @@ class BBSBot:
             }
             message = create_message('publish', data, self.clock)
             
-            self.req_socket.send(message)
+            self.dealer_socket.send_multipart([b'', message], zmq.DONTWAIT)
+            return True
             
-            # Recebe resposta
-            raw_response = self.req_socket.recv()
-            response = parse_message(raw_response)
+        except zmq.Again:
+            self.log.warning("Fila de envio cheia, mensagem descartada")
+            return False
+        except Exception as e:
+            self.log.error("Erro ao publicar: %s", e)
+            return False
+    
+    def publish_batch(self, channel, messages):
+        """
+        Publica um lote de mensagens em um canal
+        
+        Todas as mensagens são enviadas em sequência e só então as
+        confirmações são aguardadas, pagando um único RTT por lote.
+        
+        Args:
+            channel: Nome do canal
+            messages: Lista de textos a publicar
+        
+        Returns:
+            Quantidade de mensagens confirmadas pelo servidor
+        """
+        sent = sum(1 for text in messages if self.publish_message(channel, text))
+        return self.collect_replies(sent)
+    
+    def collect_replies(self, expected):
+        """
+        Coleta respostas pendentes do socket DEALER
+        
+        Args:
+            expected: Quantidade de respostas esperadas
+        
+        Returns:
+            Quantidade de respostas com status 'OK'
+        """
+        confirmed = 0
+        received = 0
+        deadline = time.time() + BATCH_REPLY_TIMEOUT / 1000
+        
+        while received < expected:
+            remaining = int((deadline - time.time()) * 1000)
+            if remaining <= 0 or not self.dealer_socket.poll(remaining, zmq.POLLIN):
+                self.log.warning("Timeout aguardando %d confirmações", expected - received)
+                break
+            
+            frames = self.dealer_socket.recv_multipart()
+            received += 1
+            response = parse_message(frames[-1])
             
             if response and response.get('data'):
                 data = response['data']
-                update_logical_clock(self.clock, data.get('clock', 0))
+                self.clock.update(data.get('clock', 0))
                 
                 if data.get('status') == 'OK':
-                    return True
-            
-            return False
-            
-        except Exception as e:
-            print(f"[BOT:{self.username}] Erro ao publicar: {e}")
-            return False
+                    confirmed += 1
+        
+        return confirmed
     
     def run(self):
         """Executa o loop principal do bot"""
-        print(f"[BOT:{self.username}] Iniciando bot...")
+        self.log.info("Iniciando bot...")
         
         # Conecta aos serviços
         if not self.connect():
-            print(f"[BOT:{self.username}] Falha ao conectar. Encerrando...")
+            self.log.error("Falha ao conectar. Encerrando...")
             return
         
         # Faz login
         if not self.login():
-            print(f"[BOT:{self.username}] Falha no login. Tentando novamente em 5s...")
+            self.log.warning("Falha no login. Tentando novamente em 5s...")
             time.sleep(5)
             if not self.login():
-                print(f"[BOT:{self.username}] Falha definitiva no login. Encerrando...")
+                self.log.error("Falha definitiva no login. Encerrando...")
                 return
         
         # Aguarda um pouco para garantir que o sistema está estável
         time.sleep(2)
         
         # Cria canais padrão
-        print(f"[BOT:{self.username}] Criando canais padrão...")
+        self.log.info("Criando canais padrão...")
         self.create_default_channels()
         
         # Aguarda canais serem criados
@@ -242,55 +307,49 @@ class BBSBot:
         
         # Obtém lista de canais
         if not self.get_channels():
-            print(f"[BOT:{self.username}] Aviso: Não foi possível obter canais")
+            self.log.warning("Aviso: Não foi possível obter canais")
             # Usa canais padrão
             self.channels = ['geral', 'tecnologia', 'random']
         
         if not self.channels:
-            print(f"[BOT:{self.username}] Nenhum canal disponível. Criando canal padrão...")
+            self.log.warning("Nenhum canal disponível. Criando canal padrão...")
             self.channels = ['geral']
         
-        print(f"[BOT:{self.username}] Bot pronto! Iniciando publicações...")
+        self.log.info("Bot pronto! Iniciando publicações...")
         
         message_count = 0
+        batch_count = 0
         
         try:
             while True:
                 # Escolhe canal aleatório
                 channel = random.choice(self.channels)
                 
-                # Envia 10 mensagens no canal escolhido
-                print(f"\n[BOT:{self.username}] Enviando 10 mensagens para #{channel}")
+                # Envia um lote de mensagens no canal escolhido
+                self.log.debug("Enviando %d mensagens para #%s", BATCH_SIZE, channel)
                 
-                for i in range(10):
-                    # Escolhe mensagem aleatória
-                    message_text = random.choice(BOT_MESSAGES)
-                    
-                    # Publica mensagem
-                    success = self.publish_message(channel, message_text)
-                    
-                    if success:
-                        message_count += 1
-                        print(f"[BOT:{self.username}] Mensagem {i+1}/10 enviada para #{channel} "
-                              f"(total: {message_count}, clock: {self.clock.get_time()})")
-                    else:
-                        print(f"[BOT:{self.username}] Falha ao enviar mensagem {i+1}/10")
-                    
-                    # Delay entre mensagens (2-5 segundos)
-                    time.sleep(random.uniform(2, 5))
+                batch = random.choices(BOT_MESSAGES, k=BATCH_SIZE)
+                confirmed = self.publish_batch(channel, batch)
+                message_count += confirmed
+                batch_count += 1
+                
+                self.log.info("%d/%d mensagens confirmadas em #%s (total: %d, clock: %d)",
+                              confirmed, BATCH_SIZE, channel, message_count, self.clock.counter)
                 
                 # Delay maior antes de escolher novo canal (5-10 segundos)
-                print(f"[BOT:{self.username}] Aguardando antes de escolher novo canal...")
+                self.log.debug("Aguardando antes de escolher novo canal...")
                 time.sleep(random.uniform(5, 10))
                 
-                # Atualiza lista de canais periodicamente
-                if message_count % 50 == 0:
+                # Atualiza lista de canais periodicamente (contado em lotes: um
+                # lote com confirmações perdidas não desalinha a contagem)
+                if batch_count % CHANNEL_REFRESH_BATCHES == 0:
                     self.get_channels()
                 
         except KeyboardInterrupt:
-            print(f"\n[BOT:{self.username}] Encerrando bot...")
+            self.log.info("Encerrando bot...")
         finally:
             self.req_socket.close()
+            self.dealer_socket.close()
             self.sub_socket.close()
             self.context.term()
 
@@ -4,7 +4,8 @@ Pacote de utilitários comuns para o sistema BBS
 
 from .logical_clock import LogicalClock
 from .persistence import DataStore
-from .messaging import create_message, parse_message, create_response, update_logical_clock
+from .messaging import create_message, parse_message, create_response
+from .logger import get_logger
 
 __all__ = [
     'LogicalClock',
@@ -12,5 +13,5 @@ __all__ = [
     'create_message',
     'parse_message',
     'create_response',
-    'update_logical_clock'
+    'get_logger'
 ]
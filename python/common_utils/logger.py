@@ -0,0 +1,54 @@
+"""
+Módulo de Logging
+Configura loggers com nível controlado pela variável de ambiente LOG_LEVEL
+"""
+
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+
+_configured = False
+
+def _configure():
+    """
+    Configura o logger raiz uma única vez (saída em stdout, prefixo [tag])
+    
+    As threads que registram mensagens apenas as enfileiram (QueueHandler);
+    a escrita em stdout, com seu lock, fica numa thread própria
+    (QueueListener), fora dos caminhos quentes.
+    """
+    global _configured
+    if _configured:
+        return
+    
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter('[%(name)s] %(message)s'))
+    
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)  # Escoa a fila ao encerrar o processo
+    
+    root = logging.getLogger()
+    root.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    _configured = True
+
+def get_logger(tag: str) -> logging.Logger:
+    """
+    Retorna um logger cujas mensagens são prefixadas com [tag]
+    
+    Use formatação preguiçosa (log.debug("... %s", valor)) nos caminhos
+    quentes: a mensagem só é montada se o nível estiver habilitado.
+    
+    Args:
+        tag: Prefixo exibido nas mensagens (ex: 'REFERENCE', 'BOT:bot_1')
+    
+    Returns:
+        Instância de logging.Logger
+    """
+    _configure()
+    return logging.getLogger(tag)
@@ -6,6 +6,9 @@ Implementa o contador lógico para sincronização de eventos distribuídos
 class LogicalClock:
     """Implementação do Relógio Lógico de Lamport"""
     
+    # Atributo fixo: acesso via slot, sem __dict__ por instância
+    __slots__ = ('counter',)
+    
     def __init__(self):
         """Inicializa o contador do relógio lógico em 0"""
         self.counter = 0
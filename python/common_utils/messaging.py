@@ -4,9 +4,36 @@ Funções auxiliares para criação e serialização de mensagens com MessagePac
 """
 
 import msgpack
+import msgspec
 import time
 from typing import Any, Dict
 
+class Msg(msgspec.Struct, gc=False):
+    """Envelope das mensagens trocadas pelo sistema"""
+    service: str = ''
+    data: dict = {}
+
+# Encoder/Decoder C do msgspec (reutilizáveis e seguros entre threads)
+_ENCODER = msgspec.msgpack.Encoder()
+_DECODER = msgspec.msgpack.Decoder(Msg)
+
+# Cabeçalhos pré-serializados: {'service': <nome>, 'data': ...} sem o valor de 'data'
+_HEADERS: Dict[str, bytes] = {}
+
+def _get_header(service: str) -> bytes:
+    """Retorna o prefixo MessagePack (mapa de 2 chaves + 'service' + 'data') para o serviço"""
+    header = _HEADERS.get(service)
+    if header is None:
+        packer = msgpack.Packer(use_bin_type=True)
+        header = (packer.pack_map_header(2) + packer.pack('service') +
+                  packer.pack(service) + packer.pack('data'))
+        _HEADERS[service] = header
+    return header
+
+def _pack_envelope(service: str, data: Dict) -> bytes:
+    """Serializa {'service': service, 'data': data} reaproveitando o cabeçalho em cache"""
+    return _get_header(service) + _ENCODER.encode(data)
+
 def create_message(service: str, data: Dict, logical_clock) -> bytes:
     """
     Cria uma mensagem serializada com MessagePack
@@ -26,12 +53,7 @@ def create_message(service: str, data: Dict, logical_clock) -> bytes:
     data['timestamp'] = time.time()
     data['clock'] = clock_value
     
-    message = {
-        'service': service,
-        'data': data
-    }
-    
-    return msgpack.packb(message, use_bin_type=True)
+    return _pack_envelope(service, data)
 
 def parse_message(raw_message: bytes) -> Dict[str, Any]:
     """
@@ -44,12 +66,14 @@ def parse_message(raw_message: bytes) -> Dict[str, Any]:
         Dicionário com a mensagem deserializada
     """
     try:
-        return msgpack.unpackb(raw_message, raw=False)
+        message = _DECODER.decode(raw_message)
+        return {'service': message.service, 'data': message.data}
     except Exception as e:
         print(f"Erro ao deserializar mensagem: {e}")
         return {}
 
-def create_response(service: str, status: str, data: Dict, logical_clock, description: str = None) -> bytes:
+def create_response(service: str, status: str, data: Dict, logical_clock, description: str = None,
+                    now: float = None) -> bytes:
     """
     Cria uma mensagem de resposta
     
@@ -59,6 +83,7 @@ def create_response(service: str, status: str, data: Dict, logical_clock, descri
         data: Dados adicionais da resposta
         logical_clock: Instância do relógio lógico
         description: Descrição de erro opcional (conforme especificação Parte 1)
+        now: Timestamp já obtido pelo chamador (evita nova chamada a time.time())
     
     Returns:
         Resposta serializada em bytes
@@ -67,7 +92,7 @@ def create_response(service: str, status: str, data: Dict, logical_clock, descri
     
     response_data = {
         'status': status,
-        'timestamp': time.time(),
+        'timestamp': now if now is not None else time.time(),
         'clock': clock_value
     }
     
@@ -77,19 +102,4 @@ def create_response(service: str, status: str, data: Dict, logical_clock, descri
     # Mescla dados adicionais
     response_data.update(data)
     
-    response = {
-        'service': service,
-        'data': response_data
-    }
-    
-    return msgpack.packb(response, use_bin_type=True)
-
-def update_logical_clock(logical_clock, received_clock: int):
-    """
-    Atualiza o relógio lógico com base no valor recebido
-    
-    Args:
-        logical_clock: Instância do relógio lógico
-        received_clock: Valor do relógio recebido
-    """
-    logical_clock.update(received_clock)
+    return _pack_envelope(service, response_data)
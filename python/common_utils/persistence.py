@@ -3,13 +3,26 @@ Módulo de Persistência Local
 Gerencia leitura e escrita de dados em arquivos JSON
 """
 
-import json
+import mmap
+import orjson
 import os
+import tempfile
+from itertools import accumulate
 from pathlib import Path
-from typing import Any, Dict, List
+from threading import RLock
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+# Arquivos a partir deste tamanho são lidos via mmap (sem cópia para buffer próprio)
+MMAP_THRESHOLD = 1024 * 1024  # 1 MiB
 
 class DataStore:
-    """Gerenciador de persistência local em JSON"""
+    """
+    Gerenciador de persistência local em JSON
+    
+    Listas que crescem item a item (logins, canais) usam um journal
+    append-only em JSON Lines ao lado do snapshot: append() escreve apenas a
+    nova linha e save() reescreve o snapshot completo e zera o journal.
+    """
     
     def __init__(self, data_dir: str = "/data"):
         """
@@ -24,11 +37,110 @@ class DataStore:
         # Subdiretório para replicação
         self.replication_dir = self.data_dir / "replication"
         self.replication_dir.mkdir(parents=True, exist_ok=True)
+        
+        # Caminhos já resolvidos (str), evitando criar um Path a cada chamada
+        self._path_cache: Dict[str, str] = {}
+        self._replication_path_cache: Dict[str, str] = {}
+        
+        # Um lock por arquivo de dados: save (snapshot + descarte do journal)
+        # e append não se intercalam quando vêm de threads diferentes (thread
+        # de escrita do servidor e workers de replicação)
+        self._file_locks: Dict[str, RLock] = {}
+    
+    def locked(self, filename: str) -> RLock:
+        """
+        Retorna o lock que serializa gravações de um arquivo de dados
+        
+        É reentrante: quem lê, decide e grava (ex: a mescla da replicação)
+        pode segurá-lo durante toda a operação e ainda chamar save/append,
+        sem que outra thread grave no arquivo entre a leitura e a escrita.
+        """
+        lock = self._file_locks.get(filename)
+        if lock is None:
+            # setdefault é atômico sob o GIL: duas threads obtêm o mesmo lock
+            lock = self._file_locks.setdefault(filename, RLock())
+        return lock
+    
+    def _p(self, filename: str) -> str:
+        """Retorna (e memoriza) o caminho absoluto de um arquivo de dados"""
+        path = self._path_cache.get(filename)
+        if path is None:
+            path = str(self.data_dir / filename)
+            self._path_cache[filename] = path
+        return path
+    
+    def _rp(self, server_name: str) -> str:
+        """Retorna (e memoriza) o caminho do arquivo de replicação de um servidor"""
+        path = self._replication_path_cache.get(server_name)
+        if path is None:
+            path = str(self.replication_dir / f"{server_name}.json")
+            self._replication_path_cache[server_name] = path
+        return path
+    
+    @staticmethod
+    def _atomic_write(filepath: str, payload: bytes):
+        """
+        Grava o conteúdo em um arquivo temporário e o move sobre o destino
+        
+        os.replace é atômico em POSIX: leitores veem o arquivo antigo ou o
+        novo, nunca uma escrita parcial em caso de falha no meio da gravação.
+        O conteúdo vai direto ao descritor com os.write (sem o buffer do
+        objeto arquivo) e é sincronizado com fsync antes da troca. Cada
+        gravação usa um temporário próprio (mkstemp), então gravações
+        simultâneas do mesmo arquivo não disputam o mesmo caminho.
+        """
+        directory, name = os.path.split(filepath)
+        fd, tmp = tempfile.mkstemp(prefix=name + '.', suffix='.tmp', dir=directory)
+        try:
+            try:
+                os.fchmod(fd, 0o644)
+                view = memoryview(payload)
+                while view:
+                    view = view[os.write(fd, view):]
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            os.replace(tmp, filepath)
+        except BaseException:
+            try:
+                os.unlink(tmp)
+            except FileNotFoundError:
+                pass
+            raise
+    
+    @staticmethod
+    def _read_json(filepath: str) -> Any:
+        """
+        Lê e decodifica um arquivo JSON
+        
+        Arquivos grandes (snapshots de mensagens e replicação) são mapeados
+        em memória e entregues ao orjson direto das páginas do cache do
+        kernel; arquivos pequenos são lidos normalmente.
+        """
+        with open(filepath, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0 or size < MMAP_THRESHOLD:
+                return orjson.loads(f.read())
+            
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                with memoryview(mm) as view:
+                    return orjson.loads(view)
+    
+    @staticmethod
+    def _journal_name(filename: str) -> str:
+        """Nome do journal JSON Lines associado a um snapshot (ex: 'logins.jsonl')"""
+        return os.path.splitext(filename)[0] + '.jsonl'
     
     def load(self, filename: str, default: Any = None) -> Any:
         """
         Carrega dados de um arquivo JSON
         
+        Se o snapshot for uma lista, os itens do journal são anexados a ela.
+        Um snapshot ilegível não descarta o journal: seus itens são devolvidos
+        (e entram no próximo save). As duas leituras são feitas sob o lock do
+        arquivo, para que um save concorrente não combine o snapshot novo com
+        o journal antigo (itens duplicados).
+        
         Args:
             filename: Nome do arquivo (ex: 'logins.json')
             default: Valor padrão se o arquivo não existir
@@ -36,22 +148,33 @@ class DataStore:
         Returns:
             Dados carregados ou valor padrão
         """
-        filepath = self.data_dir / filename
-        
-        if not filepath.exists():
-            return default if default is not None else []
+        filepath = self._p(filename)
+        with self.locked(filename):
+            journal = self.load_lines(self._journal_name(filename))
+            
+            if not os.path.exists(filepath):
+                if journal:
+                    return journal
+                return default if default is not None else []
+            
+            try:
+                data = self._read_json(filepath)
+            except (orjson.JSONDecodeError, IOError) as e:
+                print(f"Erro ao carregar {filename}: {e}")
+                if journal:
+                    return journal
+                return default if default is not None else []
         
-        try:
-            with open(filepath, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except (json.JSONDecodeError, IOError) as e:
-            print(f"Erro ao carregar {filename}: {e}")
-            return default if default is not None else []
+        if journal and isinstance(data, list):
+            data.extend(journal)
+        return data
     
     def save(self, filename: str, data: Any) -> bool:
         """
         Salva dados em um arquivo JSON
         
+        O snapshot passa a conter todo o estado, então o journal é descartado.
+        
         Args:
             filename: Nome do arquivo
             data: Dados a serem salvos
@@ -59,32 +182,227 @@ class DataStore:
         Returns:
             True se salvo com sucesso, False caso contrário
         """
-        filepath = self.data_dir / filename
+        filepath = self._p(filename)
         
         try:
-            with open(filepath, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+            payload = orjson.dumps(data)
+            with self.locked(filename):
+                self._atomic_write(filepath, payload)
+                
+                journal = self._p(self._journal_name(filename))
+                if os.path.exists(journal):
+                    os.remove(journal)
             return True
-        except IOError as e:
+        except (orjson.JSONEncodeError, IOError) as e:
             print(f"Erro ao salvar {filename}: {e}")
             return False
     
-    def append(self, filename: str, item: Any) -> bool:
+    def append(self, filename: str, *items: Any) -> bool:
+        """
+        Adiciona itens a uma lista existente
+        
+        Os itens são gravados no journal do arquivo numa única escrita, sem
+        reler nem reescrever o snapshot (O(1) por item).
+        
+        Args:
+            filename: Nome do arquivo
+            *items: Itens a serem adicionados
+        
+        Returns:
+            True se adicionados com sucesso
+        """
+        journal = self._journal_name(filename)
+        with self.locked(filename):
+            return self._append_to(self._p(journal), items, journal)
+    
+    def sync_journal(self, filename: str) -> bool:
+        """
+        Força para o disco (fdatasync) o journal de um arquivo
+        
+        Torna duráveis os itens já acrescentados com append sem regravar o
+        snapshot: um checkpoint custa O(itens novos) e não O(estado).
+        
+        Args:
+            filename: Nome do arquivo
+        
+        Returns:
+            True se sincronizado (ou se não há journal), False em caso de erro
+        """
+        try:
+            fd = os.open(self._p(self._journal_name(filename)), os.O_RDONLY)
+        except FileNotFoundError:
+            return True
+        except OSError as e:
+            print(f"Erro ao sincronizar journal de {filename}: {e}")
+            return False
+        try:
+            os.fdatasync(fd)
+            return True
+        except OSError as e:
+            print(f"Erro ao sincronizar journal de {filename}: {e}")
+            return False
+        finally:
+            os.close(fd)
+    
+    def signature(self, filename: str) -> tuple:
         """
-        Adiciona um item a uma lista existente
+        Retorna uma assinatura barata (via stat) do snapshot e do journal
+        
+        A assinatura muda sempre que um dos dois é regravado, acrescido ou
+        removido, o que permite validar caches em memória sem reler o arquivo.
         
         Args:
             filename: Nome do arquivo
-            item: Item a ser adicionado
         
         Returns:
-            True se adicionado com sucesso
+            Tupla comparável; igual enquanto o conteúdo não for alterado
+        """
+        result = []
+        for path in (self._p(filename), self._p(self._journal_name(filename))):
+            try:
+                st = os.stat(path)
+                result.append((st.st_ino, st.st_size, st.st_mtime_ns))
+            except FileNotFoundError:
+                result.append(None)
+        return tuple(result)
+    
+    def append_line(self, filename: str, item: Any) -> bool:
+        """
+        Acrescenta um item como uma linha JSON ao final de um arquivo
+        
+        Args:
+            filename: Nome do arquivo JSON Lines
+            item: Item a ser gravado
+        
+        Returns:
+            True se gravado com sucesso
         """
-        data = self.load(filename, default=[])
-        if not isinstance(data, list):
-            data = [data]
-        data.append(item)
-        return self.save(filename, data)
+        return self._append_to(self._p(filename), (item,), filename)
+    
+    def append_lines(self, filename: str, items: Sequence[Any]) -> Optional[List[int]]:
+        """
+        Acrescenta itens, um por linha JSON, e retorna a posição de cada linha
+        
+        Com as posições, read_lines_at lê depois só as linhas desejadas, sem
+        decodificar o arquivo inteiro. Se a última linha gravada ficou
+        incompleta (escrita interrompida), ela é terminada antes, para não
+        se fundir ao primeiro item novo.
+        
+        Args:
+            filename: Nome do arquivo JSON Lines
+            items: Itens a serem gravados
+        
+        Returns:
+            Posição (em bytes) do início de cada linha, ou None em caso de erro
+        """
+        try:
+            lines = [orjson.dumps(item) + b'\n' for item in items]
+            with self.locked(filename), open(self._p(filename), 'a+b') as f:
+                offset = f.seek(0, os.SEEK_END)
+                if offset and os.pread(f.fileno(), 1, offset - 1) != b'\n':
+                    lines.insert(0, b'\n')
+                f.write(b''.join(lines))
+        except (orjson.JSONEncodeError, IOError) as e:
+            print(f"Erro ao acrescentar em {filename}: {e}")
+            return None
+        
+        offsets = list(accumulate(map(len, lines), initial=offset))[:-1]
+        if len(offsets) > len(items):
+            offsets.pop(0)  # Posição do terminador acrescentado
+        return offsets
+    
+    def scan_lines(self, filename: str) -> Iterator[Tuple[int, Any]]:
+        """
+        Percorre um arquivo JSON Lines retornando a posição e o item de cada linha
+        
+        Linhas corrompidas (ex: escrita interrompida) são ignoradas.
+        
+        Args:
+            filename: Nome do arquivo JSON Lines
+        
+        Returns:
+            Iterador de tuplas (posição em bytes, item)
+        """
+        filepath = self._p(filename)
+        
+        if not os.path.exists(filepath):
+            return
+        
+        try:
+            with open(filepath, 'rb') as f:
+                offset = 0
+                for line in f:
+                    if line.strip():
+                        try:
+                            yield offset, orjson.loads(line)
+                        except orjson.JSONDecodeError:
+                            print(f"Linha inválida ignorada em {filename}")
+                    offset += len(line)
+        except IOError as e:
+            print(f"Erro ao carregar {filename}: {e}")
+    
+    def read_lines_at(self, filename: str, offsets: Iterable[int]) -> List[Any]:
+        """
+        Lê e decodifica só as linhas que começam nas posições informadas
+        
+        Args:
+            filename: Nome do arquivo JSON Lines
+            offsets: Posições obtidas de append_lines ou scan_lines
+        
+        Returns:
+            Itens lidos, na ordem das posições
+        """
+        items = []
+        try:
+            with open(self._p(filename), 'rb') as f:
+                for offset in offsets:
+                    f.seek(offset)
+                    items.append(orjson.loads(f.readline()))
+        except (orjson.JSONDecodeError, IOError) as e:
+            print(f"Erro ao ler {filename}: {e}")
+        return items
+    
+    @staticmethod
+    def _append_to(filepath: str, items: Sequence[Any], label: str) -> bool:
+        """Acrescenta os itens, um por linha JSON, ao final do arquivo numa única escrita"""
+        try:
+            with open(filepath, 'ab') as f:
+                f.write(b''.join(orjson.dumps(item) + b'\n' for item in items))
+            return True
+        except (orjson.JSONEncodeError, IOError) as e:
+            print(f"Erro ao acrescentar em {label}: {e}")
+            return False
+    
+    def load_lines(self, filename: str) -> List[Any]:
+        """
+        Carrega todos os itens de um arquivo JSON Lines
+        
+        Linhas corrompidas (ex: escrita interrompida) são ignoradas.
+        
+        Args:
+            filename: Nome do arquivo JSON Lines
+        
+        Returns:
+            Lista de itens ou lista vazia se o arquivo não existir
+        """
+        filepath = self._p(filename)
+        
+        if not os.path.exists(filepath):
+            return []
+        
+        items = []
+        try:
+            with open(filepath, 'rb') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    try:
+                        items.append(orjson.loads(line))
+                    except orjson.JSONDecodeError:
+                        print(f"Linha inválida ignorada em {filename}")
+        except IOError as e:
+            print(f"Erro ao carregar {filename}: {e}")
+        return items
     
     def save_replication(self, server_name: str, data: Dict) -> bool:
         """
@@ -97,16 +415,32 @@ class DataStore:
         Returns:
             True se salvo com sucesso
         """
-        filepath = self.replication_dir / f"{server_name}.json"
+        filepath = self._rp(server_name)
         
         try:
-            with open(filepath, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+            self._atomic_write(filepath, orjson.dumps(data))
             return True
-        except IOError as e:
+        except (orjson.JSONEncodeError, IOError) as e:
             print(f"Erro ao salvar replicação para {server_name}: {e}")
             return False
     
+    def append_replication(self, name: str, *items: Any) -> bool:
+        """
+        Acrescenta registros ao log de replicação em JSON Lines
+        
+        Usado por históricos que só crescem (ex: log de eleição), gravando
+        apenas os novos registros em vez de reescrever a lista inteira.
+        
+        Args:
+            name: Nome do log (gravado como replication/<name>.jsonl)
+            *items: Registros a serem acrescentados
+        
+        Returns:
+            True se gravado com sucesso
+        """
+        filename = f"{name}.jsonl"
+        return self._append_to(str(self.replication_dir / filename), items, filename)
+    
     def load_replication(self, server_name: str) -> Dict:
         """
         Carrega dados de replicação de um servidor
@@ -117,14 +451,13 @@ class DataStore:
         Returns:
             Dados de replicação ou dicionário vazio
         """
-        filepath = self.replication_dir / f"{server_name}.json"
+        filepath = self._rp(server_name)
         
-        if not filepath.exists():
+        if not os.path.exists(filepath):
             return {}
         
         try:
-            with open(filepath, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except (json.JSONDecodeError, IOError) as e:
+            return self._read_json(filepath)
+        except (orjson.JSONDecodeError, IOError) as e:
             print(f"Erro ao carregar replicação de {server_name}: {e}")
             return {}
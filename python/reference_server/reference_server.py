@@ -7,20 +7,23 @@ Porta: 5559 (REQ-REP)
 
 import zmq
 import time
-import sys
-import os
+import heapq
 from threading import Thread, Lock
 
-# Adiciona o diretório common_utils ao path
-sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'common_utils'))
-
-from logical_clock import LogicalClock
-from persistence import DataStore
-from messaging import create_message, parse_message, create_response, update_logical_clock
+from common_utils.logical_clock import LogicalClock
+from common_utils.persistence import DataStore
+from common_utils.messaging import parse_message, create_response
+from common_utils.logger import get_logger
 
 # Configurações
 REF_PORT = "tcp://*:5559"
 HEARTBEAT_TIMEOUT = 30  # segundos
+SOCKET_HWM = 100000  # limite de mensagens enfileiradas no socket REP
+POLL_TIMEOUT = 1000  # ms de espera quando não há requisições pendentes
+ZMQ_IO_THREADS = 2  # threads de I/O do contexto ZeroMQ
+LEGACY_SERVICES = True  # mantém 'rank' e 'heartbeat' para clientes antigos (use 'register')
+
+log = get_logger('REFERENCE')
 
 class ReferenceServer:
     """Servidor de Referência para coordenação de servidores"""
@@ -30,16 +33,43 @@ class ReferenceServer:
         self.clock = LogicalClock()
         self.datastore = DataStore('/data')
         
-        # Lista de servidores: {nome: {rank: int, last_heartbeat: float}}
+        # Lista de servidores: {nome: {rank: int, last_heartbeat: float, last_heartbeat_mono: float}}
+        # last_heartbeat é o horário de parede (persistido); last_heartbeat_mono é usado
+        # nas comparações de timeout, imune a saltos do relógio do sistema
         self.servers = {}
         self.server_lock = Lock()
         
         # Contador de ranks
         self.next_rank = 1
         
+        # Versão da lista de servidores, incrementada a cada entrada ou saída.
+        # Começa no horário de parede (ns) para não repetir versões de uma
+        # execução anterior que os servidores ainda conheçam
+        self.roster_version = time.time_ns()
+        
+        # Indica alterações na lista de servidores ainda não persistidas
+        self._dirty = False
+        
+        # Min-heap de expirações: (deadline monotônico, nome, versão do heartbeat)
+        # Entradas com versão diferente da atual do servidor estão obsoletas
+        self._expiry_heap = []
+        
         # Contexto ZeroMQ
-        self.context = zmq.Context()
+        self.context = zmq.Context(io_threads=ZMQ_IO_THREADS)
         self.socket = self.context.socket(zmq.REP)
+        self.socket.setsockopt(zmq.RCVHWM, SOCKET_HWM)
+        self.socket.setsockopt(zmq.SNDHWM, SOCKET_HWM)
+        self.socket.setsockopt(zmq.TCP_KEEPALIVE, 1)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        
+        # Tabela de despacho: serviço -> handler(data, now, mono)
+        self._handlers = {
+            'register': self.handle_register,
+            'list': self.handle_list_request
+        }
+        if LEGACY_SERVICES:
+            self._handlers['rank'] = self.handle_rank_request
+            self._handlers['heartbeat'] = self.handle_heartbeat
         
         # Carrega estado anterior se existir
         self._load_state()
@@ -54,10 +84,14 @@ class ReferenceServer:
             
             # Atualiza timestamps de heartbeat para now
             current_time = time.time()
-            for server_name in self.servers:
-                self.servers[server_name]['last_heartbeat'] = current_time
+            current_mono = time.monotonic()
+            for server_name, info in self.servers.items():
+                info['last_heartbeat'] = current_time
+                info['last_heartbeat_mono'] = current_mono
+                info['version'] = 0
+                self._schedule_expiry(server_name, info)
             
-            print(f"[REFERENCE] Estado carregado: {len(self.servers)} servidores")
+            log.info("Estado carregado: %d servidores", len(self.servers))
     
     def _save_state(self):
         """Salva estado atual"""
@@ -68,124 +102,224 @@ class ReferenceServer:
         }
         self.datastore.save('reference.json', data)
     
+    def _flush_state(self):
+        """Persiste o estado somente se a lista de servidores mudou desde a última escrita"""
+        with self.server_lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+            self._save_state()
+    
+    def _schedule_expiry(self, name, info):
+        """Agenda a expiração do heartbeat atual de um servidor (chamar com server_lock)"""
+        heapq.heappush(self._expiry_heap,
+                       (info['last_heartbeat_mono'] + HEARTBEAT_TIMEOUT, name, info['version']))
+    
+    def _touch_server(self, name, info, now, mono):
+        """Registra heartbeat de um servidor conhecido (chamar com server_lock)"""
+        info['last_heartbeat'] = now
+        info['last_heartbeat_mono'] = mono
+        info['version'] += 1
+        self._schedule_expiry(name, info)
+    
     def _cleanup_inactive_servers(self):
-        """Remove servidores inativos (sem heartbeat)"""
-        current_time = time.time()
-        inactive = []
+        """
+        Remove servidores inativos (sem heartbeat)
+        
+        Percorre apenas as entradas vencidas do heap de expirações; entradas
+        de heartbeats já renovados (versão antiga) são descartadas.
+        """
+        current_mono = time.monotonic()
+        heap = self._expiry_heap
         
         with self.server_lock:
-            for name, info in self.servers.items():
-                if current_time - info['last_heartbeat'] > HEARTBEAT_TIMEOUT:
-                    inactive.append(name)
-            
-            for name in inactive:
-                print(f"[REFERENCE] Removendo servidor inativo: {name}")
+            while heap and heap[0][0] < current_mono:
+                _, name, version = heapq.heappop(heap)
+                info = self.servers.get(name)
+                
+                if info is None or info['version'] != version:
+                    continue
+                
+                log.info("Removendo servidor inativo: %s", name)
                 del self.servers[name]
-            
-            if inactive:
-                self._save_state()
+                self.roster_version += 1
+                self._dirty = True
     
-    def handle_rank_request(self, data):
+    def _register_server(self, user, now, mono):
+        """
+        Registra um novo servidor com o próximo rank (chamar com server_lock)
+        
+        Returns:
+            Rank atribuído
         """
-        Atribui rank a um servidor
+        rank = self.next_rank
+        self.servers[user] = {
+            'rank': rank,
+            'last_heartbeat': now,
+            'last_heartbeat_mono': mono,
+            'version': 0
+        }
+        self.next_rank += 1
+        self.roster_version += 1
+        self._schedule_expiry(user, self.servers[user])
+        
+        # Persiste apenas quando a lista de servidores muda (em lote)
+        self._dirty = True
+        return rank
+    
+    def handle_register(self, data, now=None, mono=None):
+        """
+        Registra um servidor e renova seu heartbeat em uma única requisição
+        
+        Na primeira chamada atribui um rank; nas seguintes apenas atualiza o
+        heartbeat. O rank é sempre retornado, então o servidor usa este
+        serviço tanto no registro quanto como heartbeat periódico.
+        
+        Se a requisição trouxer 'known_version', a resposta inclui a versão
+        atual da lista de servidores ('roster_version') e, só quando ela
+        difere da conhecida, a própria lista ('list').
+        
+        Args:
+            data: Dados da requisição com 'user' (nome do servidor) e
+                opcionalmente 'known_version'
+            now: Horário de parede da requisição (time.time())
+            mono: Horário monotônico da requisição (time.monotonic())
+        
+        Returns:
+            Resposta serializada com o rank
+        """
+        return self._register_and_tick('register', data, now, mono)
+    
+    def handle_rank_request(self, data, now=None, mono=None):
+        """
+        Atribui rank a um servidor (legado, equivalente a 'register')
         
         Args:
             data: Dados da requisição com 'user' (nome do servidor)
+            now: Horário de parede da requisição (time.time())
+            mono: Horário monotônico da requisição (time.monotonic())
         
         Returns:
             Resposta serializada com o rank
         """
+        return self._register_and_tick('rank', data, now, mono)
+    
+    def _register_and_tick(self, service, data, now, mono):
+        """Atribui rank a servidores novos ou renova o heartbeat dos conhecidos"""
         user = data.get('user', '')
         
+        now = time.time() if now is None else now
+        mono = time.monotonic() if mono is None else mono
+        
         if not user:
-            return create_response('rank', 'erro', {}, self.clock, 
-                                 'Nome do servidor não fornecido')
+            return create_response(service, 'erro', {}, self.clock, 
+                                 'Nome do servidor não fornecido', now=now)
         
         with self.server_lock:
             # Se o servidor já existe, retorna o rank existente
             if user in self.servers:
-                rank = self.servers[user]['rank']
-                self.servers[user]['last_heartbeat'] = time.time()
+                info = self.servers[user]
+                rank = info['rank']
+                self._touch_server(user, info, now, mono)
             else:
                 # Atribui novo rank
-                rank = self.next_rank
-                self.servers[user] = {
-                    'rank': rank,
-                    'last_heartbeat': time.time()
-                }
-                self.next_rank += 1
-                print(f"[REFERENCE] Novo servidor registrado: {user} (rank {rank})")
+                rank = self._register_server(user, now, mono)
+                log.info("Novo servidor registrado: %s (rank %d)", user, rank)
             
-            self._save_state()
+            reply = {'rank': rank}
+            if 'known_version' in data:
+                reply['roster_version'] = self.roster_version
+                if data['known_version'] != self.roster_version:
+                    reply['list'] = self._server_list()
         
-        return create_response('rank', 'sucesso', {'rank': rank}, self.clock)
+        return create_response(service, 'sucesso', reply, self.clock, now=now)
+    
+    def _server_list(self):
+        """Retorna a lista [{name, rank}, ...] dos servidores ativos (chamar com server_lock)"""
+        return [
+            {'name': name, 'rank': info['rank']}
+            for name, info in self.servers.items()
+        ]
     
-    def handle_list_request(self, data):
+    def handle_list_request(self, data, now=None, mono=None):
         """
         Retorna lista de servidores ativos
         
+        Args:
+            data: Dados da requisição
+            now: Horário de parede da requisição (time.time())
+            mono: Não utilizado (mantém assinatura uniforme dos handlers)
+        
         Returns:
             Resposta serializada com a lista de servidores
         """
         with self.server_lock:
-            server_list = [
-                {'name': name, 'rank': info['rank']}
-                for name, info in self.servers.items()
-            ]
+            server_list = self._server_list()
         
-        return create_response('list', 'sucesso', {'list': server_list}, self.clock)
+        return create_response('list', 'sucesso', {'list': server_list}, self.clock, now=now)
     
-    def handle_heartbeat(self, data):
+    def handle_heartbeat(self, data, now=None, mono=None):
         """
-        Atualiza heartbeat de um servidor
+        Atualiza heartbeat de um servidor (legado, prefira 'register')
         
         Args:
             data: Dados da requisição com 'user' (nome do servidor)
+            now: Horário de parede da requisição (time.time())
+            mono: Horário monotônico da requisição (time.monotonic())
         
         Returns:
             Resposta de confirmação
         """
         user = data.get('user', '')
         
+        now = time.time() if now is None else now
+        mono = time.monotonic() if mono is None else mono
+        
         if not user:
             return create_response('heartbeat', 'erro', {}, self.clock,
-                                 'Nome do servidor não fornecido')
+                                 'Nome do servidor não fornecido', now=now)
         
         with self.server_lock:
             if user in self.servers:
-                self.servers[user]['last_heartbeat'] = time.time()
+                self._touch_server(user, self.servers[user], now, mono)
             else:
                 # Servidor desconhecido, registra com novo rank
-                rank = self.next_rank
-                self.servers[user] = {
-                    'rank': rank,
-                    'last_heartbeat': time.time()
-                }
-                self.next_rank += 1
-                print(f"[REFERENCE] Servidor registrado via heartbeat: {user} (rank {rank})")
+                rank = self._register_server(user, now, mono)
+                log.info("Servidor registrado via heartbeat: %s (rank %d)", user, rank)
         
-        return create_response('heartbeat', 'sucesso', {}, self.clock)
+        return create_response('heartbeat', 'sucesso', {}, self.clock, now=now)
     
     def run(self):
         """Executa o loop principal do servidor de referência"""
-        print("[REFERENCE] Iniciando Servidor de Referência...")
+        log.info("Iniciando Servidor de Referência...")
         
         # Bind no socket
         self.socket.bind(REF_PORT)
-        print(f"[REFERENCE] Escutando em {REF_PORT}")
-        print(f"[REFERENCE] Servidor pronto (clock: {self.clock.get_time()})")
+        log.info("Escutando em %s", REF_PORT)
+        log.info("Servidor pronto (clock: %d)", self.clock.get_time())
         
         # Thread para limpeza periódica
         cleanup_thread = Thread(target=self._periodic_cleanup, daemon=True)
         cleanup_thread.start()
         
+        poller = zmq.Poller()
+        poller.register(self.socket, zmq.POLLIN)
+        
         try:
             while True:
-                # Recebe mensagem
-                raw_message = self.socket.recv()
+                # Drena requisições pendentes sem bloquear; só espera no poller quando vazio
+                try:
+                    raw_message = self.socket.recv(zmq.DONTWAIT)
+                except zmq.Again:
+                    poller.poll(POLL_TIMEOUT)
+                    continue
+                
                 message = parse_message(raw_message)
                 
                 if not message:
+                    # REP exige uma resposta antes do próximo recv
+                    self.socket.send(create_response('error', 'erro', {}, self.clock,
+                                                     'Mensagem inválida'))
                     continue
                 
                 service = message.get('service', '')
@@ -193,26 +327,29 @@ class ReferenceServer:
                 
                 # Atualiza relógio lógico
                 received_clock = data.get('clock', 0)
-                update_logical_clock(self.clock, received_clock)
+                self.clock.update(received_clock)
+                
+                # Um único par de leituras de relógio por requisição
+                now = time.time()
+                mono = time.monotonic()
                 
                 # Processa requisição baseado no serviço
-                if service == 'rank':
-                    response = self.handle_rank_request(data)
-                elif service == 'list':
-                    response = self.handle_list_request(data)
-                elif service == 'heartbeat':
-                    response = self.handle_heartbeat(data)
+                handler = self._handlers.get(service)
+                if handler:
+                    response = handler(data, now, mono)
                 else:
                     response = create_response(service, 'erro', {}, self.clock,
-                                             f'Serviço desconhecido: {service}')
+                                             f'Serviço desconhecido: {service}', now=now)
                 
                 # Envia resposta
                 self.socket.send(response)
                 
         except KeyboardInterrupt:
-            print("\n[REFERENCE] Encerrando servidor de referência...")
+            log.info("Encerrando servidor de referência...")
         finally:
-            self._save_state()
+            with self.server_lock:
+                self._save_state()
+                self._dirty = False
             self.socket.close()
             self.context.term()
     
@@ -221,6 +358,7 @@ class ReferenceServer:
         while True:
             time.sleep(10)  # Verifica a cada 10 segundos
             self._cleanup_inactive_servers()
+            self._flush_state()
 
 def main():
     """Função principal"""
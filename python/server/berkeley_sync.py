@@ -4,10 +4,48 @@ Módulo de Sincronização de Relógio Físico - Algoritmo de Berkeley
 Implementa sincronização de tempo entre servidores distribuídos
 """
 
+import math
+import os
+import statistics
 import time
-from typing import List, Dict, Tuple
+from collections import deque
+from itertools import count
+from threading import Lock
+from typing import List, Dict, Optional
+import msgpack
 import zmq
 
+from common_utils.logger import get_logger
+
+ROUND_TIMEOUT = 2.0  # segundos de prazo global para uma etapa da rodada
+OUTLIER_THRESHOLD = 1.0  # segundos de desvio máximo em relação à mediana para entrar na média
+OUTLIER_SIGMAS = 3.0  # desvios-padrão tolerados em relação ao histórico do próprio servidor
+OUTLIER_FLOOR = 0.005  # segundos; limiar adaptativo mínimo (evita descartar tudo com variância ~0)
+DRIFT_MIN_SAMPLES = 5  # rodadas observadas antes de aplicar o limiar adaptativo
+PEER_SNDHWM = 10  # requisições enfileiradas por servidor antes de considerá-lo indisponível
+OFFSET_THRESHOLD = 0.001  # segundos; abaixo disso a rodada não distribui offsets
+SYNC_HISTORY_SIZE = 1000  # Registros mais recentes mantidos em memória (o completo fica no .jsonl)
+
+log = get_logger('BERKELEY')
+
+
+def _resolve_wall_clock():
+    """
+    Escolhe uma única vez o relógio absoluto usado nas rodadas de Berkeley
+    
+    BERKELEY_CLOCK=tai usa CLOCK_TAI (imune a saltos de segundo bissexto;
+    requer o offset TAI configurado no kernel, ex: por ptp4l/phc2sys ou
+    chrony). Qualquer outro valor, ou plataforma sem CLOCK_TAI, usa o
+    relógio de sistema. Todos os servidores devem usar a mesma fonte.
+    """
+    if os.environ.get('BERKELEY_CLOCK', 'realtime').lower() == 'tai' and hasattr(time, 'CLOCK_TAI'):
+        clock_id = time.CLOCK_TAI
+        return lambda: time.clock_gettime_ns(clock_id)
+    return time.time_ns
+
+
+wall_clock_ns = _resolve_wall_clock()  # Leitura do relógio absoluto em ns (vDSO)
+
 class BerkeleySynchronizer:
     """
     Implementação do algoritmo de Berkeley para sincronização de relógios
@@ -27,10 +65,30 @@ class BerkeleySynchronizer:
         """
         self.server_name = server_name
         self.is_coordinator = is_coordinator
-        self.time_offset = 0.0  # Offset aplicado ao relógio local
-        self.sync_history = []  # Histórico de sincronizações
+        self.time_offset_ns = 0  # Offset aplicado ao relógio local (inteiro, em ns)
+        self.sync_history = deque(maxlen=SYNC_HISTORY_SIZE)  # Histórico recente de sincronizações
         self.datastore = datastore
         
+        # Contexto ZeroMQ de longa duração
+        self.context = zmq.Context()
+        
+        # Um socket DEALER persistente por servidor (conectado sob demanda)
+        self._dealers = {}
+        
+        # Identificadores de rodada: respostas atrasadas de rodadas
+        # anteriores chegam no mesmo DEALER e são descartadas por não baterem
+        self._request_ids = count(1)
+        
+        # Estimador de Welford por servidor do desvio em relação à mediana:
+        # {server_name: (n, média, M2)}, O(1) de estado por servidor
+        self._drift = {}
+        
+        # Packer reutilizado entre rodadas (protegido por _round_lock)
+        self._packer = msgpack.Packer(use_bin_type=True)
+        
+        # Impede duas rodadas simultâneas disputando os mesmos sockets
+        self._round_lock = Lock()
+        
     def get_local_time(self) -> float:
         """
         Retorna o tempo local ajustado com o offset
@@ -38,14 +96,98 @@ class BerkeleySynchronizer:
         Returns:
             Timestamp ajustado
         """
-        return time.time() + self.time_offset
+        return (wall_clock_ns() + self.time_offset_ns) * 1e-9
+    
+    @property
+    def time_offset(self) -> float:
+        """Offset total aplicado ao relógio local, em segundos"""
+        return self.time_offset_ns * 1e-9
+    
+    def _dealer(self, server_name: str):
+        """
+        Retorna o socket DEALER do servidor, criando e conectando na primeira vez
+        
+        O DEALER envia o delimitador vazio esperado pelo REP da porta 6000, então
+        várias requisições podem ficar em voo sem o lockstep do REQ. O SNDHWM
+        baixo limita quantas requisições ficam enfileiradas para um servidor
+        fora do ar; acima disso o envio falha e o servidor é ignorado na rodada.
+        """
+        socket = self._dealers.get(server_name)
+        if socket is None:
+            socket = self.context.socket(zmq.DEALER)
+            socket.setsockopt(zmq.LINGER, 0)
+            socket.setsockopt(zmq.SNDHWM, PEER_SNDHWM)
+            socket.connect(f"tcp://{server_name}:6000")
+            self._dealers[server_name] = socket
+        return socket
     
-    def collect_timestamps(self, server_list: List[Dict]) -> Dict[str, float]:
+    def _exchange(self, requests: Dict[str, bytes], request_id: int) -> Dict[str, Dict]:
+        """
+        Envia uma requisição a cada servidor e coleta as respostas até o prazo
+        
+        Todas as requisições são enviadas antes de qualquer espera; um único
+        Poller aguarda as respostas, então a etapa dura max(RTT) limitado por
+        ROUND_TIMEOUT.
+        
+        Args:
+            requests: {server_name: requisição já serializada}
+            request_id: Identificador da rodada, embutido em todas as requisições
+        
+        Returns:
+            {server_name: dados da resposta} dos servidores que responderam
+        """
+        poller = zmq.Poller()
+        pending = {}  # socket -> server_name
+        
+        for server_name, payload in requests.items():
+            socket = self._dealer(server_name)
+            
+            try:
+                socket.send_multipart([b'', payload], zmq.DONTWAIT)
+            except zmq.Again:
+                log.warning("Servidor %s indisponível", server_name)
+                continue
+            
+            pending[socket] = server_name
+            poller.register(socket, zmq.POLLIN)
+        
+        responses = {}
+        deadline = time.monotonic() + ROUND_TIMEOUT
+        
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            
+            for socket, _ in poller.poll(remaining * 1000):
+                frames = socket.recv_multipart()
+                data = msgpack.unpackb(frames[-1], raw=False).get('data', {})
+                server_name = pending[socket]
+                
+                if data.get('request_id') != request_id:
+                    continue  # Resposta de uma rodada anterior
+                
+                responses[server_name] = data
+                poller.unregister(socket)
+                del pending[socket]
+        
+        for server_name in pending.values():
+            log.warning("Sem resposta de %s dentro do prazo", server_name)
+        
+        return responses
+    
+    def collect_timestamps(self, server_list: List[Dict],
+                           known_offsets: Optional[Dict[str, float]] = None) -> Dict[str, float]:
         """
         Coordenador coleta timestamps de todos os servidores
         
+        Servidores com diferença de relógio já conhecida (medida nas
+        confirmações de replicação) têm o timestamp estimado localmente e
+        ficam fora da etapa get_time; só os demais são consultados.
+        
         Args:
             server_list: Lista de servidores ativos [{name, address}, ...]
+            known_offsets: {server_name: relógio do servidor menos o local}
         
         Returns:
             Dicionário {server_name: timestamp}
@@ -55,51 +197,44 @@ class BerkeleySynchronizer:
         # Adiciona timestamp do próprio coordenador
         timestamps[self.server_name] = self.get_local_time()
         
-        # Cria contexto temporário para requisições
-        context = zmq.Context()
-        
+        known_offsets = known_offsets or {}
+        now = wall_clock_ns() * 1e-9
         for server in server_list:
-            if server['name'] == self.server_name:
-                continue
-                
-            try:
-                # Socket REQ para solicitar timestamp
-                socket = context.socket(zmq.REQ)
-                socket.setsockopt(zmq.RCVTIMEO, 2000)  # Timeout 2s
-                socket.setsockopt(zmq.SNDTIMEO, 2000)
-                
-                address = f"tcp://{server['name']}:6000"
-                socket.connect(address)
-                
-                # Solicita timestamp
-                import msgpack
-                request = msgpack.packb({
-                    'service': 'get_time',
-                    'data': {'requester': self.server_name}
-                })
-                
-                socket.send(request)
-                
-                # Recebe resposta
-                raw_response = socket.recv()
-                response = msgpack.unpackb(raw_response, raw=False)
-                
-                if response.get('data', {}).get('time'):
-                    timestamps[server['name']] = response['data']['time']
-                
-                socket.close()
-                
-            except Exception as e:
-                print(f"[BERKELEY] Erro ao coletar timestamp de {server['name']}: {e}")
-                continue
+            offset = known_offsets.get(server['name'])
+            if offset is not None and server['name'] != self.server_name:
+                timestamps[server['name']] = now + offset
+        
+        # A requisição é idêntica para todos: serializa uma única vez por rodada
+        request_id = next(self._request_ids)
+        request = self._packer.pack({
+            'service': 'get_time',
+            'data': {'requester': self.server_name, 'request_id': request_id}
+        })
+        requests = {
+            server['name']: request
+            for server in server_list
+            if server['name'] not in timestamps
+        }
+        if not requests:
+            log.debug("Timestamps de todos os servidores obtidos das confirmações de replicação")
+            return timestamps
+        
+        for server_name, data in self._exchange(requests, request_id).items():
+            if data.get('time'):
+                timestamps[server_name] = data['time']
         
-        context.term()
         return timestamps
     
     def calculate_offsets(self, timestamps: Dict[str, float]) -> Dict[str, float]:
         """
         Calcula offsets necessários para cada servidor
         
+        Como no algoritmo de Berkeley clássico, relógios cujo desvio em relação
+        à mediana excede OUTLIER_THRESHOLD ficam fora da média, mas ainda
+        recebem offset para convergir a ela. Com histórico suficiente, um
+        servidor também fica fora quando o desvio da rodada foge do seu
+        padrão (ver _within_drift).
+        
         Args:
             timestamps: Dicionário {server_name: timestamp}
         
@@ -109,19 +244,60 @@ class BerkeleySynchronizer:
         if not timestamps:
             return {}
         
-        # Calcula tempo médio
-        avg_time = sum(timestamps.values()) / len(timestamps)
+        # Descarta relógios discrepantes antes da média
+        median = statistics.median(timestamps.values())
+        good = [t for name, t in timestamps.items() if self._within_drift(name, t - median)]
+        
+        if len(good) < len(timestamps):
+            log.warning("%d relógio(s) discrepante(s) fora da média", len(timestamps) - len(good))
+        
+        # Calcula tempo médio (fsum evita perda de precisão ao somar epochs grandes)
+        avg_time = math.fsum(good) / len(good) if good else median
         
         # Calcula offset para cada servidor
-        offsets = {}
-        for server_name, timestamp in timestamps.items():
-            offsets[server_name] = avg_time - timestamp
+        offsets = {name: avg_time - timestamp for name, timestamp in timestamps.items()}
         
-        print(f"[BERKELEY] Tempo médio: {avg_time:.6f}")
-        print(f"[BERKELEY] Offsets calculados: {offsets}")
+        log.debug("Tempo médio: %.6f", avg_time)
+        log.debug("Offsets calculados: %s", offsets)
         
         return offsets
     
+    def _within_drift(self, server_name: str, deviation: float) -> bool:
+        """
+        Decide se o desvio da rodada é consistente e atualiza o histórico
+        
+        Desvios acima de OUTLIER_THRESHOLD são sempre rejeitados e não entram
+        no histórico. Após DRIFT_MIN_SAMPLES rodadas, o desvio também precisa
+        ficar a até OUTLIER_SIGMAS desvios-padrão da média do servidor
+        (mínimo OUTLIER_FLOOR). Média e variância são mantidas pelo método
+        de Welford, sem guardar as amostras.
+        
+        Args:
+            server_name: Nome do servidor
+            deviation: Timestamp do servidor menos a mediana da rodada
+        
+        Returns:
+            True se o timestamp pode entrar na média
+        """
+        if abs(deviation) > OUTLIER_THRESHOLD:
+            return False
+        
+        n, mean, m2 = self._drift.get(server_name, (0, 0.0, 0.0))
+        
+        consistent = True
+        if n >= DRIFT_MIN_SAMPLES:
+            std = math.sqrt(m2 / (n - 1))
+            consistent = abs(deviation - mean) <= max(OUTLIER_SIGMAS * std, OUTLIER_FLOOR)
+        
+        # Atualização de Welford
+        n += 1
+        delta = deviation - mean
+        mean += delta / n
+        m2 += delta * (deviation - mean)
+        self._drift[server_name] = (n, mean, m2)
+        
+        return consistent
+    
     def distribute_offsets(self, offsets: Dict[str, float], server_list: List[Dict]):
         """
         Distribui offsets para todos os servidores
@@ -130,7 +306,9 @@ class BerkeleySynchronizer:
             offsets: Dicionário {server_name: offset}
             server_list: Lista de servidores ativos
         """
-        context = zmq.Context()
+        request_id = next(self._request_ids)
+        timestamp = time.time()
+        requests = {}
         
         for server in server_list:
             server_name = server['name']
@@ -143,40 +321,19 @@ class BerkeleySynchronizer:
             if server_name not in offsets:
                 continue
             
-            try:
-                socket = context.socket(zmq.REQ)
-                socket.setsockopt(zmq.RCVTIMEO, 2000)
-                socket.setsockopt(zmq.SNDTIMEO, 2000)
-                
-                address = f"tcp://{server_name}:6000"
-                socket.connect(address)
-                
-                # Envia offset
-                import msgpack
-                request = msgpack.packb({
-                    'service': 'apply_offset',
-                    'data': {
-                        'offset': offsets[server_name],
-                        'coordinator': self.server_name,
-                        'timestamp': time.time()
-                    }
-                })
-                
-                socket.send(request)
-                
-                # Aguarda confirmação
-                raw_response = socket.recv()
-                response = msgpack.unpackb(raw_response, raw=False)
-                
-                if response.get('data', {}).get('status') == 'success':
-                    print(f"[BERKELEY] Offset aplicado em {server_name}: {offsets[server_name]:.6f}s")
-                
-                socket.close()
-                
-            except Exception as e:
-                print(f"[BERKELEY] Erro ao distribuir offset para {server_name}: {e}")
+            requests[server_name] = self._packer.pack({
+                'service': 'apply_offset',
+                'data': {
+                    'offset': offsets[server_name],
+                    'coordinator': self.server_name,
+                    'timestamp': timestamp,
+                    'request_id': request_id
+                }
+            })
         
-        context.term()
+        for server_name, data in self._exchange(requests, request_id).items():
+            if data.get('status') == 'success':
+                log.debug("Offset aplicado em %s: %.6fs", server_name, offsets[server_name])
     
     def apply_offset(self, offset: float):
         """
@@ -185,7 +342,8 @@ class BerkeleySynchronizer:
         Args:
             offset: Valor do offset em segundos
         """
-        self.time_offset += offset
+        # Acumula em nanossegundos inteiros: somas exatas, sem erro acumulado
+        self.time_offset_ns += round(offset * 1_000_000_000)
         
         # Registra no histórico
         sync_record = {
@@ -193,60 +351,87 @@ class BerkeleySynchronizer:
             'offset_applied': offset,
             'total_offset': self.time_offset
         }
+        self._record_sync(sync_record)
+        
+        log.info("Offset aplicado: %.6fs (total: %.6fs)", offset, self.time_offset)
+    
+    def _record_sync(self, sync_record: Dict):
+        """Adiciona um registro ao histórico e persiste apenas esse registro"""
         self.sync_history.append(sync_record)
         
-        # Persiste histórico
         if self.datastore:
-            self.datastore.save_replication(f'berkeley_sync_{self.server_name}', {
-                'server': self.server_name,
-                'time_offset': self.time_offset,
-                'sync_history': self.sync_history
-            })
-        
-        print(f"[BERKELEY] Offset aplicado: {offset:.6f}s (total: {self.time_offset:.6f}s)")
+            self.datastore.append_replication(f'berkeley_sync_{self.server_name}', sync_record)
     
-    def run_synchronization(self, server_list: List[Dict]) -> bool:
+    def run_synchronization(self, server_list: List[Dict],
+                            known_offsets: Optional[Dict[str, float]] = None) -> bool:
         """
         Executa uma rodada completa de sincronização (coordenador)
         
         Args:
             server_list: Lista de servidores ativos
+            known_offsets: Diferenças de relógio já medidas (ver collect_timestamps)
         
         Returns:
             True se sincronização foi bem-sucedida
         """
         if not self.is_coordinator:
-            print(f"[BERKELEY] {self.server_name} não é coordenador, ignorando sincronização")
+            log.debug("%s não é coordenador, ignorando sincronização", self.server_name)
             return False
         
-        print(f"[BERKELEY] Iniciando sincronização de relógio como coordenador")
+        if not self._round_lock.acquire(blocking=False):
+            log.debug("Rodada de sincronização já em andamento, ignorando")
+            return False
+        
+        log.info("Iniciando sincronização de relógio como coordenador")
         
         try:
             # Passo 1: Coletar timestamps
-            timestamps = self.collect_timestamps(server_list)
+            timestamps = self.collect_timestamps(server_list, known_offsets)
             
             if len(timestamps) < 2:
-                print(f"[BERKELEY] Timestamps insuficientes para sincronização: {len(timestamps)}")
+                log.warning("Timestamps insuficientes para sincronização: %d", len(timestamps))
                 return False
             
             # Passo 2: Calcular offsets
             offsets = self.calculate_offsets(timestamps)
             
+            # Relógios já alinhados: não há ajuste observável a distribuir
+            max_offset = max(abs(offset) for offset in offsets.values())
+            if max_offset < OFFSET_THRESHOLD:
+                self._record_sync({
+                    'timestamp': time.time(),
+                    'offset_applied': 0.0,
+                    'total_offset': self.time_offset,
+                    'skipped': True,
+                    'max_offset': max_offset
+                })
+                log.debug("Offsets abaixo de %gs (máx %.6fs), distribuição dispensada", OFFSET_THRESHOLD, max_offset)
+                return True
+            
             # Passo 3: Distribuir offsets
             self.distribute_offsets(offsets, server_list)
             
-            print(f"[BERKELEY] Sincronização completada com sucesso")
+            log.info("Sincronização completada com sucesso")
             return True
             
         except Exception as e:
-            print(f"[BERKELEY] Erro durante sincronização: {e}")
+            log.error("Erro durante sincronização: %s", e)
             return False
+        finally:
+            self._round_lock.release()
     
     def get_sync_history(self) -> List[Dict]:
         """
-        Retorna histórico de sincronizações
+        Retorna histórico recente de sincronizações
         
         Returns:
-            Lista de registros de sincronização
+            Lista com os últimos SYNC_HISTORY_SIZE registros de sincronização
         """
-        return self.sync_history
+        return list(self.sync_history)
+    
+    def close(self):
+        """Fecha os sockets e o contexto ZeroMQ (apenas no desligamento do servidor)"""
+        for socket in self._dealers.values():
+            socket.close()
+        self._dealers.clear()
+        self.context.term()
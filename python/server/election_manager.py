@@ -7,8 +7,19 @@ Implementa eleição distribuída entre servidores com base em rank
 import zmq
 import time
 import msgpack
+from collections import deque
 from typing import List, Dict, Optional
-from threading import Lock
+from threading import Event, Lock, Thread
+
+from common_utils.logger import get_logger
+
+ELECTION_TIMEOUT = 2.0  # segundos de prazo global para respostas de uma etapa da eleição
+LOG_FLUSH_INTERVAL = 0.1  # segundos entre gravações agrupadas do log de eleição
+ELECTION_LOG_SIZE = 1000  # Eventos mais recentes mantidos em memória (o completo fica no .jsonl)
+# Tópico dos anúncios entre servidores. O filtro SUB do ZeroMQ compara só o
+# prefixo: o NUL final impede que canais ou usuários chamados 'servers...'
+# casem com a inscrição, e o próprio ZeroMQ descarta esse tráfego
+SERVERS_TOPIC = b'servers\x00'
 
 class ElectionManager:
     """
@@ -18,20 +29,20 @@ class ElectionManager:
     Eleição é iniciada quando o coordenador atual falha.
     """
     
-    def __init__(self, server_name: str, rank: int, pub_socket, datastore):
+    def __init__(self, server_name: str, rank: int, proxy_address: str, datastore):
         """
         Inicializa o gerenciador de eleição
         
         Args:
             server_name: Nome deste servidor
             rank: Rank atribuído pelo ReferenceServer
-            pub_socket: Socket PUB para anunciar coordenador
+            proxy_address: Endereço do proxy PUB-SUB para anunciar coordenador
             datastore: Instância do DataStore para persistir logs
         """
         self.server_name = server_name
         self.rank = rank
-        self.pub_socket = pub_socket
         self.datastore = datastore
+        self.log = get_logger(f"ELECTION:{server_name}")
         
         # Estado da eleição
         self.is_coordinator = False
@@ -39,9 +50,21 @@ class ElectionManager:
         self.election_in_progress = False
         self.election_lock = Lock()
         
+        # Época da eleição: cresce a cada rodada e viaja nas requisições e no
+        # anúncio, para descartar resultados de rodadas já superadas
+        self.election_epoch = 0
+        
+        # Pedidos de eleição vindos de outros servidores são coalescidos num
+        # único sinal e atendidos por uma thread dedicada (eleição própria ou,
+        # se já for coordenador, novo anúncio)
+        self._election_trigger = Event()
+        Thread(target=self._election_worker, daemon=True).start()
+        
         # Lista de servidores conhecidos
-        self.known_servers = []
-        self.servers_lock = Lock()
+        # Tupla imutável substituída por inteiro a cada atualização: leitores
+        # usam a referência atual sem precisar de lock
+        self.known_servers = ()
+        self._higher_ranked = ()  # Servidores de rank maior (candidatos do Bully)
         
         # Contexto ZeroMQ para comunicação REQ/REP
         self.context = zmq.Context()
@@ -49,24 +72,36 @@ class ElectionManager:
         # Socket REP para receber requisições de eleição (porta 6001)
         self.election_socket = self.context.socket(zmq.REP)
         
-        # Log de eleições
-        self.election_log = []
+        # Socket PUB próprio para os anúncios: o PUB do servidor pertence ao
+        # loop principal e sockets ZeroMQ não são thread-safe. Eleições rodam
+        # na thread de eleição e no pool do servidor, então os envios são
+        # serializados por _pub_lock
+        self.pub_socket = self.context.socket(zmq.PUB)
+        self.pub_socket.setsockopt(zmq.LINGER, 0)
+        self.pub_socket.connect(proxy_address)
+        self._pub_lock = Lock()
+        
+        # Log de eleições; eventos novos aguardam em _pending_log até a
+        # thread de gravação persisti-los em lote, fora do caminho da eleição
+        self.election_log = deque(maxlen=ELECTION_LOG_SIZE)
+        self._pending_log = []
         self.log_lock = Lock()
+        self._stop_flush = Event()
+        Thread(target=self._flush_loop, daemon=True).start()
         
-        print(f"[ELECTION:{self.server_name}] Gerenciador inicializado (rank {rank})")
+        self.log.info("Gerenciador inicializado (rank %d)", rank)
     
     def start_election_server(self):
         """Inicia servidor de eleição em porta dedicada"""
         try:
             self.election_socket.bind("tcp://*:6001")
-            print(f"[ELECTION:{self.server_name}] Servidor de eleição escutando na porta 6001")
+            self.log.info("Servidor de eleição escutando na porta 6001")
             
-            from threading import Thread
             thread = Thread(target=self._handle_election_requests, daemon=True)
             thread.start()
             
         except Exception as e:
-            print(f"[ELECTION:{self.server_name}] Erro ao iniciar servidor de eleição: {e}")
+            self.log.error("Erro ao iniciar servidor de eleição: %s", e)
     
     def _handle_election_requests(self):
         """Thread que processa requisições de eleição"""
@@ -94,7 +129,7 @@ class ElectionManager:
                 self.election_socket.send(msgpack.packb(response))
                 
             except Exception as e:
-                print(f"[ELECTION:{self.server_name}] Erro ao processar requisição: {e}")
+                self.log.error("Erro ao processar requisição: %s", e)
                 error_response = {
                     'service': 'error',
                     'data': {'status': 'error', 'message': str(e)}
@@ -113,16 +148,29 @@ class ElectionManager:
         """
         requester_rank = data.get('rank', 0)
         requester_name = data.get('server', '')
+        requester_epoch = data.get('epoch', 0)
         
-        print(f"[ELECTION:{self.server_name}] Requisição de eleição recebida de {requester_name} (rank {requester_rank})")
+        self.log.debug("Requisição de eleição recebida de %s (rank %d)", requester_name, requester_rank)
         
         # Se meu rank é maior, respondo OK e inicio minha própria eleição
         if self.rank > requester_rank:
-            print(f"[ELECTION:{self.server_name}] Meu rank ({self.rank}) é maior. Respondendo OK e iniciando eleição.")
+            with self.election_lock:
+                # Só uma eleição em andamento cobre o pedido. Épocas são locais
+                # e não persistem (um servidor reiniciado volta à época 0),
+                # então uma época menor não indica que o requisitante conhece
+                # o resultado: o OK o faz desistir, e alguém precisa anunciar
+                covered = self.election_in_progress
+                if not covered:
+                    self.election_epoch = max(self.election_epoch, requester_epoch)
             
-            # Inicia eleição própria em thread separada (não bloqueia resposta)
-            from threading import Thread
-            Thread(target=self.start_election, daemon=True).start()
+            if covered:
+                self.log.debug("Meu rank (%d) é maior. Respondendo OK (eleição já em andamento).", self.rank)
+            else:
+                self.log.info("Meu rank (%d) é maior. Respondendo OK e iniciando eleição.", self.rank)
+                
+                # Sinaliza a thread de eleição (não bloqueia resposta; pedidos
+                # repetidos antes dela acordar viram uma única eleição)
+                self._election_trigger.set()
         
         return {
             'service': 'election',
@@ -134,6 +182,21 @@ class ElectionManager:
             }
         }
     
+    def _election_worker(self):
+        """Thread que executa as eleições sinalizadas por _election_trigger"""
+        while True:
+            self._election_trigger.wait()
+            self._election_trigger.clear()
+            
+            try:
+                if self.is_coordinator:
+                    # Já sou o coordenador: basta reanunciar com a época atual
+                    self._publish_coordinator_announcement()
+                else:
+                    self.start_election()
+            except Exception as e:
+                self.log.error("Erro na eleição: %s", e)
+    
     def _handle_coordinator_announcement(self, data: Dict) -> Dict:
         """
         Processa anúncio de novo coordenador
@@ -144,26 +207,38 @@ class ElectionManager:
         Returns:
             Confirmação de recebimento
         """
-        new_coordinator = data.get('coordinator', '')
-        coordinator_rank = data.get('rank', 0)
+        self.accept_coordinator(data.get('coordinator', ''), data.get('rank', 0), data.get('epoch', 0))
         
-        print(f"[ELECTION:{self.server_name}] Coordenador anunciado: {new_coordinator} (rank {coordinator_rank})")
+        return {
+            'service': 'coordinator',
+            'data': {
+                'status': 'OK',
+                'timestamp': time.time()
+            }
+        }
+    
+    def accept_coordinator(self, new_coordinator: str, coordinator_rank: int, epoch: int = 0):
+        """
+        Adota o coordenador anunciado e encerra eleição em andamento
+        
+        Uma eleição própria de época menor, ainda em voo, é abortada ao
+        perceber a época mais nova.
+        
+        Args:
+            new_coordinator: Nome do novo coordenador
+            coordinator_rank: Rank do novo coordenador
+            epoch: Época da eleição que elegeu o coordenador
+        """
+        self.log.info("Coordenador anunciado: %s (rank %d)", new_coordinator, coordinator_rank)
         
         with self.election_lock:
             self.coordinator = new_coordinator
             self.is_coordinator = (new_coordinator == self.server_name)
             self.election_in_progress = False
+            self.election_epoch = max(self.election_epoch, epoch)
         
         # Registra no log
         self._log_election_event('coordinator_announced', new_coordinator, coordinator_rank)
-        
-        return {
-            'service': 'coordinator',
-            'data': {
-                'status': 'OK',
-                'timestamp': time.time()
-            }
-        }
     
     def update_server_list(self, server_list: List[Dict]):
         """
@@ -172,8 +247,12 @@ class ElectionManager:
         Args:
             server_list: Lista de servidores [{name, rank}, ...]
         """
-        with self.servers_lock:
-            self.known_servers = server_list.copy()
+        # Ranks são fixos: o filtro do Bully é feito aqui, não a cada eleição
+        self._higher_ranked = tuple(
+            server for server in server_list
+            if server['rank'] > self.rank and server['name'] != self.server_name
+        )
+        self.known_servers = tuple(server_list)
     
     def start_election(self):
         """
@@ -187,73 +266,58 @@ class ElectionManager:
         """
         with self.election_lock:
             if self.election_in_progress:
-                print(f"[ELECTION:{self.server_name}] Eleição já em progresso, ignorando.")
+                self.log.debug("Eleição já em progresso, ignorando.")
                 return
             
             self.election_in_progress = True
+            self.election_epoch += 1
+            epoch = self.election_epoch
         
-        print(f"[ELECTION:{self.server_name}] Iniciando eleição (rank {self.rank})")
+        self.log.info("Iniciando eleição (rank %d, época %d)", self.rank, epoch)
         self._log_election_event('election_started', self.server_name, self.rank)
         
-        # Encontra servidores com rank maior
-        higher_rank_servers = []
-        with self.servers_lock:
-            for server in self.known_servers:
-                if server['rank'] > self.rank and server['name'] != self.server_name:
-                    higher_rank_servers.append(server)
+        # Servidores com rank maior (pré-calculados em update_server_list)
+        higher_rank_servers = self._higher_ranked
         
         # Se não há servidores com rank maior, sou o coordenador
         if not higher_rank_servers:
-            print(f"[ELECTION:{self.server_name}] Nenhum servidor com rank maior. Tornando-me coordenador.")
+            self.log.info("Nenhum servidor com rank maior. Tornando-me coordenador.")
             self._become_coordinator()
             return
         
+        # Requisição ELECTION é idêntica para todos: serializa uma vez
+        request = msgpack.packb({
+            'service': 'election',
+            'data': {
+                'rank': self.rank,
+                'server': self.server_name,
+                'epoch': epoch,
+                'timestamp': time.time()
+            }
+        })
+        
         # Envia requisição ELECTION para servidores com rank maior
         received_ok = False
-        for server in higher_rank_servers:
-            try:
-                socket = self.context.socket(zmq.REQ)
-                socket.setsockopt(zmq.RCVTIMEO, 2000)  # Timeout 2s
-                socket.setsockopt(zmq.SNDTIMEO, 2000)
-                
-                address = f"tcp://{server['name']}:6001"
-                socket.connect(address)
-                
-                # Envia requisição de eleição
-                request = msgpack.packb({
-                    'service': 'election',
-                    'data': {
-                        'rank': self.rank,
-                        'server': self.server_name,
-                        'timestamp': time.time()
-                    }
-                })
-                
-                socket.send(request)
-                
-                # Aguarda resposta
-                raw_response = socket.recv()
-                response = msgpack.unpackb(raw_response, raw=False)
-                
-                if response.get('data', {}).get('status') == 'OK':
-                    print(f"[ELECTION:{self.server_name}] Recebido OK de {server['name']}. Cancelando eleição.")
-                    received_ok = True
-                
-                socket.close()
-                
-            except Exception as e:
-                print(f"[ELECTION:{self.server_name}] Erro ao contactar {server['name']}: {e}")
-                continue
+        for server_name, response in self._exchange(higher_rank_servers, request).items():
+            if response.get('data', {}).get('status') == 'OK':
+                self.log.info("Recebido OK de %s. Cancelando eleição.", server_name)
+                received_ok = True
         
+        # Um anúncio de época mais nova chegou durante a rodada
+        with self.election_lock:
+            superseded = self.election_epoch > epoch
+        
+        if superseded:
+            self.log.info("Eleição da época %d superada. Abortando.", epoch)
         # Se não recebeu OK de ninguém, torna-se coordenador
-        if not received_ok:
-            print(f"[ELECTION:{self.server_name}] Nenhum OK recebido. Tornando-me coordenador.")
+        elif not received_ok:
+            self.log.info("Nenhum OK recebido. Tornando-me coordenador.")
             self._become_coordinator()
         else:
             # Outro servidor de rank maior assumirá
             with self.election_lock:
                 self.election_in_progress = False
-            print(f"[ELECTION:{self.server_name}] Aguardando anúncio do novo coordenador.")
+            self.log.info("Aguardando anúncio do novo coordenador.")
     
     def _become_coordinator(self):
         """Declara-se coordenador e anuncia para todos"""
@@ -262,14 +326,12 @@ class ElectionManager:
             self.coordinator = self.server_name
             self.election_in_progress = False
         
-        print(f"[ELECTION:{self.server_name}] Sou o novo COORDENADOR (rank {self.rank})")
+        self.log.info("Sou o novo COORDENADOR (rank %d)", self.rank)
         self._log_election_event('became_coordinator', self.server_name, self.rank)
         
-        # Anuncia no tópico 'servers' via PUB-SUB
+        # Anuncia no tópico 'servers' via PUB-SUB (um único envio alcança
+        # todos os servidores inscritos)
         self._publish_coordinator_announcement()
-        
-        # Envia anúncio direto via REQ/REP para cada servidor
-        self._announce_to_all_servers()
     
     def _publish_coordinator_announcement(self):
         """Publica anúncio de coordenador no tópico 'servers'"""
@@ -280,49 +342,81 @@ class ElectionManager:
                     'event': 'new_coordinator',
                     'coordinator': self.server_name,
                     'rank': self.rank,
+                    'epoch': self.election_epoch,
                     'timestamp': time.time()
                 }
             }
             
             message = msgpack.packb(announcement)
-            self.pub_socket.send_multipart([b'servers', message])
+            with self._pub_lock:
+                self.pub_socket.send_multipart([SERVERS_TOPIC, message])
             
-            print(f"[ELECTION:{self.server_name}] Coordenador anunciado no tópico 'servers'")
+            self.log.info("Coordenador anunciado no tópico 'servers'")
             
         except Exception as e:
-            print(f"[ELECTION:{self.server_name}] Erro ao publicar anúncio: {e}")
+            self.log.error("Erro ao publicar anúncio: %s", e)
     
-    def _announce_to_all_servers(self):
-        """Envia anúncio de coordenador diretamente para todos os servidores"""
-        with self.servers_lock:
-            servers_to_notify = [s for s in self.known_servers if s['name'] != self.server_name]
+    def _exchange(self, servers: List[Dict], payload: bytes) -> Dict[str, Dict]:
+        """
+        Envia a mesma requisição a vários servidores e aguarda as respostas
+        
+        Todas as requisições saem antes de qualquer espera e um único Poller
+        aguarda as respostas até ELECTION_TIMEOUT, então respostas rápidas
+        não ficam presas atrás de servidores lentos ou fora do ar.
         
-        for server in servers_to_notify:
+        Args:
+            servers: Servidores de destino [{name, ...}, ...]
+            payload: Requisição já serializada
+        
+        Returns:
+            {server_name: resposta} dos servidores que responderam no prazo
+        """
+        poller = zmq.Poller()
+        pending = {}  # socket -> server_name
+        
+        for server in servers:
+            # LINGER 0: close() descarta o que não foi entregue a peers fora do ar.
+            # IMMEDIATE fica desligado: o envio NOBLOCK logo após connect()
+            # falharia antes de a conexão TCP ser estabelecida
+            socket = self.context.socket(zmq.DEALER)
+            socket.setsockopt(zmq.LINGER, 0)
+            
             try:
-                socket = self.context.socket(zmq.REQ)
-                socket.setsockopt(zmq.RCVTIMEO, 2000)
-                socket.setsockopt(zmq.SNDTIMEO, 2000)
-                
-                address = f"tcp://{server['name']}:6001"
-                socket.connect(address)
-                
-                announcement = msgpack.packb({
-                    'service': 'coordinator',
-                    'data': {
-                        'coordinator': self.server_name,
-                        'rank': self.rank,
-                        'timestamp': time.time()
-                    }
-                })
-                
-                socket.send(announcement)
-                socket.recv()  # Aguarda confirmação
+                socket.connect(f"tcp://{server['name']}:6001")
+                socket.send_multipart([b'', payload], zmq.NOBLOCK)
+            except zmq.ZMQError as e:
+                self.log.error("Erro ao contactar %s: %s", server['name'], e)
                 socket.close()
+                continue
+            
+            pending[socket] = server['name']
+            poller.register(socket, zmq.POLLIN)
+        
+        responses = {}
+        deadline = time.monotonic() + ELECTION_TIMEOUT
+        
+        try:
+            while pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
                 
-                print(f"[ELECTION:{self.server_name}] Anúncio enviado para {server['name']}")
-                
-            except Exception as e:
-                print(f"[ELECTION:{self.server_name}] Erro ao anunciar para {server['name']}: {e}")
+                for socket, _ in poller.poll(remaining * 1000):
+                    frames = socket.recv_multipart(zmq.NOBLOCK)
+                    server_name = pending.pop(socket)
+                    poller.unregister(socket)
+                    socket.close()
+                    
+                    try:
+                        responses[server_name] = msgpack.unpackb(frames[-1], raw=False)
+                    except Exception as e:
+                        self.log.warning("Resposta inválida de %s: %s", server_name, e)
+        finally:
+            for socket, server_name in pending.items():
+                self.log.warning("Sem resposta de %s dentro do prazo", server_name)
+                socket.close()
+        
+        return responses
     
     def _log_election_event(self, event_type: str, server: str, rank: int):
         """
@@ -342,12 +436,20 @@ class ElectionManager:
                 'local_server': self.server_name
             }
             self.election_log.append(log_entry)
-            
-            # Persiste log
-            self.datastore.save_replication('election_log', {
-                'server': self.server_name,
-                'log': self.election_log
-            })
+            self._pending_log.append(log_entry)
+    
+    def _flush_log(self):
+        """Acrescenta ao log persistido os eventos pendentes numa única escrita"""
+        with self.log_lock:
+            pending, self._pending_log = self._pending_log, []
+        
+        if pending:
+            self.datastore.append_replication('election_log', *pending)
+    
+    def _flush_loop(self):
+        """Thread que grava o log de eleição a cada LOG_FLUSH_INTERVAL"""
+        while not self._stop_flush.wait(LOG_FLUSH_INTERVAL):
+            self._flush_log()
     
     def check_coordinator_health(self, last_heartbeat_time: float, timeout: int = 15) -> bool:
         """
@@ -367,14 +469,19 @@ class ElectionManager:
         elapsed = current_time - last_heartbeat_time
         
         if elapsed > timeout:
-            print(f"[ELECTION:{self.server_name}] Coordenador {self.coordinator} falhou (timeout {elapsed:.1f}s)")
+            self.log.warning("Coordenador %s falhou (timeout %.1fs)", self.coordinator, elapsed)
             return False
         
         return True
     
     def cleanup(self):
         """Limpeza de recursos"""
+        self._stop_flush.set()
+        self._flush_log()
+        
         try:
             self.election_socket.close()
+            with self._pub_lock:
+                self.pub_socket.close()
         except:
             pass
@@ -5,10 +5,143 @@ Gerencia sincronização de dados entre servidores distribuídos
 """
 
 import zmq
+import heapq
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import time
 import msgpack
-from typing import Dict, List, Any
-from threading import Thread, Lock
+import msgspec
+from typing import Dict, List, Any, Callable, Optional, Tuple, Union
+from threading import Event, Thread, Lock
+from berkeley_sync import wall_clock_ns
+from common_utils.logger import get_logger
+
+PEER_TIMEOUT = 3.0  # segundos de prazo global para as confirmações de uma replicação
+PEER_HWM = 100  # Mensagens enfileiradas por servidor antes de bloquear o envio
+MAX_REQUEST_SIZE = 128 * 1024 * 1024  # bytes; limite do buffer do Unpacker de requisições
+REPLICATION_WORKERS = 4  # Threads reutilizadas para replicações assíncronas
+REPLICATION_HANDLERS = 4  # Workers que atendem requisições da porta 6000 em paralelo
+WORKERS_ENDPOINT = "inproc://replication-workers"
+FLUSH_INTERVAL = 0.02  # segundos entre envios agrupados das replicações assíncronas
+STATE_FILES = ('logins.json', 'channels.json', 'messages.json')  # Estado enviado em sync_state
+SERVICES = ('replicate', 'get_time', 'apply_offset', 'sync_state', 'state_summary')  # Serviços da porta 6000
+REPLICATION_LOG_SIZE = 10_000  # Entradas mais recentes mantidas no histórico de replicação
+DEPARTED_RETAIN_LIMIT = 10_000  # Escritas pendentes guardadas para um servidor fora da lista antes de esquecê-lo
+
+# Encoder/decoder C do msgspec para os payloads volumosos (replicações e
+# estado completo); geram os mesmos bytes que msgpack.packb
+_encode = msgspec.msgpack.Encoder().encode
+_decode = msgspec.msgpack.Decoder().decode
+
+
+def _message_order(msg: Dict) -> tuple:
+    """Chave de ordenação das mensagens persistidas: (timestamp, clock)"""
+    return (msg.get('timestamp', 0), msg.get('clock', 0))
+
+
+# Arquivos de estado mantidos ordenados em memória, com a chave de ordenação
+STATE_ORDER = {'messages.json': _message_order}
+
+
+def _login_key(login: Dict) -> Optional[str]:
+    """Chave de deduplicação de logins (None se o registro não tiver usuário)"""
+    return login.get('user')
+
+
+def _channel_key(channel: Dict) -> Optional[str]:
+    """Chave de deduplicação de canais (None se o registro não tiver nome)"""
+    return channel.get('channel')
+
+
+def _new_items(items: List[Dict], key_fn: Callable[[Dict], Any], existing_keys: set) -> List[Dict]:
+    """
+    Seleciona os itens cuja chave ainda não existe e registra essas chaves
+    
+    As chaves são calculadas e comparadas em bloco (map e diferença de
+    conjuntos) em vez de item a item.
+    
+    Args:
+        items: Itens recebidos
+        key_fn: Função que extrai a chave de deduplicação (None = ignorar)
+        existing_keys: Chaves já conhecidas; atualizado com as novas
+    
+    Returns:
+        Itens novos, na ordem recebida (um por chave, o de menor timestamp)
+    """
+    keys = list(map(key_fn, items))
+    fresh = set(keys).difference(existing_keys)
+    fresh.discard(None)
+    
+    to_add = [item for key, item in zip(keys, items) if key in fresh]
+    if len(to_add) > len(fresh):
+        # Chaves repetidas no próprio lote: mantém o registro de menor
+        # timestamp (como em _keep_earliest), para que a ordem de chegada
+        # não decida o vencedor
+        earliest = {}
+        for key, item in zip(keys, items):
+            if key in fresh:
+                kept = earliest.get(key)
+                if kept is None or item.get('timestamp', 0) < kept.get('timestamp', 0):
+                    earliest[key] = item
+        to_add = list(earliest.values())
+    
+    existing_keys.update(fresh)
+    return to_add
+
+
+def _keep_earliest(existing: List[Dict], items: List[Dict], key_fn: Callable[[Dict], Any],
+                   existing_keys: set) -> bool:
+    """
+    Resolve conflitos de chave mantendo o registro de menor timestamp
+    
+    Quando dois servidores registram a mesma chave (ex: o mesmo usuário),
+    todos convergem para o registro mais antigo, independentemente da ordem
+    em que as réplicas chegam.
+    
+    Args:
+        existing: Registros locais; alterados no lugar
+        items: Registros recebidos
+        key_fn: Função que extrai a chave de deduplicação
+        existing_keys: Chaves dos registros locais
+    
+    Returns:
+        True se algum registro local foi substituído
+    """
+    conflicts = [item for item in items if key_fn(item) in existing_keys]
+    if not conflicts:
+        return False
+    
+    index = {key_fn(item): i for i, item in enumerate(existing)}
+    replaced = False
+    for item in conflicts:
+        i = index[key_fn(item)]
+        if item.get('timestamp', 0) < existing[i].get('timestamp', 0):
+            existing[i] = item
+            replaced = True
+    return replaced
+
+def _response_prefix(service: str, data: Dict) -> bytes:
+    """
+    Pré-serializa uma resposta cujo último campo de 'data' é None
+    
+    None ocupa um único byte no fim da serialização; sem ele sobra um prefixo
+    ao qual basta concatenar o valor serializado do último campo.
+    """
+    return msgpack.packb({'service': service, 'data': data})[:-1]
+
+
+# Respostas frequentes pré-serializadas (ver _response_prefix)
+_APPLY_OFFSET_OK = _response_prefix('apply_offset', {'status': 'success', 'request_id': None})
+_REQUEST_ID_FIELD = msgpack.packb('request_id')
+_TIME_FIELD = msgpack.packb('time')
+
+# Confirmação de replicação até 'records_received' inclusive; a contagem e o
+# relógio local ('time', aproveitado pela sincronização Berkeley) são
+# concatenados a cada resposta
+_REPLICATE_OK = _response_prefix('replicate', {
+    'status': 'success', 'records_received': None, 'time': None
+})[:-(len(_TIME_FIELD) + 1)]
 
 class ReplicationManager:
     """
@@ -18,7 +151,7 @@ class ReplicationManager:
     diretamente quando processar uma operação.
     """
     
-    def __init__(self, server_name: str, rank: int, datastore):
+    def __init__(self, server_name: str, rank: int, datastore, archived_ids: Optional[set] = None):
         """
         Inicializa o gerenciador de replicação
         
@@ -26,78 +159,228 @@ class ReplicationManager:
             server_name: Nome deste servidor
             rank: Rank atribuído pelo ReferenceServer
             datastore: Instância do DataStore para persistência
+            archived_ids: Identificadores das mensagens já arquivadas pelo
+                servidor (conjunto compartilhado, atualizado por ele)
         """
         self.server_name = server_name
         self.rank = rank
         self.datastore = datastore
         
-        # Lista de servidores conhecidos
-        self.known_servers = []
-        self.servers_lock = Lock()
+        # Mensagens arquivadas saíram de messages.json, então a deduplicação
+        # pelo cache não as vê: réplicas delas são descartadas por este
+        # conjunto. Só é consultado aqui (testes de pertinência são atômicos
+        # sob o GIL enquanto o servidor o atualiza)
+        self.archived_ids = archived_ids if archived_ids is not None else set()
+        self.log = get_logger(f"REPLICATION:{server_name}")
+        
+        # Servidores conhecidos: tupla imutável substituída por inteiro em
+        # update_server_list, então leitores não precisam de lock
+        self.known_servers = ()
         
-        # Contexto ZeroMQ
+        # Contexto ZeroMQ; as opções comuns a todos os sockets ficam como
+        # padrão do contexto e são herdadas pelos sockets criados por ele
         self.context = zmq.Context()
+        self.context.setsockopt(zmq.LINGER, 0)  # close() não espera por peer inalcançável
+        self.context.setsockopt(zmq.SNDHWM, PEER_HWM)
+        self.context.setsockopt(zmq.RCVHWM, PEER_HWM)
+        self.context.setsockopt(zmq.TCP_KEEPALIVE, 1)  # Detecta conexões TCP mortas
+        
+        # Socket ROUTER para receber requisições de replicação (porta 6000);
+        # após start_replication_server pertence à thread do proxy
+        self.rep_socket = self.context.socket(zmq.ROUTER)
+        self._serving = False
+        
+        # Um DEALER persistente por servidor destino, reutilizado entre
+        # replicações; o lock de cada entrada serializa o uso do socket
+        self._peer_sockets: Dict[str, Tuple[zmq.Socket, Lock]] = {}
+        self._peer_lock = Lock()
+        
+        # Pool fixo para replicações disparadas pelo atendimento de clientes,
+        # em vez de uma thread nova por operação
+        self._fanout_pool = ThreadPoolExecutor(max_workers=REPLICATION_WORKERS,
+                                               thread_name_prefix='repl-fanout')
+        
+        # Replicações assíncronas aguardam em _out_queue ({tipo: registros})
+        # e são enviadas em lote a cada FLUSH_INTERVAL, uma requisição por tipo
+        self._out_queue: Dict[str, List] = {}
+        self._out_lock = Lock()
+        self._stop_flush = Event()
+        Thread(target=self._flush_loop, daemon=True).start()
+        
+        # Estado local em memória: {arquivo: (assinatura, itens, chaves)}.
+        # O MessageServer grava os mesmos arquivos, então o cache só é usado
+        # enquanto a assinatura (stat) do arquivo não mudar. Cada arquivo tem
+        # seu próprio lock, então mesclar logins não bloqueia mensagens
+        self._state = {}
+        self._state_locks = {filename: Lock() for filename in STATE_FILES}
+        
+        # Maior 'seq' confirmada por servidor e tipo: {servidor: {tipo: seq}}.
+        # replicate_delta envia a cada servidor só o que vem depois dela; um
+        # inteiro por servidor e tipo, em vez das chaves de tudo já replicado.
+        # Servidores que saem da lista continuam acompanhados (as escritas que
+        # perderem seguem retidas para quando voltarem) até acumularem
+        # DEPARTED_RETAIN_LIMIT pendências
+        self._acked_seq: Dict[str, Dict[str, int]] = {}
+        self._acked_lock = Lock()
+        
+        # Servidores vistos pela primeira vez (ou esquecidos e de volta) que
+        # ainda não receberam o estado completo; os em envio ficam em _pushing
+        self._needs_state: set = set()
+        self._pushing: set = set()
         
-        # Socket REP para receber requisições de replicação (porta 6000)
-        self.rep_socket = self.context.socket(zmq.REP)
+        # Prefixo da resposta de get_time até o campo 'time' inclusive; o
+        # valor do tempo e o request_id são concatenados a cada chamada
+        self._time_prefix = _response_prefix('get_time', {
+            'server': server_name, 'time': None, 'request_id': None
+        })[:-(len(_REQUEST_ID_FIELD) + 1)]
         
-        # Histórico de replicação
-        self.replication_log = []
-        self.log_lock = Lock()
+        # Diferença de relógio de cada servidor (dele menos o local, em
+        # segundos) medida nas confirmações de replicação, com o instante
+        # monotônico da medida: {servidor: (offset, instante)}
+        self._clock_samples: Dict[str, Tuple[float, float]] = {}
         
-        print(f"[REPLICATION:{self.server_name}] Gerenciador inicializado (rank {rank})")
+        # Resposta de sync_state já serializada: (assinaturas dos arquivos, bytes)
+        self._snapshot: Optional[Tuple[tuple, bytes]] = None
+        
+        # Histórico recente de replicação em memória (append em deque é
+        # atômico, sem lock); o histórico completo fica em replication/<nome>.jsonl
+        self.replication_log = deque(maxlen=REPLICATION_LOG_SIZE)
+        
+        self.log.info("Gerenciador inicializado (rank %d)", rank)
     
     def start_replication_server(self):
-        """Inicia servidor de replicação em thread separada"""
+        """
+        Inicia servidor de replicação em threads separadas
+        
+        Um ROUTER na porta 6000 repassa as requisições, via proxy, a
+        REPLICATION_HANDLERS workers REP (inproc); uma mesclagem demorada não
+        bloqueia get_time/apply_offset nem outras replicações.
+        """
         try:
             self.rep_socket.bind("tcp://*:6000")
-            print(f"[REPLICATION:{self.server_name}] Servidor de replicação escutando na porta 6000")
+            workers = self.context.socket(zmq.DEALER)
+            workers.bind(WORKERS_ENDPOINT)
+            self._serving = True
+            self.log.info("Servidor de replicação escutando na porta 6000")
+            
+            # Workers conectam ao endpoint inproc depois do bind
+            for _ in range(REPLICATION_HANDLERS):
+                Thread(target=self._handle_replication_requests, daemon=True).start()
             
-            # Thread para processar requisições
-            thread = Thread(target=self._handle_replication_requests, daemon=True)
-            thread.start()
+            Thread(target=self._proxy_requests, args=(workers,), daemon=True).start()
             
         except Exception as e:
-            print(f"[REPLICATION:{self.server_name}] Erro ao iniciar servidor de replicação: {e}")
+            self.log.error("Erro ao iniciar servidor de replicação: %s", e)
+    
+    def _proxy_requests(self, workers: zmq.Socket):
+        """Thread que encaminha requisições entre o ROUTER e os workers"""
+        try:
+            zmq.proxy(self.rep_socket, workers)
+        except zmq.ContextTerminated:
+            pass
+        finally:
+            workers.close()
+            self.rep_socket.close()
     
     def _handle_replication_requests(self):
-        """Thread que processa requisições de replicação"""
-        while True:
-            try:
-                # Recebe requisição
-                raw_request = self.rep_socket.recv()
-                request = msgpack.unpackb(raw_request, raw=False)
-                
-                service = request.get('service', '')
-                data = request.get('data', {})
-                
-                # Processa baseado no serviço
-                if service == 'replicate':
-                    response = self._handle_replicate(data)
-                elif service == 'get_time':
-                    response = self._handle_get_time(data)
-                elif service == 'apply_offset':
-                    response = self._handle_apply_offset(data)
-                elif service == 'sync_state':
-                    response = self._handle_sync_state(data)
-                else:
-                    response = {
-                        'service': service,
-                        'data': {'status': 'error', 'message': f'Serviço desconhecido: {service}'}
+        """Worker que processa requisições de replicação recebidas do proxy"""
+        socket = self.context.socket(zmq.REP)
+        socket.connect(WORKERS_ENDPOINT)
+        
+        # Packer e Unpacker pertencem a este worker e reaproveitam seus
+        # buffers entre requisições
+        packer = msgpack.Packer(use_bin_type=True)
+        unpacker = msgpack.Unpacker(raw=False, max_buffer_size=MAX_REQUEST_SIZE)
+        
+        try:
+            while True:
+                # O socket REP só aceita uma resposta após um recv bem-sucedido;
+                # a resposta de erro só é enviada se há requisição pendente
+                awaiting_reply = False
+                try:
+                    # Recebe requisição (um objeto msgpack por frame); copy=False
+                    # entrega o buffer do ZeroMQ sem cópia intermediária em bytes
+                    frame = socket.recv(copy=False)
+                    awaiting_reply = True
+                    unpacker.feed(frame.buffer)
+                    service, data = self._read_request(unpacker)
+                    
+                    # Processa baseado no serviço
+                    if service == 'replicate':
+                        response = self._handle_replicate(data)
+                    elif service == 'get_time':
+                        response = self._handle_get_time(data)
+                    elif service == 'apply_offset':
+                        response = self._handle_apply_offset(data)
+                    elif service == 'sync_state':
+                        response = self._handle_sync_state(data)
+                    elif service == 'state_summary':
+                        response = self._handle_state_summary(data)
+                    else:
+                        response = {
+                            'service': service,
+                            'data': {'status': 'error', 'message': f'Serviço desconhecido: {service}'}
+                        }
+                    
+                    # Envia resposta (handlers podem devolvê-la já serializada)
+                    if not isinstance(response, bytes):
+                        response = packer.pack(response)
+                    socket.send(response, copy=False)
+                    awaiting_reply = False
+                    
+                except zmq.ContextTerminated:
+                    break
+                except Exception as e:
+                    self.log.error("Erro ao processar requisição: %s", e)
+                    
+                    # Descarta bytes restantes de uma requisição inválida
+                    unpacker = msgpack.Unpacker(raw=False, max_buffer_size=MAX_REQUEST_SIZE)
+                    packer.reset()
+                    
+                    if not awaiting_reply:
+                        continue
+                    
+                    error_response = {
+                        'service': 'error',
+                        'data': {'status': 'error', 'message': str(e)}
                     }
-                
-                # Envia resposta
-                self.rep_socket.send(msgpack.packb(response))
-                
-            except Exception as e:
-                print(f"[REPLICATION:{self.server_name}] Erro ao processar requisição: {e}")
-                error_response = {
-                    'service': 'error',
-                    'data': {'status': 'error', 'message': str(e)}
-                }
-                self.rep_socket.send(msgpack.packb(error_response))
+                    try:
+                        socket.send(packer.pack(error_response))
+                    except zmq.ContextTerminated:
+                        break
+                    except zmq.ZMQError as send_error:
+                        self.log.error("Erro ao enviar resposta de erro: %s", send_error)
+        finally:
+            socket.close()
+    
+    @staticmethod
+    def _read_request(unpacker: msgpack.Unpacker) -> Tuple[Any, Any]:
+        """
+        Decodifica uma requisição {'service', 'data'} campo a campo
+        
+        O campo 'data' só é decodificado se o serviço já lido for conhecido
+        (os remetentes gravam 'service' primeiro); para serviços desconhecidos
+        e campos extras os bytes são pulados sem construir objetos.
+        
+        Args:
+            unpacker: Unpacker já alimentado com o frame da requisição
+        
+        Returns:
+            Tupla (serviço, dados)
+        """
+        service, data = None, {}
+        for _ in range(unpacker.read_map_header()):
+            key = unpacker.unpack()
+            if key == 'service':
+                service = unpacker.unpack()
+            elif key == 'data' and (service is None or service in SERVICES):
+                data = unpacker.unpack()
+            else:
+                unpacker.skip()
+        
+        return ('' if service is None else service), data
     
-    def _handle_replicate(self, data: Dict) -> Dict:
+    def _handle_replicate(self, data: Dict) -> Union[bytes, Dict]:
         """
         Processa requisição de replicação de dados
         
@@ -105,13 +388,13 @@ class ReplicationManager:
             data: Dados da requisição
         
         Returns:
-            Resposta com status
+            Resposta com status (já serializada em caso de sucesso)
         """
         source_server = data.get('source_server', '')
         data_type = data.get('type', '')
         payload = data.get('payload', [])
         
-        print(f"[REPLICATION:{self.server_name}] Recebendo replicação de {source_server} (tipo: {data_type})")
+        self.log.debug("Recebendo replicação de %s (tipo: %s)", source_server, data_type)
         
         try:
             # Mescla dados replicados com dados locais
@@ -128,186 +411,264 @@ class ReplicationManager:
                 }
             
             # Registra no log
-            with self.log_lock:
-                log_entry = {
-                    'timestamp': time.time(),
-                    'source': source_server,
-                    'type': data_type,
-                    'records': len(payload) if isinstance(payload, list) else 1
-                }
-                self.replication_log.append(log_entry)
-                
-                # Salva log de replicação
-                self.datastore.save_replication(self.server_name, {
-                    'server': self.server_name,
-                    'log': self.replication_log
-                })
+            log_entry = {
+                'timestamp': time.time(),
+                'source': source_server,
+                'type': data_type,
+                'records': len(payload) if isinstance(payload, list) else 1
+            }
+            self.replication_log.append(log_entry)
             
-            print(f"[REPLICATION:{self.server_name}] Dados replicados com sucesso ({len(payload) if isinstance(payload, list) else 1} registros)")
+            # Acrescenta a entrada ao log persistido, sem reescrever o histórico
+            self.datastore.append_replication(self.server_name, log_entry)
             
-            return {
-                'service': 'replicate',
-                'data': {'status': 'success', 'records_received': len(payload) if isinstance(payload, list) else 1}
-            }
+            self.log.debug("Dados replicados com sucesso (%d registros)", log_entry['records'])
+            
+            return b''.join((
+                _REPLICATE_OK,
+                msgpack.packb(log_entry['records']),
+                _TIME_FIELD,
+                msgpack.packb(wall_clock_ns() * 1e-9)
+            ))
             
         except Exception as e:
-            print(f"[REPLICATION:{self.server_name}] Erro ao replicar dados: {e}")
+            self.log.error("Erro ao replicar dados: %s", e)
             return {
                 'service': 'replicate',
                 'data': {'status': 'error', 'message': str(e)}
             }
     
-    def _handle_get_time(self, data: Dict) -> Dict:
-        """Retorna timestamp local (para sincronização Berkeley)"""
-        return {
-            'service': 'get_time',
-            'data': {
-                'time': time.time(),
-                'server': self.server_name
-            }
-        }
+    def _handle_get_time(self, data: Dict) -> bytes:
+        """Retorna timestamp local (para sincronização Berkeley), já serializado"""
+        return b''.join((
+            self._time_prefix,
+            msgpack.packb(wall_clock_ns() * 1e-9),
+            _REQUEST_ID_FIELD,
+            msgpack.packb(data.get('request_id'))
+        ))
     
-    def _handle_apply_offset(self, data: Dict) -> Dict:
-        """Aplica offset de sincronização Berkeley"""
+    def _handle_apply_offset(self, data: Dict) -> bytes:
+        """Aplica offset de sincronização Berkeley (resposta já serializada)"""
         offset = data.get('offset', 0.0)
         coordinator = data.get('coordinator', '')
         
         # Nota: O offset seria aplicado ao relógio, mas como usamos time.time()
         # do sistema, apenas registramos para fins de logging
-        print(f"[REPLICATION:{self.server_name}] Offset recebido de {coordinator}: {offset:.6f}s")
+        self.log.debug("Offset recebido de %s: %.6fs", coordinator, offset)
+        
+        return _APPLY_OFFSET_OK + msgpack.packb(data.get('request_id'))
+    
+    def _handle_state_summary(self, data: Dict) -> Dict:
+        """
+        Informa a chave de ordenação (timestamp, clock) da mensagem mais recente
+        
+        Quem envia o estado completo (_push_state) manda só as mensagens
+        posteriores a ela, em vez de toda a janela recente.
+        """
+        with self._state_locks['messages.json']:
+            messages, _ = self._cached_state('messages.json', self._get_message_id)
+            latest = _message_order(messages[-1]) if messages else None
         
         return {
-            'service': 'apply_offset',
-            'data': {'status': 'success'}
+            'service': 'state_summary',
+            'data': {'status': 'success', 'latest_message': latest}
         }
     
-    def _handle_sync_state(self, data: Dict) -> Dict:
-        """Retorna estado completo para sincronização"""
+    def _handle_sync_state(self, data: Dict) -> Union[bytes, Dict]:
+        """
+        Retorna estado completo para sincronização
+        
+        A resposta serializada é reaproveitada enquanto nenhum dos arquivos
+        de estado mudar, então sincronizações seguidas de vários servidores
+        custam uma única serialização.
+        """
         try:
-            logins = self.datastore.load('logins.json', default=[])
-            channels = self.datastore.load('channels.json', default=[])
-            messages = self.datastore.load('messages.json', default=[])
-            
-            return {
-                'service': 'sync_state',
-                'data': {
-                    'status': 'success',
-                    'state': {
-                        'logins': logins,
-                        'channels': channels,
-                        'messages': messages
-                    }
-                }
-            }
+            with self._state_locks['logins.json'], self._state_locks['channels.json'], \
+                    self._state_locks['messages.json']:
+                signature = tuple(self.datastore.signature(f) for f in STATE_FILES)
+                
+                if self._snapshot is None or self._snapshot[0] != signature:
+                    logins, _ = self._cached_state('logins.json', _login_key)
+                    channels, _ = self._cached_state('channels.json', _channel_key)
+                    messages, _ = self._cached_state('messages.json', self._get_message_id)
+                    
+                    self._snapshot = (signature, _encode({
+                        'service': 'sync_state',
+                        'data': {
+                            'status': 'success',
+                            'state': {
+                                'logins': logins,
+                                'channels': channels,
+                                'messages': messages
+                            }
+                        }
+                    }))
+                
+                return self._snapshot[1]
         except Exception as e:
             return {
                 'service': 'sync_state',
                 'data': {'status': 'error', 'message': str(e)}
             }
     
+    def _cached_state(self, filename: str, key_fn: Callable[[Dict], Any]) -> Tuple[List[Dict], set]:
+        """
+        Retorna itens e chaves de deduplicação de um arquivo de estado
+        
+        Relê o arquivo apenas se ele mudou desde a última leitura ou escrita
+        feita aqui; caso contrário reaproveita a lista e o conjunto em memória.
+        Deve ser chamado com o lock do arquivo (_state_locks) adquirido; quem
+        vai gravar a partir do resultado segura também o lock do DataStore,
+        para que nenhuma escrita da thread do servidor caia entre a leitura e
+        a gravação (save() a descartaria junto com o journal). Arquivos com
+        ordem definida (STATE_ORDER) são ordenados ao serem relidos, já que o
+        journal guarda a ordem de chegada.
+        
+        Args:
+            filename: Nome do arquivo (ex: 'logins.json')
+            key_fn: Função que extrai a chave de deduplicação de um item
+        
+        Returns:
+            Tupla (itens, conjunto de chaves)
+        """
+        signature = self.datastore.signature(filename)
+        cached = self._state.get(filename)
+        
+        if cached is not None and cached[0] == signature:
+            return cached[1], cached[2]
+        
+        items = self.datastore.load(filename, default=[])
+        order = STATE_ORDER.get(filename)
+        if order is not None:
+            # Timsort aproveita os trechos já ordenados: quase O(N) no caso
+            # comum, em que só entradas do journal estão fora de ordem
+            items.sort(key=order)
+        keys = {key for key in map(key_fn, items) if key is not None}
+        self._state[filename] = (signature, items, keys)
+        return items, keys
+    
+    def _store_state(self, filename: str, items: List[Dict], keys: set):
+        """Atualiza o cache após uma gravação feita por este gerenciador"""
+        self._state[filename] = (self.datastore.signature(filename), items, keys)
+    
     def _merge_logins(self, new_logins: List[Dict]):
         """
         Mescla logins replicados com logins locais
-        Remove duplicatas baseado no campo 'user'
+        Remove duplicatas baseado no campo 'user'; em conflito prevalece o
+        login mais antigo
         """
         try:
-            # Carrega logins existentes
-            existing = self.datastore.load('logins.json', default=[])
-            
-            # Cria conjunto de usuários já existentes
-            existing_users = {login['user'] for login in existing if 'user' in login}
-            
-            # Adiciona apenas novos usuários
-            for login in new_logins:
-                if 'user' in login and login['user'] not in existing_users:
-                    existing.append(login)
-                    existing_users.add(login['user'])
+            with self._state_locks['logins.json'], self.datastore.locked('logins.json'):
+                existing, existing_users = self._cached_state('logins.json', _login_key)
+                
+                replaced = _keep_earliest(existing, new_logins, _login_key, existing_users)
+                to_add = _new_items(new_logins, _login_key, existing_users)
+                existing.extend(to_add)
+                
+                # Novos logins vão para o journal; o snapshot só é reescrito
+                # se algum registro local foi substituído
+                if replaced:
+                    self.datastore.save('logins.json', existing)
+                elif to_add:
+                    self.datastore.append('logins.json', *to_add)
+                if replaced or to_add:
+                    self._store_state('logins.json', existing, existing_users)
             
-            # Salva resultado mesclado
-            self.datastore.save('logins.json', existing)
-            print(f"[REPLICATION:{self.server_name}] Logins mesclados: {len(existing)} total")
+            self.log.debug("Logins mesclados: %d total", len(existing))
             
         except Exception as e:
-            print(f"[REPLICATION:{self.server_name}] Erro ao mesclar logins: {e}")
+            self.log.error("Erro ao mesclar logins: %s", e)
     
     def _merge_channels(self, new_channels: List[Dict]):
         """
         Mescla canais replicados com canais locais
-        Remove duplicatas baseado no campo 'channel'
+        Remove duplicatas baseado no campo 'channel'; em conflito prevalece a
+        criação mais antiga
         """
         try:
-            # Carrega canais existentes
-            existing = self.datastore.load('channels.json', default=[])
-            
-            # Cria conjunto de canais já existentes
-            existing_channels = {ch['channel'] for ch in existing if 'channel' in ch}
-            
-            # Adiciona apenas novos canais
-            for channel in new_channels:
-                if 'channel' in channel and channel['channel'] not in existing_channels:
-                    existing.append(channel)
-                    existing_channels.add(channel['channel'])
+            with self._state_locks['channels.json'], self.datastore.locked('channels.json'):
+                existing, existing_channels = self._cached_state('channels.json', _channel_key)
+                
+                replaced = _keep_earliest(existing, new_channels, _channel_key, existing_channels)
+                to_add = _new_items(new_channels, _channel_key, existing_channels)
+                existing.extend(to_add)
+                
+                # Novos canais vão para o journal; o snapshot só é reescrito
+                # se algum registro local foi substituído
+                if replaced:
+                    self.datastore.save('channels.json', existing)
+                elif to_add:
+                    self.datastore.append('channels.json', *to_add)
+                if replaced or to_add:
+                    self._store_state('channels.json', existing, existing_channels)
             
-            # Salva resultado mesclado
-            self.datastore.save('channels.json', existing)
-            print(f"[REPLICATION:{self.server_name}] Canais mesclados: {len(existing)} total")
+            self.log.debug("Canais mesclados: %d total", len(existing))
             
         except Exception as e:
-            print(f"[REPLICATION:{self.server_name}] Erro ao mesclar canais: {e}")
+            self.log.error("Erro ao mesclar canais: %s", e)
     
     def _merge_messages(self, new_messages: List[Dict]):
         """
         Mescla mensagens replicadas com mensagens locais
         Remove duplicatas baseado em (timestamp, clock, user, channel/dst)
-        Mantém ordem por timestamp e clock
+        Mantém ordem por timestamp e clock: a lista em cache é ordenada ao ser
+        lida do disco (o servidor acrescenta ao journal na ordem de chegada),
+        então só as novas mensagens são ordenadas e intercaladas a ela.
+        O snapshot só é reescrito quando alguma nova precisa ser intercalada.
         """
         try:
-            # Carrega mensagens existentes
-            existing = self.datastore.load('messages.json', default=[])
-            
-            # Cria conjunto de identificadores únicos das mensagens existentes
-            existing_ids = set()
-            for msg in existing:
-                msg_id = self._get_message_id(msg)
-                existing_ids.add(msg_id)
-            
-            # Adiciona apenas mensagens novas
-            added = 0
-            for msg in new_messages:
-                msg_id = self._get_message_id(msg)
-                if msg_id not in existing_ids:
-                    existing.append(msg)
-                    existing_ids.add(msg_id)
-                    added += 1
-            
-            # Ordena por timestamp e clock para manter consistência
-            existing.sort(key=lambda m: (m.get('timestamp', 0), m.get('clock', 0)))
+            with self._state_locks['messages.json'], self.datastore.locked('messages.json'):
+                existing, existing_ids = self._cached_state('messages.json', self._get_message_id)
+                
+                # Mensagens já arquivadas não voltam para messages.json
+                if self.archived_ids:
+                    new_messages = [msg for msg in new_messages
+                                    if self._get_message_id(msg) not in self.archived_ids]
+                
+                # Separa apenas mensagens novas
+                to_add = _new_items(new_messages, self._get_message_id, existing_ids)
+                added = len(to_add)
+                
+                if to_add:
+                    # Intercala duas sequências ordenadas: O(N + M), sem reordenar tudo
+                    to_add.sort(key=_message_order)
+                    if not existing or _message_order(existing[-1]) <= _message_order(to_add[0]):
+                        # Caso comum: todas as novas vêm depois das salvas, então
+                        # basta acrescentá-las ao journal sem reescrever o snapshot
+                        existing.extend(to_add)
+                        self.datastore.append('messages.json', *to_add)
+                    else:
+                        # Só a cauda a partir da primeira nova é intercalada; a
+                        # posição sai de uma busca binária (bisect em C)
+                        pos = bisect_right(existing, _message_order(to_add[0]), key=_message_order)
+                        existing[pos:] = heapq.merge(existing[pos:], to_add, key=_message_order)
+                        self.datastore.save('messages.json', existing)
+                    
+                    self._store_state('messages.json', existing, existing_ids)
             
-            # Salva resultado mesclado
-            self.datastore.save('messages.json', existing)
-            print(f"[REPLICATION:{self.server_name}] Mensagens mescladas: {added} novas, {len(existing)} total")
+            self.log.debug("Mensagens mescladas: %d novas, %d total", added, len(existing))
             
         except Exception as e:
-            print(f"[REPLICATION:{self.server_name}] Erro ao mesclar mensagens: {e}")
+            self.log.error("Erro ao mesclar mensagens: %s", e)
     
-    def _get_message_id(self, msg: Dict) -> tuple:
+    @staticmethod
+    def _get_message_id(msg: Dict) -> tuple:
         """
         Gera identificador único para uma mensagem
         Baseado em: timestamp, clock, tipo, usuário e canal/destinatário
-        """
-        msg_type = msg.get('type', '')
-        timestamp = msg.get('timestamp', 0)
-        clock = msg.get('clock', 0)
-        user = msg.get('user', msg.get('src', ''))
-        
-        if msg_type == 'publish':
-            target = msg.get('channel', '')
-        else:  # message (privada)
-            target = msg.get('dst', '')
         
-        message_text = msg.get('message', '')
-        
-        return (timestamp, clock, msg_type, user, target, message_text)
+        Publicações têm 'channel' e mensagens privadas têm 'dst', então o
+        alvo sai do campo presente, sem desviar pelo tipo.
+        """
+        get = msg.get
+        return (
+            get('timestamp', 0),
+            get('clock', 0),
+            get('type', ''),
+            msg['user'] if 'user' in msg else get('src', ''),
+            get('channel') or get('dst', ''),
+            get('message', '')
+        )
     
     def update_server_list(self, servers: List[Dict]):
         """
@@ -316,74 +677,354 @@ class ReplicationManager:
         Args:
             servers: Lista com [{name, rank}, ...]
         """
-        with self.servers_lock:
-            self.known_servers = [s for s in servers if s['name'] != self.server_name]
+        self.known_servers = tuple(s for s in servers if s['name'] != self.server_name)
         
-        print(f"[REPLICATION:{self.server_name}] Lista de servidores atualizada: {len(self.known_servers)} servidores")
+        # Servidores sem acompanhamento não têm como receber só o delta: o que
+        # já saiu da fila de escritas chega a eles pelo estado completo
+        with self._acked_lock:
+            for server in self.known_servers:
+                if server['name'] not in self._acked_seq:
+                    self._acked_seq[server['name']] = {}
+                    self._needs_state.add(server['name'])
+        self.push_state_to_new_servers()
+        
+        self.log.debug("Lista de servidores atualizada: %d servidores", len(self.known_servers))
+    
+    def push_state_to_new_servers(self):
+        """Agenda o envio do estado completo aos servidores que ainda não o receberam"""
+        known = {server['name'] for server in self.known_servers}
+        with self._acked_lock:
+            targets = (self._needs_state & known) - self._pushing
+            self._pushing |= targets
+        
+        for target_server in targets:
+            self._fanout_pool.submit(self._push_state, target_server)
+    
+    def _push_state(self, target_server: str):
+        """
+        Envia o estado local a um servidor, mesclado por ele como réplica
+        
+        Logins e canais vão completos (são pequenos e deduplicados por nome).
+        Das mensagens vão só as posteriores à mais recente que o servidor
+        informa ter (state_summary): ao reiniciar, um servidor não reenvia a
+        cada par a janela que ele já tem. Escritas perdidas por um par que
+        saiu e voltou seguem pela retenção do delta (replicate_delta).
+        
+        Se algum tipo não for confirmado, o servidor segue em _needs_state e o
+        envio é repetido na próxima sincronização.
+        """
+        try:
+            summary = self._exchange([target_server], _encode({
+                'service': 'state_summary',
+                'data': {'source_server': self.server_name}
+            })).get(target_server, {}).get('data', {})
+            if summary.get('status') != 'success':
+                self.log.warning("Sem resumo de estado de %s; envio adiado", target_server)
+                return
+            latest = summary.get('latest_message')
+            
+            complete = True
+            for filename, data_type, key_fn in (('logins.json', 'logins', _login_key),
+                                                ('channels.json', 'channels', _channel_key),
+                                                ('messages.json', 'messages', self._get_message_id)):
+                with self._state_locks[filename]:
+                    items = self._cached_state(filename, key_fn)[0]
+                    if data_type == 'messages' and latest is not None:
+                        # Lista ordenada (STATE_ORDER): corta na primeira posterior
+                        items = items[bisect_right(items, tuple(latest), key=_message_order):]
+                    else:
+                        items = list(items)
+                if not items:
+                    continue
+                
+                responses = self._exchange([target_server], self._pack_replicate(data_type, items))
+                self._report(responses)
+                if responses.get(target_server, {}).get('data', {}).get('status') != 'success':
+                    complete = False
+            
+            if complete:
+                with self._acked_lock:
+                    self._needs_state.discard(target_server)
+                self.log.info("Estado completo enviado para %s", target_server)
+        except Exception as e:
+            self.log.error("Erro ao enviar estado para %s: %s", target_server, e)
+        finally:
+            with self._acked_lock:
+                self._pushing.discard(target_server)
     
     def replicate_to_all(self, data_type: str, payload: Any):
         """
         Replica dados para todos os servidores conhecidos
         
+        A requisição é serializada uma única vez e enviada a todos antes de
+        aguardar qualquer confirmação (ver _exchange).
+        
         Args:
             data_type: Tipo de dados ('logins', 'channels', 'messages')
             payload: Dados a replicar
         """
-        with self.servers_lock:
-            servers = list(self.known_servers)
+        servers = self.known_servers
         
         if not servers:
-            print(f"[REPLICATION:{self.server_name}] Nenhum servidor para replicar")
+            self.log.debug("Nenhum servidor para replicar")
             return
         
-        print(f"[REPLICATION:{self.server_name}] Replicando {data_type} para {len(servers)} servidores")
+        self.log.debug("Replicando %s para %d servidores", data_type, len(servers))
         
-        for server in servers:
-            self._replicate_to_server(server['name'], data_type, payload)
+        request = self._pack_replicate(data_type, payload)
+        self._report(self._exchange([server['name'] for server in servers], request))
+    
+    def replicate_delta(self, data_type: str, records: List[Tuple[int, Dict]]) -> int:
+        """
+        Replica apenas os registros que cada servidor ainda não confirmou
+        
+        Os registros vêm em ordem de seq e cada servidor confirmou tudo até a
+        sua maior seq confirmada, então o que falta a ele é um sufixo da lista.
+        Servidores com o mesmo sufixo pendente compartilham uma única
+        requisição serializada; servidores já em dia não recebem nada.
+        Servidores fora da lista não recebem nada, mas seguem retendo o que
+        perderam; quem acumula mais de DEPARTED_RETAIN_LIMIT pendências é
+        esquecido e, se voltar, recebe o estado completo.
+        
+        Args:
+            data_type: Tipo de dados ('logins', 'channels', 'messages')
+            records: Pares (seq, registro) candidatos a replicar, em ordem de seq
+        
+        Returns:
+            Maior seq confirmada por todos os servidores acompanhados: os
+            registros até ela podem sair da fila de quem chamou
+        """
+        if not records:
+            return 0
+        
+        known = {server['name'] for server in self.known_servers}
+        seqs = [seq for seq, _ in records]
+        
+        # Agrupa os servidores presentes pelo início do sufixo ainda pendente
+        groups: Dict[int, List[str]] = {}
+        with self._acked_lock:
+            for server, acked in list(self._acked_seq.items()):
+                start = bisect_right(seqs, acked.get(data_type, 0))
+                if server not in known:
+                    if len(records) - start > DEPARTED_RETAIN_LIMIT:
+                        del self._acked_seq[server]
+                        self.log.warning("%s fora da lista há %d escritas; receberá o estado completo se voltar",
+                                         server, len(records) - start)
+                elif start < len(records):
+                    groups.setdefault(start, []).append(server)
+        
+        for start, targets in groups.items():
+            delta = [record for _, record in records[start:]]
+            self.log.debug("Delta de %s: %d de %d registros para %s",
+                           data_type, len(delta), len(records), targets)
+            responses = self._exchange(targets, self._pack_replicate(data_type, delta))
+            self._report(responses)
+            self._record_acks(data_type, seqs[-1], responses)
+        
+        with self._acked_lock:
+            return min((acked.get(data_type, 0) for acked in self._acked_seq.values()),
+                       default=seqs[-1])
+    
+    def _record_acks(self, data_type: str, seq: int, responses: Dict[str, Dict]):
+        """Avança até seq a confirmação dos servidores que responderam com sucesso"""
+        with self._acked_lock:
+            for server, response in responses.items():
+                acked = self._acked_seq.get(server)
+                if acked is not None and response.get('data', {}).get('status') == 'success':
+                    acked[data_type] = max(acked.get(data_type, 0), seq)
+    
+    def replicate_async(self, data_type: str, payload: Any):
+        """
+        Enfileira dados para replicação e retorna imediatamente
+        
+        Operações próximas do mesmo tipo são agrupadas e enviadas juntas
+        pela thread de envio (ver _flush_outgoing).
+        
+        Args:
+            data_type: Tipo de dados ('logins', 'channels', 'messages')
+            payload: Registro ou lista de registros a replicar
+        """
+        with self._out_lock:
+            batch = self._out_queue.setdefault(data_type, [])
+            if isinstance(payload, list):
+                batch.extend(payload)
+            else:
+                batch.append(payload)
+    
+    def _flush_outgoing(self, wait: bool = False):
+        """
+        Replica os lotes pendentes, um replicate_to_all por tipo de dados
+        
+        Args:
+            wait: Se True, replica na thread atual em vez de usar o pool
+        """
+        with self._out_lock:
+            pending, self._out_queue = self._out_queue, {}
+        
+        for data_type, batch in pending.items():
+            if wait:
+                self.replicate_to_all(data_type, batch)
+            else:
+                self._fanout_pool.submit(self.replicate_to_all, data_type, batch)
+    
+    def _flush_loop(self):
+        """Thread que envia as replicações agrupadas a cada FLUSH_INTERVAL"""
+        while not self._stop_flush.wait(FLUSH_INTERVAL):
+            self._flush_outgoing()
     
     def _replicate_to_server(self, target_server: str, data_type: str, payload: Any):
         """
-        Replica dados para um servidor específico
+        Replica dados para um servidor específico (ex: reenvio pontual)
         
         Args:
             target_server: Nome do servidor destino
             data_type: Tipo de dados
             payload: Dados a replicar
         """
+        request = self._pack_replicate(data_type, payload)
+        self._report(self._exchange([target_server], request))
+    
+    def _pack_replicate(self, data_type: str, payload: Any) -> bytes:
+        """Serializa uma requisição de replicação"""
+        return _encode({
+            'service': 'replicate',
+            'data': {
+                'source_server': self.server_name,
+                'type': data_type,
+                'payload': payload,
+                'timestamp': time.time()
+            }
+        })
+    
+    def _report(self, responses: Dict[str, Dict]):
+        """Registra o resultado da replicação em cada servidor que respondeu"""
+        for target_server, response in responses.items():
+            if response.get('data', {}).get('status') == 'success':
+                self.log.debug("Dados replicados para %s", target_server)
+            else:
+                self.log.warning("Falha ao replicar para %s: %s", target_server, response)
+    
+    def _exchange(self, targets: List[str], request: bytes) -> Dict[str, Dict]:
+        """
+        Envia a mesma requisição aos servidores e coleta as confirmações
+        
+        Todos os envios são feitos antes de qualquer espera e um único Poller
+        aguarda as respostas até PEER_TIMEOUT, então a replicação leva
+        max(RTT) em vez da soma dos RTTs. Sockets sem resposta no prazo são
+        descartados do pool (e com eles qualquer resposta atrasada).
+        
+        Args:
+            targets: Nomes dos servidores destino
+            request: Requisição já serializada
+        
+        Returns:
+            {server_name: resposta} dos servidores que responderam no prazo
+        """
+        # Locks sempre adquiridos na mesma ordem (por nome) para evitar deadlock
+        entries = [(name, *self._get_peer_socket(name)) for name in sorted(set(targets))]
+        for _, _, lock in entries:
+            lock.acquire()
+        
         try:
-            socket = self.context.socket(zmq.REQ)
-            socket.setsockopt(zmq.RCVTIMEO, 3000)  # Timeout 3s
-            socket.setsockopt(zmq.SNDTIMEO, 3000)
+            poller = zmq.Poller()
+            pending = {}  # socket -> server_name
             
-            address = f"tcp://{target_server}:6000"
-            socket.connect(address)
+            for target_server, socket, _ in entries:
+                if socket.closed:
+                    # Descartado por uma chamada concorrente que acabou de falhar
+                    self.log.warning("Servidor %s indisponível", target_server)
+                    continue
+                
+                try:
+                    socket.send_multipart([b'', request], zmq.NOBLOCK, copy=False)
+                except zmq.ZMQError as e:
+                    self._evict_peer_socket(target_server, socket)
+                    self.log.error("Erro ao replicar para %s: %s", target_server, e)
+                    continue
+                
+                pending[socket] = target_server
+                poller.register(socket, zmq.POLLIN)
             
-            # Envia requisição de replicação
-            request = msgpack.packb({
-                'service': 'replicate',
-                'data': {
-                    'source_server': self.server_name,
-                    'type': data_type,
-                    'payload': payload,
-                    'timestamp': time.time()
-                }
-            })
+            responses = {}
+            sent_ns = wall_clock_ns()
+            deadline = time.monotonic() + PEER_TIMEOUT
             
-            socket.send(request)
+            while pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                
+                for socket, _ in poller.poll(remaining * 1000):
+                    raw_response = socket.recv_multipart(zmq.NOBLOCK, copy=False)[-1].buffer
+                    target_server = pending.pop(socket)
+                    poller.unregister(socket)
+                    
+                    try:
+                        responses[target_server] = msgpack.unpackb(raw_response, raw=False)
+                    except Exception as e:
+                        self.log.warning("Resposta inválida de %s: %s", target_server, e)
+                        continue
+                    
+                    # O relógio remoto foi lido entre o envio e o recebimento:
+                    # compara com o ponto médio do intervalo local
+                    remote_time = responses[target_server].get('data', {}).get('time')
+                    if remote_time:
+                        midpoint = (sent_ns + wall_clock_ns()) * 0.5e-9
+                        self._clock_samples[target_server] = (remote_time - midpoint, time.monotonic())
             
-            # Aguarda confirmação
-            raw_response = socket.recv()
-            response = msgpack.unpackb(raw_response, raw=False)
+            for socket, target_server in pending.items():
+                self._evict_peer_socket(target_server, socket)
+                self.log.warning("Sem confirmação de %s dentro do prazo", target_server)
             
-            if response.get('data', {}).get('status') == 'success':
-                print(f"[REPLICATION:{self.server_name}] Dados replicados para {target_server}")
-            else:
-                print(f"[REPLICATION:{self.server_name}] Falha ao replicar para {target_server}: {response}")
+            return responses
+        finally:
+            for _, _, lock in entries:
+                lock.release()
+    
+    def clock_offsets(self, max_age: float) -> Dict[str, float]:
+        """
+        Retorna as diferenças de relógio medidas nas confirmações recentes
+        
+        Args:
+            max_age: Idade máxima da medida, em segundos
+        
+        Returns:
+            {servidor: relógio do servidor menos o local, em segundos}
+        """
+        now = time.monotonic()
+        return {server: offset for server, (offset, seen) in list(self._clock_samples.items())
+                if now - seen <= max_age}
+    
+    def _get_peer_socket(self, target_server: str) -> Tuple[zmq.Socket, Lock]:
+        """
+        Retorna o DEALER persistente para um servidor, criando-o se necessário
+        
+        Args:
+            target_server: Nome do servidor destino
+        
+        Returns:
+            Tupla (socket, lock que serializa o uso do socket)
+        """
+        with self._peer_lock:
+            entry = self._peer_sockets.get(target_server)
             
-            socket.close()
+            if entry is None:
+                socket = self.context.socket(zmq.DEALER)
+                socket.connect(f"tcp://{target_server}:6000")
+                
+                entry = (socket, Lock())
+                self._peer_sockets[target_server] = entry
             
-        except Exception as e:
-            print(f"[REPLICATION:{self.server_name}] Erro ao replicar para {target_server}: {e}")
+            return entry
+    
+    def _evict_peer_socket(self, target_server: str, socket: zmq.Socket):
+        """Remove do pool e fecha o socket de um servidor que falhou"""
+        with self._peer_lock:
+            entry = self._peer_sockets.get(target_server)
+            if entry is not None and entry[0] is socket:
+                del self._peer_sockets[target_server]
+        
+        socket.close(0)
     
     def sync_from_coordinator(self, coordinator_name: str) -> bool:
         """
@@ -399,6 +1040,7 @@ class ReplicationManager:
             socket = self.context.socket(zmq.REQ)
             socket.setsockopt(zmq.RCVTIMEO, 5000)
             socket.setsockopt(zmq.SNDTIMEO, 5000)
+            socket.setsockopt(zmq.IMMEDIATE, 1)  # Não enfileira antes da conexão existir
             
             address = f"tcp://{coordinator_name}:6000"
             socket.connect(address)
@@ -411,9 +1053,9 @@ class ReplicationManager:
             
             socket.send(request)
             
-            # Recebe estado
-            raw_response = socket.recv()
-            response = msgpack.unpackb(raw_response, raw=False)
+            # Recebe estado (pode ter vários MB: lê direto do buffer do frame)
+            frame = socket.recv(copy=False)
+            response = _decode(frame.buffer)
             
             if response.get('data', {}).get('status') == 'success':
                 state = response['data']['state']
@@ -423,7 +1065,7 @@ class ReplicationManager:
                 self.datastore.save('channels.json', state.get('channels', []))
                 self.datastore.save('messages.json', state.get('messages', []))
                 
-                print(f"[REPLICATION:{self.server_name}] Estado sincronizado de {coordinator_name}")
+                self.log.info("Estado sincronizado de %s", coordinator_name)
                 socket.close()
                 return True
             
@@ -431,15 +1073,26 @@ class ReplicationManager:
             return False
             
         except Exception as e:
-            print(f"[REPLICATION:{self.server_name}] Erro ao sincronizar de {coordinator_name}: {e}")
+            self.log.error("Erro ao sincronizar de %s: %s", coordinator_name, e)
             return False
     
     def get_replication_log(self) -> List[Dict]:
         """Retorna log de replicação"""
-        with self.log_lock:
-            return list(self.replication_log)
+        return list(self.replication_log)
     
     def cleanup(self):
         """Limpa recursos"""
-        self.rep_socket.close()
+        self._stop_flush.set()
+        self._fanout_pool.shutdown(wait=False, cancel_futures=True)
+        self._flush_outgoing(wait=True)
+        
+        with self._peer_lock:
+            for socket, _ in self._peer_sockets.values():
+                socket.close(0)
+            self._peer_sockets.clear()
+        
+        # Com o servidor ativo, term() encerra proxy e workers, que fecham
+        # seus próprios sockets
+        if not self._serving:
+            self.rep_socket.close()
         self.context.term()
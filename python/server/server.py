@@ -6,24 +6,28 @@ Conecta ao broker (5556) e ao proxy (5557)
 """
 
 import zmq
+import msgpack
 import time
-import sys
 import os
 import random
-from threading import Thread, Lock
+import signal
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from collections import deque
+from itertools import count
+from threading import Event, Thread, Lock, current_thread, main_thread
 from datetime import datetime
 
-# Adiciona o diretório common_utils ao path
-sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'common_utils'))
-
-from logical_clock import LogicalClock
-from persistence import DataStore
-from messaging import create_message, parse_message, create_response, update_logical_clock
+from common_utils.logical_clock import LogicalClock
+from common_utils.persistence import DataStore
+from common_utils.messaging import create_message, parse_message, create_response
+from common_utils.logger import get_logger
 
 # Importa módulos de sincronização, replicação e eleição
 from berkeley_sync import BerkeleySynchronizer
 from replication_manager import ReplicationManager
-from election_manager import ElectionManager
+from election_manager import ElectionManager, SERVERS_TOPIC
 
 # Configurações
 BROKER_BACKEND = "tcp://broker:5556"
@@ -31,12 +35,41 @@ PROXY_BACKEND = "tcp://proxy:5557"
 REFERENCE_SERVER = "tcp://reference:5559"
 HEARTBEAT_INTERVAL = 10  # segundos
 SYNC_INTERVAL = 10  # a cada 10 mensagens
-CLOCK_SYNC_INTERVAL = 10  # a cada 10 mensagens
+SNAPSHOT_EVERY = 10  # Sincronizações entre checkpoints completos (snapshot + Berkeley); nas demais, só journal e replicação
+CLOCK_SAMPLE_MAX_AGE = 5.0  # segundos; medidas de relógio das replicações aceitas pelo Berkeley
 ELECTION_TIMEOUT = 15  # timeout para detectar falha do coordenador
+REFERENCE_TIMEOUT = 5000  # ms de espera por resposta do servidor de referência
+REGISTER_ATTEMPTS = 12  # tentativas de registro antes de desistir
+POLL_TIMEOUT = 100  # ms de espera do loop principal por requisições ou anúncios
+REQUEST_BATCH = 64  # Requisições já enfileiradas atendidas por despertar do poll
+MAX_MESSAGES_IN_MEMORY = 10000  # Mensagens mantidas em memória e em messages.json
+ARCHIVE_FILE = 'messages_archive.jsonl'  # Mensagens mais antigas (JSON Lines, só acréscimos)
+WRITE_QUEUE_SIZE = 10000  # Escritas pendentes antes de o produtor esperar a gravação
+WRITE_BATCH = 512  # Máximo de entradas gravadas por lote
+WRITE_BATCH_WINDOW = 0.001  # segundos de espera por mais entradas antes de gravar
+SOCKET_HWM = 100000  # Mensagens enfileiradas por socket antes de bloquear/descartar (rajadas)
+SYNC_WORKERS = 3  # Uma thread por tarefa de fundo: replicação, Berkeley e eleição
+
+_unpack = msgpack.unpackb  # Referência local, evita a busca do atributo a cada anúncio
 
 class MessageServer:
     """Servidor de mensagens do sistema BBS"""
     
+    # Atributos fixos: acesso via slot, sem __dict__ por instância
+    __slots__ = (
+        'server_name', 'log', 'clock', 'datastore',
+        'rank', 'coordinator', 'message_count', '_msgs_since_sync', '_syncs',
+        'last_coordinator_heartbeat', '_roster_version',
+        'berkeley_sync', 'replication_manager', 'election_manager',
+        'users_lock', 'channels_lock', 'messages_lock', 'coordinator_lock',
+        'users', 'channels', 'messages', '_channel_msgs', '_private_msgs',
+        '_seq', '_unreplicated', '_archive_by_channel', '_archive_by_user', '_archive_rounds', '_archived_ids',
+        '_topic_bytes', '_write_queue', '_write_ready',
+        '_sync_pool', '_sync_futures',
+        'context', 'req_socket', 'pub_socket', 'ref_socket', 'sub_socket',
+        '_handlers', '_running',
+    )
+    
     def __init__(self, server_name=None):
         """
         Inicializa o servidor de mensagens
@@ -45,6 +78,7 @@ class MessageServer:
             server_name: Nome do servidor (padrão: server_{random})
         """
         self.server_name = server_name or f"server_{random.randint(1000, 9999)}"
+        self.log = get_logger(f"SERVER:{self.server_name}")
         self.clock = LogicalClock()
         self.datastore = DataStore('/data')
         
@@ -52,7 +86,10 @@ class MessageServer:
         self.rank = None
         self.coordinator = None
         self.message_count = 0
+        self._msgs_since_sync = 0  # Requisições desde a última sincronização
+        self._syncs = 0  # Sincronizações disparadas (define o checkpoint completo)
         self.last_coordinator_heartbeat = time.time()
+        self._roster_version = None  # Versão da lista de servidores já aplicada
         
         # Sincronização Berkeley
         self.berkeley_sync = None  # Será inicializado após obter rank
@@ -63,19 +100,76 @@ class MessageServer:
         # Gerenciador de eleição
         self.election_manager = None  # Será inicializado após obter rank
         
-        # Locks para thread-safety
+        # Locks para thread-safety. Só escritores os adquirem: leituras
+        # (pertinência, list() e fatias de lista) são uma única operação em C,
+        # atômica sob o GIL, e os recarregamentos substituem os objetos inteiros.
+        # users e channels são copy-on-write: o escritor monta um dict novo e
+        # troca a referência, então um leitor pode iterar o que obteve sem lock
         self.users_lock = Lock()
         self.channels_lock = Lock()
         self.messages_lock = Lock()
         self.coordinator_lock = Lock()
         
         # Dados locais
-        self.users = set()
-        self.channels = set()
+        self.users = {}  # usuário -> timestamp do login
+        self.channels = {}  # canal -> timestamp da criação
         self.messages = []
         
-        # Contexto ZeroMQ
+        # Índices do histórico, mantidos junto com self.messages (sob
+        # messages_lock): publicações por canal e mensagens privadas por
+        # usuário (remetente e destinatário), em ordem cronológica
+        self._channel_msgs = {}
+        self._private_msgs = {}
+        
+        # Escritas locais ainda não confirmadas por todos os servidores
+        # acompanhados, por tipo, como pares (seq, entrada) em ordem de seq; a
+        # sincronização periódica só envia estas. A seq fica fora da entrada,
+        # que é gravada e devolvida aos clientes no histórico
+        self._seq = count(1)
+        # (deques: o handler só acrescenta e a sincronização só remove do
+        # início, ambas operações atômicas, então não há lock próprio)
+        self._unreplicated = {'logins': deque(), 'channels': deque(), 'messages': deque()}
+        
+        # Posições em ARCHIVE_FILE das mensagens arquivadas de cada canal e de
+        # cada usuário (remetente e destinatário), em ordem de arquivamento: o
+        # histórico lê só as linhas de que precisa, sem decodificar o arquivo.
+        # A thread de escrita acrescenta posições (array.append é atômico sob
+        # o GIL) enquanto o loop principal lê fatias
+        self._archive_by_channel = {}
+        self._archive_by_user = {}
+        self._archive_rounds = 0  # Arquivamentos feitos (detecta um durante o recarregamento)
+        # Identificadores das mensagens arquivadas: réplicas e recarregamentos
+        # descartam essas mensagens em vez de trazê-las de volta à janela
+        # recente (e arquivá-las de novo). Só cresce, sob messages_lock
+        self._archived_ids = set()
+        
+        # Tópicos PUB já codificados (canal ou usuário -> bytes UTF-8); só
+        # recebe nomes existentes, então cresce com canais e usuários
+        self._topic_bytes = {}
+        
+        # Entradas de journal (arquivo, entrada) gravadas pela thread de
+        # escrita, fora do caminho da resposta ao cliente; (None, operação)
+        # agenda checkpoints e snapshots na mesma ordem das escritas. A fila
+        # é um deque (append/popleft atômicos sob o GIL, sem lock); o Event
+        # só acorda a thread de escrita quando ela está ociosa
+        self._write_queue = deque()
+        self._write_ready = Event()
+        Thread(target=self._writer_loop, daemon=True).start()
+        
+        # Tarefas de fundo (replicação, Berkeley, eleição) rodam num pool fixo
+        # em vez de uma thread nova a cada disparo; _sync_futures guarda a
+        # execução em andamento de cada uma para descartar disparos sobrepostos
+        self._sync_pool = ThreadPoolExecutor(max_workers=SYNC_WORKERS,
+                                             thread_name_prefix='sync')
+        self._sync_futures = {}
+        
+        # Contexto ZeroMQ; as opções comuns a todos os sockets ficam como
+        # padrão do contexto e são herdadas pelos sockets criados por ele
         self.context = zmq.Context()
+        self.context.setsockopt(zmq.LINGER, 0)  # close() não espera por peer inalcançável
+        self.context.setsockopt(zmq.SNDHWM, SOCKET_HWM)
+        self.context.setsockopt(zmq.RCVHWM, SOCKET_HWM)
+        self.context.setsockopt(zmq.TCP_KEEPALIVE, 1)  # Detecta conexões TCP mortas
         
         # Socket REQ para broker (requisições dos clientes)
         self.req_socket = self.context.socket(zmq.REP)
@@ -83,101 +177,389 @@ class MessageServer:
         # Socket PUB para proxy (publicações)
         self.pub_socket = self.context.socket(zmq.PUB)
         
-        # Socket REQ para servidor de referência
+        # Socket REQ para servidor de referência, persistente (registro e
+        # heartbeats). Com REQ_RELAXED/REQ_CORRELATE uma resposta perdida não
+        # trava o socket: após o timeout basta enviar a próxima requisição
         self.ref_socket = self.context.socket(zmq.REQ)
+        self.ref_socket.setsockopt(zmq.RCVTIMEO, REFERENCE_TIMEOUT)
+        self.ref_socket.setsockopt(zmq.REQ_RELAXED, 1)
+        self.ref_socket.setsockopt(zmq.REQ_CORRELATE, 1)
         
         # Socket SUB para ouvir eleições e sincronizações
         self.sub_socket = self.context.socket(zmq.SUB)
         
-        # Socket REQ para comunicação entre servidores
-        self.server_socket = self.context.socket(zmq.REQ)
+        # Despacho das requisições: serviço -> handler
+        self._handlers = {
+            'login': self.handle_login,
+            'users': self.handle_list_users,
+            'channel': self.handle_create_channel,
+            'channels': self.handle_list_channels,
+            'publish': self.handle_publish,
+            'message': self.handle_message,
+            'get_history': self.handle_get_history,
+            'get_private_history': self.handle_get_private_history,
+        }
         
         # Carrega estado anterior
         self._load_state()
         
-        print(f"[SERVER:{self.server_name}] Servidor inicializado (clock: {self.clock.get_time()})")
+        self.log.info("Servidor inicializado (clock: %d)", self.clock.get_time())
     
     def _load_state(self):
         """Carrega estado salvo anteriormente"""
         # Carrega logins
         logins_data = self.datastore.load('logins.json', default=[])
-        self.users = set([entry['user'] for entry in logins_data if 'user' in entry])
+        self.users = self._timestamps(logins_data, 'user')
         
         # Carrega canais
         channels_data = self.datastore.load('channels.json', default=[])
-        self.channels = set([entry['channel'] for entry in channels_data if 'channel' in entry])
+        self.channels = self._timestamps(channels_data, 'channel')
         
-        # Carrega mensagens
-        self.messages = self.datastore.load('messages.json', default=[])
+        # Carrega o arquivo e depois as mensagens recentes; as que já foram
+        # arquivadas (snapshot anterior ao arquivamento) ficam de fora
+        for offset, msg in self.datastore.scan_lines(ARCHIVE_FILE):
+            self._index_archived(msg, offset)
+            self._archived_ids.add(ReplicationManager._get_message_id(msg))
         
-        print(f"[SERVER:{self.server_name}] Estado carregado: {len(self.users)} usuários, "
-              f"{len(self.channels)} canais, {len(self.messages)} mensagens")
+        messages = self.datastore.load('messages.json', default=[])
+        self.messages = self._without_archived(messages)
+        self._rebuild_history_index()
+        
+        self.log.info("Estado carregado: %d usuários, %d canais, %d mensagens",
+                      len(self.users), len(self.channels), len(self.messages))
     
     def _reload_users_and_channels(self):
-        """Recarrega usuários e canais do disco (após replicação)"""
+        """
+        Incorpora ao estado em memória o que a replicação gravou em disco
+        
+        A fila de escrita é esvaziada e os arquivos são lidos sem lock; sob o
+        lock de cada tipo só entra o que ainda não está em memória. Como nada
+        é substituído, escritas locais feitas nesse meio-tempo (ainda fora do
+        disco) não se perdem, e os handlers não esperam pela gravação.
+        """
         try:
-            # Recarrega logins
-            logins_data = self.datastore.load('logins.json', default=[])
+            archive_rounds = self._archive_rounds
+            # Arquivos passam a refletir tudo o que já foi enfileirado,
+            # inclusive snapshots que retiraram mensagens arquivadas
+            self._wait_writes()
+            
+            # Recarrega logins e canais (em conflito, vale o registro mais antigo)
+            loaded = self._timestamps(self.datastore.load('logins.json', default=[]), 'user')
             with self.users_lock:
-                self.users = set([entry['user'] for entry in logins_data if 'user' in entry])
+                self.users = self._merge_timestamps(self.users, loaded)
             
-            # Recarrega canais
-            channels_data = self.datastore.load('channels.json', default=[])
+            loaded = self._timestamps(self.datastore.load('channels.json', default=[]), 'channel')
             with self.channels_lock:
-                self.channels = set([entry['channel'] for entry in channels_data if 'channel' in entry])
+                self.channels = self._merge_timestamps(self.channels, loaded)
             
-            # Recarrega mensagens
-            with self.messages_lock:
-                self.messages = self.datastore.load('messages.json', default=[])
+            # Recarrega mensagens: só as que a memória ainda não tem. A cópia de
+            # self.messages é feita após a leitura, então tudo o que a thread de
+            # escrita gravou até lá já está na cópia e não volta duplicado
+            loaded = self.datastore.load('messages.json', default=[])
+            known = set(map(ReplicationManager._get_message_id, list(self.messages)))
+            known |= self._archived_ids
+            fresh = [msg for msg in loaded if ReplicationManager._get_message_id(msg) not in known]
+            if fresh:
+                with self.messages_lock:
+                    # Um arquivamento no meio do caminho tornaria a leitura
+                    # antiga: as mensagens arquivadas voltariam à memória
+                    if self._archive_rounds == archive_rounds:
+                        self.messages = self.messages + fresh
+                        self._rebuild_history_index()
             
-            print(f"[SERVER:{self.server_name}] Estado recarregado: {len(self.users)} usuários, "
-                  f"{len(self.channels)} canais, {len(self.messages)} mensagens")
+            self.log.info("Estado recarregado: %d usuários, %d canais, %d mensagens",
+                          len(self.users), len(self.channels), len(self.messages))
         except Exception as e:
-            print(f"[SERVER:{self.server_name}] Erro ao recarregar estado: {e}")
+            self.log.error("Erro ao recarregar estado: %s", e)
+    
+    @staticmethod
+    def _merge_timestamps(current, loaded):
+        """
+        Junta nomes carregados do disco a um dict nome -> timestamp
+        
+        Returns:
+            O próprio current se nada mudou; senão um dict novo (copy-on-write)
+            em que cada nome fica com o menor timestamp conhecido
+        """
+        changes = {name: ts for name, ts in loaded.items()
+                   if name not in current or ts < current[name]}
+        if not changes:
+            return current
+        merged = dict(current)
+        merged.update(changes)
+        return merged
+    
+    @staticmethod
+    def _timestamps(entries, key):
+        """
+        Mapeia cada nome ao timestamp do seu primeiro registro
+        
+        Args:
+            entries: Registros carregados (snapshot seguido do journal)
+            key: Campo com o nome ('user' ou 'channel')
+        
+        Returns:
+            Dict nome -> timestamp
+        """
+        names = {}
+        for entry in entries:
+            if key in entry:
+                names.setdefault(entry[key], entry.get('timestamp', 0))
+        return names
+    
+    @staticmethod
+    def _index_into(channel_msgs, private_msgs, msg):
+        """Acrescenta uma mensagem aos índices de histórico informados"""
+        if msg.get('type') == 'publish':
+            channel_msgs.setdefault(msg.get('channel'), []).append(msg)
+        elif msg.get('type') == 'message':
+            src, dst = msg.get('src'), msg.get('dst')
+            private_msgs.setdefault(src, []).append(msg)
+            if dst != src:
+                private_msgs.setdefault(dst, []).append(msg)
+    
+    def _index_message(self, msg):
+        """Acrescenta uma mensagem aos índices do histórico (com messages_lock)"""
+        self._index_into(self._channel_msgs, self._private_msgs, msg)
+    
+    def _rebuild_history_index(self):
+        """
+        Reconstrói os índices do histórico a partir de self.messages (com messages_lock)
+        
+        Os novos índices são montados à parte e só então atribuídos, então
+        leitores sem lock nunca veem um índice pela metade.
+        """
+        channel_msgs, private_msgs = {}, {}
+        for msg in sorted(self.messages, key=lambda m: (m.get('timestamp', 0), m.get('clock', 0))):
+            self._index_into(channel_msgs, private_msgs, msg)
+        self._channel_msgs, self._private_msgs = channel_msgs, private_msgs
+    
+    def _track_write(self, data_type, entry):
+        """Numera uma escrita local e a enfileira para a sincronização periódica"""
+        self._unreplicated[data_type].append((next(self._seq), entry))
+    
+    def _topic(self, name):
+        """Retorna o tópico PUB (bytes) de um canal ou usuário, codificado uma única vez"""
+        topic = self._topic_bytes.get(name)
+        if topic is None:
+            topic = self._topic_bytes[name] = name.encode('utf-8')
+        return topic
+    
+    def _writer_loop(self):
+        """
+        Thread que grava no journal as entradas enfileiradas pelos handlers
+        
+        Ao acordar espera WRITE_BATCH_WINDOW por outras entradas e grava o
+        lote com um único append por arquivo, na ordem de chegada.
+        Operações agendadas (checkpoint, snapshot) rodam depois de gravadas
+        as entradas enfileiradas antes delas.
+        """
+        pending = self._write_queue
+        while True:
+            # Limpa o sinal antes de olhar a fila: uma entrada acrescentada
+            # depois disso o religa, então nenhum despertar se perde
+            self._write_ready.clear()
+            if not pending:
+                self._write_ready.wait()
+                time.sleep(WRITE_BATCH_WINDOW)
+            
+            by_file = {}
+            for _ in range(min(len(pending), WRITE_BATCH)):
+                filename, item = pending.popleft()
+                if filename is None:
+                    self._append_journal(by_file)
+                    by_file = {}
+                    try:
+                        item()
+                    except Exception as e:
+                        self.log.error("Erro em operação de escrita: %s", e)
+                else:
+                    by_file.setdefault(filename, []).append(item)
+            self._append_journal(by_file)
+    
+    def _append_journal(self, by_file):
+        """Grava as entradas agrupadas por arquivo, um append por arquivo"""
+        try:
+            for filename, entries in by_file.items():
+                self.datastore.append(filename, *entries)
+        except Exception as e:
+            self.log.error("Erro ao gravar journal: %s", e)
+    
+    def _push_write(self, filename, item):
+        """Acrescenta um item à fila de escrita e acorda a thread se ociosa"""
+        self._write_queue.append((filename, item))
+        if not self._write_ready.is_set():
+            self._write_ready.set()
+    
+    def _enqueue_write(self, filename, item):
+        """
+        Enfileira uma entrada de journal (ou, com filename None, uma operação)
+        
+        Se a gravação ficou WRITE_QUEUE_SIZE itens para trás, espera a fila
+        escoar, limitando a memória ocupada pelas escritas pendentes.
+        """
+        self._push_write(filename, item)
+        if len(self._write_queue) >= WRITE_QUEUE_SIZE:
+            self._wait_writes()
+    
+    def _wait_writes(self):
+        """Espera a thread de escrita processar tudo o que já foi enfileirado"""
+        done = Event()
+        self._push_write(None, done.set)
+        done.wait()
+    
+    def _checkpoint(self):
+        """
+        Agenda um checkpoint: torna duráveis as escritas até este ponto
+        
+        Cada escrita local já vai para o journal pela thread de escrita; o
+        checkpoint só sincroniza os journals com o disco, sem regravar o
+        estado inteiro e sem bloquear o loop principal.
+        """
+        self._enqueue_write(None, self._sync_journals)
+    
+    def _sync_journals(self):
+        """Sincroniza com o disco os journals do estado (na thread de escrita)"""
+        for filename in ('logins.json', 'channels.json', 'messages.json'):
+            self.datastore.sync_journal(filename)
     
     def _save_state(self):
-        """Salva estado atual"""
-        # Salva usuários
-        users_data = [{'user': user, 'timestamp': time.time()} for user in self.users]
-        self.datastore.save('logins.json', users_data)
+        """
+        Agenda a gravação do snapshot completo do estado atual
         
-        # Salva canais
-        channels_data = [{'channel': channel, 'timestamp': time.time()} for channel in self.channels]
-        self.datastore.save('channels.json', channels_data)
+        O estado é copiado agora e gravado pela thread de escrita, depois
+        das entradas de journal já enfileiradas (que o snapshot contém) e
+        antes das seguintes (que ele não contém). Quem precisa do snapshot
+        em disco espera com self._wait_writes().
+        """
+        # Usuários e canais são copy-on-write: basta a referência atual
+        users, channels = self.users, self.channels
+        users_data = [{'user': user, 'timestamp': ts} for user, ts in users.items()]
+        channels_data = [{'channel': channel, 'timestamp': ts} for channel, ts in channels.items()]
         
-        # Salva mensagens
-        self.datastore.save('messages.json', self.messages)
+        # Mensagens: só a janela recente (as antigas vão para o arquivo)
+        with self.messages_lock:
+            self._archive_old_messages()
+            snapshot = {
+                'logins.json': users_data,
+                'channels.json': channels_data,
+                'messages.json': list(self.messages),
+            }
+            self._enqueue_write(None, partial(self._write_snapshot, snapshot))
+    
+    def _write_snapshot(self, snapshot):
+        """Grava os snapshots copiados por _save_state (na thread de escrita)"""
+        for filename, data in snapshot.items():
+            self.datastore.save(filename, data)
+    
+    def _archive_old_messages(self):
+        """
+        Move para ARCHIVE_FILE as mensagens além de MAX_MESSAGES_IN_MEMORY (com messages_lock)
+        
+        As mais antigas são acrescentadas ao journal do arquivo e deixam a
+        memória, mantendo limitados o consumo de memória, o tamanho de
+        messages.json e o custo de cada _save_state.
+        """
+        overflow = len(self.messages) - MAX_MESSAGES_IN_MEMORY
+        if overflow <= 0:
+            return
+        
+        ordered = sorted(self.messages, key=lambda m: (m.get('timestamp', 0), m.get('clock', 0)))
+        archived, self.messages = ordered[:overflow], ordered[overflow:]
+        self._archive_rounds += 1
+        # Registrados já aqui (não na thread de escrita): a partir deste ponto
+        # uma réplica das mensagens arquivadas deve ser descartada
+        self._archived_ids.update(map(ReplicationManager._get_message_id, archived))
+        
+        self._enqueue_write(None, partial(self._append_archive, archived))
+        self._rebuild_history_index()
+        
+        self.log.info("%d mensagens antigas arquivadas", overflow)
+    
+    def _without_archived(self, messages):
+        """Retorna as mensagens que não estão em ARCHIVE_FILE"""
+        if not self._archived_ids:
+            return messages
+        return [msg for msg in messages
+                if ReplicationManager._get_message_id(msg) not in self._archived_ids]
+    
+    def _append_archive(self, messages):
+        """Grava mensagens em ARCHIVE_FILE e indexa suas posições (na thread de escrita)"""
+        offsets = self.datastore.append_lines(ARCHIVE_FILE, messages)
+        if offsets is None:
+            self.log.error("Falha ao arquivar %d mensagens", len(messages))
+            return
+        for msg, offset in zip(messages, offsets):
+            self._index_archived(msg, offset)
+    
+    def _index_archived(self, msg, offset):
+        """Registra a posição de uma mensagem arquivada no índice do canal ou dos usuários"""
+        if msg.get('type') == 'publish':
+            self._archive_by_channel.setdefault(msg.get('channel'), array('Q')).append(offset)
+        elif msg.get('type') == 'message':
+            src, dst = msg.get('src'), msg.get('dst')
+            self._archive_by_user.setdefault(src, array('Q')).append(offset)
+            if dst != src:
+                self._archive_by_user.setdefault(dst, array('Q')).append(offset)
+    
+    def _archived_history(self, offsets, limit):
+        """
+        Retorna as últimas mensagens arquivadas de um canal ou usuário
+        
+        Só as linhas das limit posições mais recentes do índice são lidas e
+        decodificadas: o custo é O(limit), qualquer que seja o tamanho do
+        arquivo.
+        
+        Args:
+            offsets: Posições do canal ou usuário (_archive_by_channel/_archive_by_user)
+            limit: Número máximo de mensagens retornadas
+        
+        Returns:
+            Lista com até limit mensagens, em ordem de arquivamento
+        """
+        if limit <= 0 or not offsets:
+            return []
+        return self.datastore.read_lines_at(ARCHIVE_FILE, offsets[-limit:])
     
     def register_with_reference(self):
         """Registra o servidor no servidor de referência e obtém rank"""
         try:
             self.ref_socket.connect(REFERENCE_SERVER)
             
-            # Solicita rank
-            message = create_message('rank', {'user': self.server_name}, self.clock)
-            self.ref_socket.send(message)
+            # Solicita rank (o mesmo serviço é usado depois como heartbeat),
+            # reenviando enquanto o servidor de referência não responder
+            for _ in range(REGISTER_ATTEMPTS):
+                self.ref_socket.send(self._register_message())
+                try:
+                    raw_response = self.ref_socket.recv()
+                    break
+                except zmq.Again:
+                    self.log.warning("Servidor de referência não respondeu, tentando novamente")
+            else:
+                return False
             
-            # Recebe resposta
-            raw_response = self.ref_socket.recv()
             response = parse_message(raw_response)
             
             if response:
                 data = response.get('data', {})
-                update_logical_clock(self.clock, data.get('clock', 0))
+                self.clock.update(data.get('clock', 0))
                 
                 if data.get('status') == 'sucesso':
                     self.rank = data.get('rank')
-                    print(f"[SERVER:{self.server_name}] Rank atribuído: {self.rank}")
+                    self.log.info("Rank atribuído: %s", self.rank)
                     
                     # Inicializa sincronização Berkeley e replicação
                     self._initialize_coordination_modules()
                     
+                    # A resposta já traz a lista de servidores
+                    self._apply_roster(data)
+                    
                     return True
             
             return False
             
         except Exception as e:
-            print(f"[SERVER:{self.server_name}] Erro ao registrar com referência: {e}")
+            self.log.error("Erro ao registrar com referência: %s", e)
             return False
     
     def _initialize_coordination_modules(self):
@@ -186,7 +568,7 @@ class MessageServer:
         self.election_manager = ElectionManager(
             self.server_name, 
             self.rank, 
-            self.pub_socket,
+            PROXY_BACKEND,
             self.datastore
         )
         self.election_manager.start_election_server()
@@ -199,16 +581,13 @@ class MessageServer:
             self.coordinator = self.server_name
             self.election_manager.is_coordinator = True
             self.election_manager.coordinator = self.server_name
-            print(f"[SERVER:{self.server_name}] Inicializado como COORDENADOR (rank {self.rank})")
+            self.log.info("Inicializado como COORDENADOR (rank %s)", self.rank)
         
         # Inicializa gerenciador de replicação
-        self.replication_manager = ReplicationManager(self.server_name, self.rank, self.datastore)
+        self.replication_manager = ReplicationManager(self.server_name, self.rank, self.datastore,
+                                                      self._archived_ids)
         self.replication_manager.start_replication_server()
         
-        # Thread para atualizar lista de servidores periodicamente
-        update_thread = Thread(target=self._update_server_list_periodically, daemon=True)
-        update_thread.start()
-        
         # Thread para monitorar coordenador
         monitor_thread = Thread(target=self._monitor_coordinator, daemon=True)
         monitor_thread.start()
@@ -218,13 +597,17 @@ class MessageServer:
         reload_thread.start()
     
     def send_heartbeat(self):
-        """Thread que envia heartbeat periodicamente ao servidor de referência"""
+        """
+        Thread que envia heartbeat periodicamente ao servidor de referência
+        
+        O heartbeat informa a versão da lista de servidores já conhecida; a
+        lista só vem na resposta quando mudou (ver _apply_roster).
+        """
         while True:
             time.sleep(HEARTBEAT_INTERVAL)
             
             try:
-                message = create_message('heartbeat', {'user': self.server_name}, self.clock)
-                self.ref_socket.send(message)
+                self.ref_socket.send(self._register_message())
                 
                 # Recebe resposta
                 raw_response = self.ref_socket.recv()
@@ -232,47 +615,43 @@ class MessageServer:
                 
                 if response:
                     data = response.get('data', {})
-                    update_logical_clock(self.clock, data.get('clock', 0))
+                    self.clock.update(data.get('clock', 0))
+                    self._apply_roster(data)
                     
             except Exception as e:
-                print(f"[SERVER:{self.server_name}] Erro ao enviar heartbeat: {e}")
+                self.log.error("Erro ao enviar heartbeat: %s", e)
     
-    def _update_server_list_periodically(self):
-        """Thread que atualiza lista de servidores do ReferenceServer"""
-        while True:
-            time.sleep(20)  # Atualiza a cada 20 segundos
-            
-            try:
-                # Solicita lista de servidores
-                message = create_message('list', {}, self.clock)
-                
-                # Cria socket temporário para não bloquear ref_socket
-                temp_socket = self.context.socket(zmq.REQ)
-                temp_socket.setsockopt(zmq.RCVTIMEO, 5000)
-                temp_socket.connect(REFERENCE_SERVER)
-                
-                temp_socket.send(message)
-                raw_response = temp_socket.recv()
-                response = parse_message(raw_response)
-                
-                if response and response.get('data', {}).get('status') == 'sucesso':
-                    server_list = response['data'].get('list', [])
-                    
-                    # Atualiza replication manager
-                    if self.replication_manager:
-                        self.replication_manager.update_server_list(server_list)
-                    
-                    # Atualiza election manager
-                    if self.election_manager:
-                        self.election_manager.update_server_list(server_list)
-                    
-                    # Atualiza coordenador se necessário
-                    self._update_coordinator_from_list(server_list)
-                
-                temp_socket.close()
-                
-            except Exception as e:
-                print(f"[SERVER:{self.server_name}] Erro ao atualizar lista de servidores: {e}")
+    def _register_message(self):
+        """Monta a requisição 'register' (registro e heartbeat) com a versão da lista conhecida"""
+        return create_message('register', {
+            'user': self.server_name,
+            'known_version': self._roster_version
+        }, self.clock)
+    
+    def _apply_roster(self, data):
+        """
+        Aplica a lista de servidores recebida na resposta do 'register'
+        
+        Args:
+            data: Dados da resposta; sem 'list' a lista conhecida segue válida
+        """
+        if 'list' not in data:
+            return
+        
+        server_list = data['list']
+        
+        # Atualiza replication manager
+        if self.replication_manager:
+            self.replication_manager.update_server_list(server_list)
+        
+        # Atualiza election manager
+        if self.election_manager:
+            self.election_manager.update_server_list(server_list)
+        
+        # Atualiza coordenador se necessário
+        self._update_coordinator_from_list(server_list)
+        
+        self._roster_version = data.get('roster_version')
     
     def _update_coordinator_from_list(self, server_list: list):
         """Atualiza coordenador baseado na lista (menor rank)"""
@@ -287,7 +666,7 @@ class MessageServer:
             if self.coordinator != new_coordinator:
                 old_coordinator = self.coordinator
                 self.coordinator = new_coordinator
-                print(f"[SERVER:{self.server_name}] Coordenador mudou: {old_coordinator} -> {new_coordinator}")
+                self.log.info("Coordenador mudou: %s -> %s", old_coordinator, new_coordinator)
                 
                 # Atualiza Berkeley
                 if self.berkeley_sync:
@@ -314,9 +693,9 @@ class MessageServer:
                 )
                 
                 if not is_healthy:
-                    print(f"[SERVER:{self.server_name}] Coordenador {current_coordinator} não responde. Iniciando eleição.")
+                    self.log.warning("Coordenador %s não responde. Iniciando eleição.", current_coordinator)
                     # Inicia eleição Bully
-                    Thread(target=self.election_manager.start_election, daemon=True).start()
+                    self._submit_sync(self.election_manager.start_election)
                     # Aguarda resultado da eleição
                     time.sleep(10)
     
@@ -326,44 +705,85 @@ class MessageServer:
             time.sleep(5)  # Recarrega a cada 5 segundos
             self._reload_users_and_channels()
     
-    def _check_sync(self):
-        """Verifica se é hora de sincronizar (Berkeley e replicação)"""
-        if self.message_count % SYNC_INTERVAL == 0:
-            print(f"[SERVER:{self.server_name}] Sincronização necessária após {self.message_count} mensagens")
-            
-            # Salva estado local
+    def _after_request(self):
+        """
+        Contabiliza uma requisição atendida e sincroniza a cada SYNC_INTERVAL
+        
+        Único ponto que incrementa message_count: chamado uma vez por
+        requisição de serviço conhecido, depois da resposta enviada.
+        """
+        self.message_count += 1
+        self._msgs_since_sync += 1
+        if self._msgs_since_sync >= SYNC_INTERVAL:
+            self._msgs_since_sync = 0
+            self._trigger_sync()
+    
+    def _trigger_sync(self):
+        """Persiste o estado e dispara replicação e sincronização Berkeley"""
+        self.log.info("Sincronização necessária após %d mensagens", self.message_count)
+        
+        # Toda sincronização faz a etapa barata: checkpoint do journal e
+        # envio das escritas ainda não confirmadas (a replicação individual
+        # de cada escrita já corre continuamente). A cada SNAPSHOT_EVERY
+        # sincronizações vem a etapa cara: snapshot completo (que compacta o
+        # journal) e rodada de Berkeley
+        self._syncs += 1
+        full_checkpoint = self._syncs % SNAPSHOT_EVERY == 0
+        if full_checkpoint:
             self._save_state()
-            
-            # Replica para outros servidores
-            if self.replication_manager:
-                Thread(target=self._replicate_current_state, daemon=True).start()
-            
-            # Sincronização Berkeley (apenas coordenador)
-            if self.message_count % CLOCK_SYNC_INTERVAL == 0:
-                if self.berkeley_sync and self.berkeley_sync.is_coordinator:
-                    Thread(target=self._run_berkeley_sync, daemon=True).start()
+        else:
+            self._checkpoint()
+        
+        # Replica para outros servidores
+        if self.replication_manager:
+            self._submit_sync(self._replicate_current_state)
+        
+        # Sincronização Berkeley (apenas coordenador)
+        if full_checkpoint and self.berkeley_sync and self.berkeley_sync.is_coordinator:
+            self._submit_sync(self._run_berkeley_sync)
+    
+    def _submit_sync(self, task):
+        """
+        Agenda uma tarefa de fundo no pool, se ela já não estiver em andamento
+        
+        Args:
+            task: Função sem argumentos (ex: self._replicate_current_state)
+        """
+        running = self._sync_futures.get(task.__name__)
+        if running and not running.done():
+            self.log.debug("%s ainda em andamento, disparo ignorado", task.__name__)
+            return
+        self._sync_futures[task.__name__] = self._sync_pool.submit(task)
     
     def _replicate_current_state(self):
-        """Replica estado atual para outros servidores"""
+        """
+        Replica para outros servidores as escritas locais ainda não confirmadas
+        
+        Escritas confirmadas por todos os servidores acompanhados (inclusive
+        os que saíram da lista e ainda podem voltar) saem da fila, então cada
+        sincronização custa O(novas escritas) e não O(estado). Servidores
+        vistos pela primeira vez recebem antes o estado completo.
+        """
         try:
-            with self.users_lock:
-                users_data = [{'user': user, 'timestamp': time.time()} for user in self.users]
-            
-            with self.channels_lock:
-                channels_data = [{'channel': channel, 'timestamp': time.time()} for channel in self.channels]
+            self.replication_manager.push_state_to_new_servers()
             
-            with self.messages_lock:
-                messages_data = list(self.messages)
-            
-            # Replica cada tipo de dado
-            self.replication_manager.replicate_to_all('logins', users_data)
-            self.replication_manager.replicate_to_all('channels', channels_data)
-            self.replication_manager.replicate_to_all('messages', messages_data)
+            for data_type, pending in self._unreplicated.items():
+                records = list(pending)
+                if not records:
+                    continue
+                
+                # Só o que cada servidor ainda não confirmou é enviado
+                acked = self.replication_manager.replicate_delta(data_type, records)
+                
+                # Remove só do início: o que chegou após a cópia fica na fila
+                # (_submit_sync garante uma única sincronização por vez)
+                while pending and pending[0][0] <= acked:
+                    pending.popleft()
             
-            print(f"[SERVER:{self.server_name}] Estado replicado para outros servidores")
+            self.log.info("Estado replicado para outros servidores")
             
         except Exception as e:
-            print(f"[SERVER:{self.server_name}] Erro ao replicar estado: {e}")
+            self.log.error("Erro ao replicar estado: %s", e)
     
     def _run_berkeley_sync(self):
         """Executa sincronização Berkeley"""
@@ -383,19 +803,15 @@ class MessageServer:
                 'address': f"tcp://{self.server_name}:6000"
             })
             
-            # Executa sincronização
-            success = self.berkeley_sync.run_synchronization(server_list)
-            
-            if success:
-                # Salva histórico de sincronização
-                sync_history = self.berkeley_sync.get_sync_history()
-                self.datastore.save_replication('berkeley_sync', {
-                    'server': self.server_name,
-                    'history': sync_history
-                })
+            # Executa sincronização; servidores com relógio medido nas
+            # confirmações de replicação recentes dispensam a etapa get_time.
+            # Cada registro da rodada já é acrescentado ao histórico em
+            # replication/berkeley_sync_<servidor>.jsonl pelo próprio sincronizador
+            self.berkeley_sync.run_synchronization(
+                server_list, self.replication_manager.clock_offsets(CLOCK_SAMPLE_MAX_AGE))
             
         except Exception as e:
-            print(f"[SERVER:{self.server_name}] Erro ao executar sincronização Berkeley: {e}")
+            self.log.error("Erro ao executar sincronização Berkeley: %s", e)
     
     def handle_login(self, data):
         """Gerencia login de usuário"""
@@ -410,28 +826,27 @@ class MessageServer:
                 return create_response('login', 'erro', {}, self.clock,
                                      'Usuário já cadastrado')
             
-            self.users.add(user)
-            
             # Persiste login
             login_entry = {
                 'user': user,
                 'timestamp': time.time(),
                 'clock': self.clock.get_time()
             }
-            self.datastore.append('logins.json', login_entry)
+            users = dict(self.users)
+            users[user] = login_entry['timestamp']
+            self.users = users
+            self._track_write('logins', login_entry)
+            self._enqueue_write('logins.json', login_entry)
             
             if self.replication_manager:
-                Thread(target=lambda: self.replication_manager.replicate_to_all(
-                    'logins', [login_entry]
-                ), daemon=True).start()
+                self.replication_manager.replicate_async('logins', [login_entry])
         
-        print(f"[SERVER:{self.server_name}] Novo login: {user}")
+        self.log.debug("Novo login: %s", user)
         return create_response('login', 'sucesso', {}, self.clock)
     
     def handle_list_users(self, data):
         """Retorna lista de usuários cadastrados"""
-        with self.users_lock:
-            users_list = list(self.users)
+        users_list = list(self.users)
         
         return create_response('users', 'sucesso', {'users': users_list}, self.clock)
     
@@ -448,28 +863,27 @@ class MessageServer:
                 return create_response('channel', 'erro', {}, self.clock,
                                      'Canal já existe')
             
-            self.channels.add(channel)
-            
             # Persiste canal
             channel_entry = {
                 'channel': channel,
                 'timestamp': time.time(),
                 'clock': self.clock.get_time()
             }
-            self.datastore.append('channels.json', channel_entry)
+            channels = dict(self.channels)
+            channels[channel] = channel_entry['timestamp']
+            self.channels = channels
+            self._track_write('channels', channel_entry)
+            self._enqueue_write('channels.json', channel_entry)
             
             if self.replication_manager:
-                Thread(target=lambda: self.replication_manager.replicate_to_all(
-                    'channels', [channel_entry]
-                ), daemon=True).start()
+                self.replication_manager.replicate_async('channels', [channel_entry])
         
-        print(f"[SERVER:{self.server_name}] Novo canal: {channel}")
+        self.log.debug("Novo canal: %s", channel)
         return create_response('channel', 'sucesso', {}, self.clock)
     
     def handle_list_channels(self, data):
         """Retorna lista de canais disponíveis"""
-        with self.channels_lock:
-            channels_list = list(self.channels)
+        channels_list = list(self.channels)
         
         return create_response('channels', 'sucesso', {'channels': channels_list}, self.clock)
     
@@ -483,10 +897,9 @@ class MessageServer:
             return create_response('publish', 'erro', {}, self.clock,
                                  'Nome do canal não fornecido')
         
-        with self.channels_lock:
-            if channel not in self.channels:
-                return create_response('publish', 'erro', {}, self.clock,
-                                     'Canal não existe')
+        if channel not in self.channels:
+            return create_response('publish', 'erro', {}, self.clock,
+                                 'Canal não existe')
         
         # Cria mensagem de publicação
         pub_data = {
@@ -496,7 +909,8 @@ class MessageServer:
         pub_message = create_message('publish', pub_data, self.clock)
         
         # Publica no tópico do canal
-        self.pub_socket.send_multipart([channel.encode('utf-8'), pub_message])
+        # (copy=False: frames grandes vão sem cópia; os pequenos o pyzmq copia)
+        self.pub_socket.send_multipart([self._topic(channel), pub_message], copy=False)
         
         # Persiste mensagem
         with self.messages_lock:
@@ -508,18 +922,17 @@ class MessageServer:
                 'timestamp': time.time(),
                 'clock': self.clock.get_time()
             }
+            self._track_write('messages', message_entry)
             self.messages.append(message_entry)
-            self.datastore.save('messages.json', self.messages)
+            self._index_message(message_entry)
+            # Só a nova mensagem vai para o journal (pela thread de escrita);
+            # o snapshot completo é regravado em _save_state
+            self._enqueue_write('messages.json', message_entry)
         
         if self.replication_manager:
-            Thread(target=lambda: self.replication_manager.replicate_to_all(
-                'messages', [message_entry]
-            ), daemon=True).start()
+            self.replication_manager.replicate_async('messages', [message_entry])
         
-        self.message_count += 1
-        self._check_sync()
-        
-        print(f"[SERVER:{self.server_name}] Publicação em #{channel} por {user}")
+        self.log.debug("Publicação em #%s por %s", channel, user)
         return create_response('publish', 'OK', {}, self.clock)
     
     def handle_message(self, data):
@@ -532,10 +945,9 @@ class MessageServer:
             return create_response('message', 'erro', {}, self.clock,
                                  'Destinatário não fornecido')
         
-        with self.users_lock:
-            if dst not in self.users:
-                return create_response('message', 'erro', {}, self.clock,
-                                     'Usuário destinatário não existe')
+        if dst not in self.users:
+            return create_response('message', 'erro', {}, self.clock,
+                                 'Usuário destinatário não existe')
         
         # Cria mensagem privada
         msg_data = {
@@ -545,7 +957,8 @@ class MessageServer:
         msg_message = create_message('message', msg_data, self.clock)
         
         # Publica no tópico do usuário destinatário
-        self.pub_socket.send_multipart([dst.encode('utf-8'), msg_message])
+        # (copy=False: frames grandes vão sem cópia; os pequenos o pyzmq copia)
+        self.pub_socket.send_multipart([self._topic(dst), msg_message], copy=False)
         
         # Persiste mensagem
         with self.messages_lock:
@@ -557,19 +970,18 @@ class MessageServer:
                 'timestamp': time.time(),
                 'clock': self.clock.get_time()
             }
+            self._track_write('messages', message_entry)
             self.messages.append(message_entry)
-            self.datastore.save('messages.json', self.messages)
+            self._index_message(message_entry)
+            # Só a nova mensagem vai para o journal (pela thread de escrita);
+            # o snapshot completo é regravado em _save_state
+            self._enqueue_write('messages.json', message_entry)
         
         # Replica imediatamente mensagens para garantir consistência
         if self.replication_manager:
-            Thread(target=lambda: self.replication_manager.replicate_to_all(
-                'messages', [message_entry]
-            ), daemon=True).start()
-        
-        self.message_count += 1
-        self._check_sync()
+            self.replication_manager.replicate_async('messages', [message_entry])
         
-        print(f"[SERVER:{self.server_name}] Mensagem de {src} para {dst}")
+        self.log.debug("Mensagem de %s para %s", src, dst)
         return create_response('message', 'OK', {}, self.clock)
     
     def handle_get_history(self, data):
@@ -589,27 +1001,23 @@ class MessageServer:
             return create_response('get_history', 'erro', {}, self.clock,
                                  'Nome do canal não fornecido')
         
-        with self.channels_lock:
-            if channel not in self.channels:
-                return create_response('get_history', 'erro', {}, self.clock,
-                                     'Canal não existe')
+        if channel not in self.channels:
+            return create_response('get_history', 'erro', {}, self.clock,
+                                 'Canal não existe')
         
-        # Filtra mensagens do canal
-        with self.messages_lock:
-            channel_messages = [
-                msg for msg in self.messages
-                if msg.get('type') == 'publish' and msg.get('channel') == channel
-            ]
-            
-            # Ordena por timestamp (e relógio lógico como desempate) para garantir
-            # que o histórico retornado esteja em ordem cronológica.
-            channel_messages.sort(key=lambda m: (m.get('timestamp', 0), m.get('clock', 0)))
-
-            # Limita quantidade (últimas N mensagens)
-            if len(channel_messages) > limit:
-                channel_messages = channel_messages[-limit:]
+        # Últimas N publicações do canal, direto do índice (sem varrer todas
+        # as mensagens); a ordenação por timestamp e relógio lógico garante a
+        # ordem cronológica mesmo com entregas fora de ordem
+        channel_messages = self._channel_msgs.get(channel, [])[-limit:]
         
-        print(f"[SERVER:{self.server_name}] Histórico solicitado para #{channel}: {len(channel_messages)} mensagens")
+        # Completa com mensagens arquivadas se a janela em memória não bastar
+        archived = self._archive_by_channel.get(channel)
+        if len(channel_messages) < limit and archived:
+            older = self._archived_history(archived, limit - len(channel_messages))
+            channel_messages = older + channel_messages
+        channel_messages.sort(key=lambda m: (m.get('timestamp', 0), m.get('clock', 0)))
+        
+        self.log.debug("Histórico solicitado para #%s: %d mensagens", channel, len(channel_messages))
         return create_response('get_history', 'sucesso', 
                              {'channel': channel, 'messages': channel_messages}, 
                              self.clock)
@@ -631,178 +1039,234 @@ class MessageServer:
             return create_response('get_private_history', 'erro', {}, self.clock,
                                  'Nome do usuário não fornecido')
         
-        # Filtra mensagens privadas (enviadas ou recebidas)
-        with self.messages_lock:
-            private_messages = [
-                msg for msg in self.messages
-                if msg.get('type') == 'message' and 
-                   (msg.get('src') == user or msg.get('dst') == user)
-            ]
-            
-            # Limita quantidade
-            if len(private_messages) > limit:
-                private_messages = private_messages[-limit:]
+        # Últimas N mensagens privadas (enviadas ou recebidas), direto do índice
+        private_messages = self._private_msgs.get(user, [])[-limit:]
+        
+        # Completa com mensagens arquivadas se a janela em memória não bastar
+        archived = self._archive_by_user.get(user)
+        if len(private_messages) < limit and archived:
+            older = self._archived_history(archived, limit - len(private_messages))
+            private_messages = older + private_messages
         
-        print(f"[SERVER:{self.server_name}] Histórico privado solicitado para @{user}: {len(private_messages)} mensagens")
+        self.log.debug("Histórico privado solicitado para @%s: %d mensagens",
+                       user, len(private_messages))
         return create_response('get_private_history', 'sucesso',
                              {'user': user, 'messages': private_messages},
                              self.clock)
     
-    def _check_sync(self):
-        """Verifica se é hora de sincronizar"""
-        if self.message_count % SYNC_INTERVAL == 0:
-            print(f"[SERVER:{self.server_name}] Sincronização necessária após {self.message_count} mensagens")
-            # Aqui seria implementada a lógica de sincronização entre servidores
-            # Por simplicidade, apenas salvamos o estado
-            self._save_state()
-    
-    def _process_servers_topic(self):
-        """Thread que processa mensagens do tópico 'servers' (anúncios de eleição)"""
-        import msgpack
+    def _handle_servers_message(self):
+        """
+        Processa uma mensagem do tópico 'servers' (anúncios de eleição)
         
-        while True:
-            try:
-                # Recebe mensagem do tópico 'servers'
-                topic, raw_message = self.sub_socket.recv_multipart()
-                message = msgpack.unpackb(raw_message, raw=False)
+        Returns:
+            False se não havia mensagem pendente, True caso contrário
+        """
+        try:
+            # Recebe mensagem do tópico 'servers'
+            topic, raw_message = self.sub_socket.recv_multipart(zmq.NOBLOCK)
+        except zmq.Again:
+            return False
+        
+        try:
+            # use_list=False: anúncios são só lidos, tuplas custam menos que listas
+            message = _unpack(raw_message, raw=False, use_list=False)
+            
+            service = message.get('service', '')
+            data = message.get('data', {})
+            
+            # Processa anúncio de novo coordenador
+            if service == 'election' and data.get('event') == 'new_coordinator':
+                new_coordinator = data.get('coordinator', '')
+                coordinator_rank = data.get('rank', 0)
                 
-                service = message.get('service', '')
-                data = message.get('data', {})
+                self.log.info("Anúncio recebido: %s é o novo coordenador (rank %s)",
+                              new_coordinator, coordinator_rank)
                 
-                # Processa anúncio de novo coordenador
-                if service == 'election' and data.get('event') == 'new_coordinator':
-                    new_coordinator = data.get('coordinator', '')
-                    coordinator_rank = data.get('rank', 0)
+                with self.coordinator_lock:
+                    old_coordinator = self.coordinator
+                    self.coordinator = new_coordinator
                     
-                    print(f"[SERVER:{self.server_name}] Anúncio recebido: {new_coordinator} é o novo coordenador (rank {coordinator_rank})")
-                    
-                    with self.coordinator_lock:
-                        old_coordinator = self.coordinator
-                        self.coordinator = new_coordinator
-                        
-                        # Atualiza estado de coordenação
-                        if self.election_manager:
-                            self.election_manager.coordinator = new_coordinator
-                            self.election_manager.is_coordinator = (new_coordinator == self.server_name)
-                        
-                        if self.berkeley_sync:
-                            self.berkeley_sync.is_coordinator = (new_coordinator == self.server_name)
-                    
-                    # Atualiza timestamp de heartbeat
-                    self.last_coordinator_heartbeat = time.time()
+                    # Atualiza estado de coordenação (encerra eleição em andamento)
+                    if self.election_manager:
+                        self.election_manager.accept_coordinator(new_coordinator, coordinator_rank, data.get('epoch', 0))
                     
-                    print(f"[SERVER:{self.server_name}] Coordenador atualizado: {old_coordinator} -> {new_coordinator}")
+                    if self.berkeley_sync:
+                        self.berkeley_sync.is_coordinator = (new_coordinator == self.server_name)
                 
-            except Exception as e:
-                print(f"[SERVER:{self.server_name}] Erro ao processar tópico 'servers': {e}")
-                time.sleep(1)
+                # Atualiza timestamp de heartbeat
+                self.last_coordinator_heartbeat = time.time()
+                
+                self.log.info("Coordenador atualizado: %s -> %s", old_coordinator, new_coordinator)
+            
+        except Exception as e:
+            self.log.error("Erro ao processar tópico 'servers': %s", e)
+        return True
+    
+    def _handle_client_request(self):
+        """
+        Recebe uma requisição do broker, processa e envia a resposta
+        
+        Returns:
+            False se não havia requisição pendente, True caso contrário
+        """
+        try:
+            raw_message = self.req_socket.recv(zmq.NOBLOCK)
+        except zmq.Again:
+            return False
+        message = parse_message(raw_message)
+        
+        if not message:
+            # Envia erro se mensagem inválida
+            error = create_response('error', 'erro', {}, self.clock,
+                                  'Mensagem inválida')
+            self.req_socket.send(error)
+            return True
+        
+        service = message.get('service', '')
+        data = message.get('data', {})
+        
+        # Atualiza relógio lógico
+        received_clock = data.get('clock', 0)
+        self.clock.update(received_clock)
+        
+        # Processa requisição baseado no serviço
+        handler = self._handlers.get(service)
+        if handler:
+            response = handler(data)
+        else:
+            response = create_response(service, 'erro', {}, self.clock,
+                                     f'Serviço desconhecido: {service}')
+        
+        # Envia resposta
+        self.req_socket.send(response)
+        
+        # Sincroniza (Berkeley + Replicação) a cada SYNC_INTERVAL requisições
+        if handler:
+            self._after_request()
+        return True
+    
+    def _install_shutdown_signals(self):
+        """
+        Trata SIGINT e SIGTERM (docker stop) encerrando o loop principal
+        
+        O tratador só desliga self._running; com signal.set_wakeup_fd o sinal
+        também escreve num pipe registrado no poller, que acorda na hora em
+        vez de esperar o POLL_TIMEOUT. Sinais só podem ser tratados na thread
+        principal; fora dela nada é instalado.
+        
+        Returns:
+            Descritor de leitura do pipe de despertar, ou None
+        """
+        self._running = True
+        if current_thread() is not main_thread():
+            return None
+        
+        read_fd, write_fd = os.pipe()
+        os.set_blocking(read_fd, False)
+        os.set_blocking(write_fd, False)
+        signal.set_wakeup_fd(write_fd)
+        
+        def request_shutdown(signum, frame):
+            self._running = False
+        
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, request_shutdown)
+        return read_fd
     
     def run(self):
         """Executa o loop principal do servidor"""
-        print(f"[SERVER:{self.server_name}] Iniciando servidor de mensagens...")
+        self.log.info("Iniciando servidor de mensagens...")
         
         # Registra com servidor de referência
         if not self.register_with_reference():
-            print(f"[SERVER:{self.server_name}] ERRO: Falha ao registrar com servidor de referência")
+            self.log.error("Falha ao registrar com servidor de referência")
             return
         
         # Conecta aos sockets
         self.req_socket.connect(BROKER_BACKEND)
-        print(f"[SERVER:{self.server_name}] Conectado ao broker em {BROKER_BACKEND}")
+        self.log.info("Conectado ao broker em %s", BROKER_BACKEND)
         
         self.pub_socket.connect(PROXY_BACKEND)
-        print(f"[SERVER:{self.server_name}] Conectado ao proxy em {PROXY_BACKEND}")
+        self.log.info("Conectado ao proxy em %s", PROXY_BACKEND)
         
-        # Se inscreve no tópico 'servers' para receber anúncios de eleição
+        # Se inscreve no tópico 'servers' para receber anúncios de eleição; a
+        # filtragem é feita pelo ZeroMQ, nada de outros tópicos chega aqui
         self.sub_socket.connect("tcp://proxy:5558")
-        self.sub_socket.setsockopt_string(zmq.SUBSCRIBE, 'servers')
-        print(f"[SERVER:{self.server_name}] Inscrito no tópico 'servers'")
-        
-        # Inicia thread para processar mensagens do tópico 'servers'
-        servers_thread = Thread(target=self._process_servers_topic, daemon=True)
-        servers_thread.start()
+        self.sub_socket.setsockopt(zmq.SUBSCRIBE, SERVERS_TOPIC)
+        self.log.info("Inscrito no tópico 'servers'")
         
         # Inicia thread de heartbeat
         heartbeat_thread = Thread(target=self.send_heartbeat, daemon=True)
         heartbeat_thread.start()
         
-        print(f"[SERVER:{self.server_name}] Servidor pronto para receber requisições")
+        self.log.info("Servidor pronto para receber requisições")
+        
+        # Um único loop atende requisições do broker e anúncios do tópico
+        # 'servers', conforme a prontidão de cada socket; cada socket pronto
+        # é esvaziado (até REQUEST_BATCH mensagens) antes de voltar ao poll
+        poller = zmq.Poller()
+        poller.register(self.req_socket, zmq.POLLIN)
+        poller.register(self.sub_socket, zmq.POLLIN)
+        
+        wakeup_fd = self._install_shutdown_signals()
+        if wakeup_fd is not None:
+            poller.register(wakeup_fd, zmq.POLLIN)
+        
+        # Métodos e sockets usados a cada iteração, resolvidos uma única vez
+        poll = poller.poll
+        req_socket = self.req_socket
+        handle_request = self._handle_client_request
+        handle_servers = self._handle_servers_message
         
         try:
-            while True:
-                # Recebe requisição do broker
-                raw_message = self.req_socket.recv()
-                message = parse_message(raw_message)
-                
-                if not message:
-                    # Envia erro se mensagem inválida
-                    error = create_response('error', 'erro', {}, self.clock,
-                                          'Mensagem inválida')
-                    self.req_socket.send(error)
-                    continue
-                
-                service = message.get('service', '')
-                data = message.get('data', {})
-                
-                # Atualiza relógio lógico
-                received_clock = data.get('clock', 0)
-                update_logical_clock(self.clock, received_clock)
-                
-                # Processa requisição baseado no serviço
-                if service == 'login':
-                    response = self.handle_login(data)
-                    self.message_count += 1
-                elif service == 'users':
-                    response = self.handle_list_users(data)
-                    self.message_count += 1
-                elif service == 'channel':
-                    response = self.handle_create_channel(data)
-                    self.message_count += 1
-                elif service == 'channels':
-                    response = self.handle_list_channels(data)
-                    self.message_count += 1
-                elif service == 'publish':
-                    response = self.handle_publish(data)
-                    # publish já incrementa message_count e chama _check_sync()
-                elif service == 'message':
-                    response = self.handle_message(data)
-                    # message já incrementa message_count e chama _check_sync()
-                elif service == 'get_history':
-                    response = self.handle_get_history(data)
-                    self.message_count += 1
-                elif service == 'get_private_history':
-                    response = self.handle_get_private_history(data)
-                    self.message_count += 1
-                else:
-                    response = create_response(service, 'erro', {}, self.clock,
-                                             f'Serviço desconhecido: {service}')
-                
-                # Envia resposta
-                self.req_socket.send(response)
-                
-                # CORREÇÃO: Verifica sincronização após cada requisição processada
-                # Sincroniza (Berkeley + Replicação) a cada SYNC_INTERVAL mensagens
-                self._check_sync()
-                
-        except KeyboardInterrupt:
-            print(f"\n[SERVER:{self.server_name}] Encerrando servidor...")
+            while self._running:
+                for socket, _ in poll(POLL_TIMEOUT):
+                    if socket == wakeup_fd:
+                        os.read(wakeup_fd, 512)  # Descarta os bytes do sinal
+                        continue
+                    handle = handle_request if socket is req_socket else handle_servers
+                    for _ in range(REQUEST_BATCH):
+                        if not handle():
+                            break
+            
+            self.log.info("Encerrando servidor...")
         finally:
+            if wakeup_fd is not None:
+                os.close(signal.set_wakeup_fd(-1))  # Devolve o descritor de escrita
+                os.close(wakeup_fd)
+            self._sync_pool.shutdown(wait=False, cancel_futures=True)
             self._save_state()
+            self._shutdown_components()
             
-            # Cleanup de replicação
-            if self.replication_manager:
-                self.replication_manager.cleanup()
-            
-            # Cleanup de eleição
-            if self.election_manager:
-                self.election_manager.cleanup()
-            
-            self.req_socket.close()
-            self.pub_socket.close()
-            self.ref_socket.close()
-            self.sub_socket.close()
-            self.server_socket.close()
+            # Com LINGER 0 (padrão do contexto), mensagens ainda não entregues
+            # não seguram o term()
+            for socket in (self.req_socket, self.pub_socket, self.ref_socket, self.sub_socket):
+                socket.close()
             self.context.term()
+    
+    def _shutdown_components(self):
+        """
+        Encerra em paralelo a gravação pendente e os gerenciadores
+        
+        Cada gerenciador tem seu próprio contexto ZeroMQ e pode esperar a
+        rede ao esvaziar filas; em paralelo, o desligamento custa o do mais
+        lento e não a soma de todos.
+        """
+        tasks = [self._wait_writes]
+        if self.replication_manager:
+            tasks.append(self.replication_manager.cleanup)
+        if self.election_manager:
+            tasks.append(self.election_manager.cleanup)
+        if self.berkeley_sync:
+            tasks.append(self.berkeley_sync.close)
+        
+        with ThreadPoolExecutor(max_workers=len(tasks),
+                                thread_name_prefix='shutdown') as executor:
+            futures = [executor.submit(task) for task in tasks]
+        
+        for task, future in zip(tasks, futures):
+            if future.exception():
+                self.log.error("Erro ao encerrar (%s): %s", task.__qualname__, future.exception())
 
 def main():
     """Função principal"""
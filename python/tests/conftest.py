@@ -0,0 +1,48 @@
+"""
+Configuração compartilhada dos testes
+
+Os módulos do servidor importam uns aos outros pelo nome (como dentro do
+contêiner), então python/ e python/server/ entram no sys.path.
+"""
+
+import os
+import sys
+
+import pytest
+
+PYTHON_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in (PYTHON_DIR, os.path.join(PYTHON_DIR, 'server')):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+from common_utils.persistence import DataStore  # noqa: E402
+
+
+@pytest.fixture
+def datastore(tmp_path):
+    """DataStore em diretório temporário"""
+    return DataStore(str(tmp_path))
+
+
+@pytest.fixture
+def make_server(tmp_path, monkeypatch):
+    """
+    Fábrica de MessageServer que persiste em tmp_path
+    
+    Servidores criados pela mesma fábrica compartilham o diretório de dados,
+    o que permite simular um reinício.
+    """
+    import server as server_module
+    
+    monkeypatch.setattr(server_module, 'DataStore', lambda _: DataStore(str(tmp_path)))
+    created = []
+    
+    def factory(name='test'):
+        srv = server_module.MessageServer(name)
+        created.append(srv)
+        return srv
+    
+    yield factory
+    
+    for srv in created:
+        srv._wait_writes()
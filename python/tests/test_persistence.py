@@ -0,0 +1,79 @@
+"""Testes do DataStore: snapshot + journal e arquivos JSON Lines indexados"""
+
+import os
+
+
+def test_load_missing_file_returns_default(datastore):
+    assert datastore.load('logins.json') == []
+    assert datastore.load('logins.json', default={'a': 1}) == {'a': 1}
+
+
+def test_save_load_round_trip(datastore):
+    data = [{'user': 'ana', 'timestamp': 1.5}, {'user': 'bia', 'timestamp': 2.0}]
+    assert datastore.save('logins.json', data)
+    assert datastore.load('logins.json') == data
+
+
+def test_append_goes_to_journal_and_load_merges_it(datastore):
+    datastore.save('channels.json', [{'channel': 'geral'}])
+    datastore.append('channels.json', {'channel': 'random'}, {'channel': 'dev'})
+    
+    assert os.path.exists(os.path.join(datastore.data_dir, 'channels.jsonl'))
+    assert datastore.load('channels.json') == [
+        {'channel': 'geral'}, {'channel': 'random'}, {'channel': 'dev'}]
+
+
+def test_append_without_snapshot(datastore):
+    datastore.append('messages.json', {'message': 'oi'})
+    assert datastore.load('messages.json') == [{'message': 'oi'}]
+
+
+def test_save_discards_journal(datastore):
+    datastore.append('logins.json', {'user': 'ana'})
+    datastore.save('logins.json', [{'user': 'bia'}])
+    
+    assert not os.path.exists(os.path.join(datastore.data_dir, 'logins.jsonl'))
+    assert datastore.load('logins.json') == [{'user': 'bia'}]
+
+
+def test_corrupt_snapshot_keeps_journal(datastore):
+    datastore.append('logins.json', {'user': 'ana'})
+    with open(os.path.join(datastore.data_dir, 'logins.json'), 'wb') as f:
+        f.write(b'[{"user": ')
+    
+    assert datastore.load('logins.json') == [{'user': 'ana'}]
+
+
+def test_signature_changes_on_write(datastore):
+    before = datastore.signature('logins.json')
+    datastore.append('logins.json', {'user': 'ana'})
+    after_append = datastore.signature('logins.json')
+    datastore.save('logins.json', [{'user': 'ana'}])
+    
+    assert len({before, after_append, datastore.signature('logins.json')}) == 3
+
+
+def test_append_lines_offsets_read_back(datastore):
+    first = datastore.append_lines('archive.jsonl', [{'n': 0}, {'n': 1}])
+    second = datastore.append_lines('archive.jsonl', [{'n': 2}])
+    offsets = first + second
+    
+    assert offsets[0] == 0
+    assert datastore.read_lines_at('archive.jsonl', offsets) == [{'n': 0}, {'n': 1}, {'n': 2}]
+    assert datastore.read_lines_at('archive.jsonl', [offsets[2], offsets[0]]) == [{'n': 2}, {'n': 0}]
+
+
+def test_scan_lines_matches_append_lines(datastore):
+    offsets = datastore.append_lines('archive.jsonl', [{'n': i} for i in range(4)])
+    assert list(datastore.scan_lines('archive.jsonl')) == [(o, {'n': i}) for i, o in enumerate(offsets)]
+
+
+def test_append_lines_terminates_torn_line(datastore):
+    datastore.append_lines('archive.jsonl', [{'n': 0}])
+    with open(os.path.join(datastore.data_dir, 'archive.jsonl'), 'ab') as f:
+        f.write(b'{"n": ')  # escrita interrompida
+    
+    offsets = datastore.append_lines('archive.jsonl', [{'n': 1}])
+    
+    assert datastore.read_lines_at('archive.jsonl', offsets) == [{'n': 1}]
+    assert [item for _, item in datastore.scan_lines('archive.jsonl')] == [{'n': 0}, {'n': 1}]
@@ -0,0 +1,171 @@
+"""Testes da deduplicação, da mescla e do envio de estado do ReplicationManager"""
+
+import os
+
+import msgpack
+import pytest
+
+from common_utils.persistence import DataStore
+from replication_manager import ReplicationManager, _keep_earliest, _new_items
+
+
+def _message(ts, text=None, user='ana'):
+    return {'type': 'publish', 'user': user, 'channel': 'geral',
+            'message': text if text is not None else str(ts),
+            'timestamp': float(ts), 'clock': 0}
+
+
+@pytest.fixture
+def managers(tmp_path):
+    """
+    Fábrica de ReplicationManager, cada um com seu diretório de dados
+    
+    As requisições entre eles vão direto aos handlers do destino (sem
+    sockets); as enviadas ficam em manager.sent como (serviço, dados).
+    """
+    created = {}
+    
+    def factory(name):
+        manager = ReplicationManager(name, len(created) + 1, DataStore(str(tmp_path / name)))
+        manager.sent = []
+        
+        def exchange(targets, request):
+            message = msgpack.unpackb(request)
+            service, data = message['service'], message['data']
+            manager.sent.append((service, data))
+            responses = {}
+            for target in targets:
+                handler = getattr(created[target], f'_handle_{service}')
+                response = handler(data)
+                responses[target] = msgpack.unpackb(response) if isinstance(response, bytes) else response
+            return responses
+        
+        manager._exchange = exchange
+        created[name] = manager
+        return manager
+    
+    yield factory
+    
+    for manager in created.values():
+        manager.cleanup()
+
+
+def test_push_state_sends_only_messages_newer_than_peer(managers):
+    sender, peer = managers('s1'), managers('s2')
+    shared = [_message(ts) for ts in range(5)]
+    sender.datastore.save('messages.json', shared + [_message(5), _message(6)])
+    peer.datastore.save('messages.json', shared)
+    
+    sender._push_state('s2')
+    
+    pushed = [data['payload'] for service, data in sender.sent
+              if service == 'replicate' and data['type'] == 'messages']
+    assert [[m['timestamp'] for m in payload] for payload in pushed] == [[5.0, 6.0]]
+    assert len(peer.datastore.load('messages.json')) == 7
+
+
+def test_push_state_sends_everything_to_empty_peer(managers):
+    sender, peer = managers('s1'), managers('s2')
+    sender.datastore.save('logins.json', [{'user': 'ana', 'timestamp': 1.0}])
+    sender.datastore.save('messages.json', [_message(ts) for ts in range(3)])
+    
+    sender._push_state('s2')
+    
+    assert peer.datastore.load('logins.json') == [{'user': 'ana', 'timestamp': 1.0}]
+    assert len(peer.datastore.load('messages.json')) == 3
+
+
+def test_push_state_waits_for_peer_summary(managers):
+    sender, peer = managers('s1'), managers('s2')
+    sender.datastore.save('messages.json', [_message(1)])
+    sender._needs_state.add('s2')
+    peer._handle_state_summary = lambda data: {'service': 'state_summary',
+                                               'data': {'status': 'error'}}
+    
+    sender._push_state('s2')
+    
+    assert [service for service, _ in sender.sent] == ['state_summary']
+    assert 's2' in sender._needs_state
+
+
+def _user_key(item):
+    return item.get('user')
+
+
+def test_new_items_skips_known_keys_and_records_new_ones():
+    known = {'ana'}
+    items = [{'user': 'ana', 'timestamp': 1}, {'user': 'bia', 'timestamp': 2}, {'timestamp': 3}]
+    
+    assert _new_items(items, _user_key, known) == [{'user': 'bia', 'timestamp': 2}]
+    assert known == {'ana', 'bia'}
+
+
+def test_new_items_keeps_earliest_of_keys_repeated_in_batch():
+    items = [{'user': 'ana', 'timestamp': 5}, {'user': 'bia', 'timestamp': 1},
+             {'user': 'ana', 'timestamp': 2}, {'user': 'ana', 'timestamp': 3}]
+    
+    assert _new_items(items, _user_key, set()) == [
+        {'user': 'ana', 'timestamp': 2}, {'user': 'bia', 'timestamp': 1}]
+
+
+def test_keep_earliest_replaces_only_with_older_records():
+    existing = [{'user': 'ana', 'timestamp': 5}, {'user': 'bia', 'timestamp': 1}]
+    items = [{'user': 'ana', 'timestamp': 3}, {'user': 'bia', 'timestamp': 4}]
+    
+    assert _keep_earliest(existing, items, _user_key, {'ana', 'bia'})
+    assert existing == [{'user': 'ana', 'timestamp': 3}, {'user': 'bia', 'timestamp': 1}]
+    assert not _keep_earliest(existing, items, _user_key, {'ana', 'bia'})
+
+
+def test_merge_logins_converges_to_earliest(managers):
+    manager = managers('s1')
+    manager.datastore.save('logins.json', [{'user': 'ana', 'timestamp': 5.0}])
+    
+    manager._merge_logins([{'user': 'ana', 'timestamp': 9.0}, {'user': 'ana', 'timestamp': 2.0},
+                           {'user': 'bia', 'timestamp': 4.0}, {'user': 'bia', 'timestamp': 3.0}])
+    
+    assert sorted(manager.datastore.load('logins.json'), key=_user_key) == [
+        {'user': 'ana', 'timestamp': 2.0}, {'user': 'bia', 'timestamp': 3.0}]
+
+
+def _timestamps(manager):
+    return [m['timestamp'] for m in manager.datastore.load('messages.json')]
+
+
+def test_merge_messages_appends_newer_to_journal(managers):
+    manager = managers('s1')
+    manager.datastore.save('messages.json', [_message(1), _message(2)])
+    
+    manager._merge_messages([_message(4), _message(3), _message(2)])
+    
+    assert os.path.exists(os.path.join(manager.datastore.data_dir, 'messages.jsonl'))
+    assert _timestamps(manager) == [1.0, 2.0, 3.0, 4.0]
+
+
+def test_merge_messages_interleaves_older_into_tail(managers):
+    manager = managers('s1')
+    manager.datastore.save('messages.json', [_message(ts) for ts in (1, 3, 5, 7)])
+    
+    manager._merge_messages([_message(6), _message(2), _message(8)])
+    
+    assert _timestamps(manager) == [1.0, 2.0, 3.0, 5.0, 6.0, 7.0, 8.0]
+
+
+def test_merge_messages_sorts_unordered_journal(managers):
+    manager = managers('s1')
+    # O servidor acrescenta ao journal na ordem de chegada
+    manager.datastore.save('messages.json', [_message(1), _message(5)])
+    manager.datastore.append('messages.json', _message(9), _message(3))
+    
+    manager._merge_messages([_message(4)])
+    
+    assert _timestamps(manager) == [1.0, 3.0, 4.0, 5.0, 9.0]
+
+
+def test_merge_messages_skips_archived(managers):
+    manager = managers('s1')
+    manager.archived_ids.add(ReplicationManager._get_message_id(_message(1)))
+    
+    manager._merge_messages([_message(1), _message(2)])
+    
+    assert _timestamps(manager) == [2.0]
@@ -0,0 +1,31 @@
+"""Testes do ciclo de sincronização do MessageServer"""
+
+import server as server_module
+
+
+def test_sync_every_sync_interval_requests(make_server, monkeypatch):
+    srv = make_server()
+    triggered = []
+    monkeypatch.setattr(server_module.MessageServer, '_trigger_sync',
+                        lambda self: triggered.append(self.message_count))
+    
+    for _ in range(3 * server_module.SYNC_INTERVAL):
+        srv._after_request()
+    
+    interval = server_module.SYNC_INTERVAL
+    assert triggered == [interval, 2 * interval, 3 * interval]
+
+
+def test_full_checkpoint_runs_snapshot_and_berkeley(make_server, monkeypatch):
+    srv = make_server()
+    calls = []
+    monkeypatch.setattr(server_module.MessageServer, '_save_state', lambda self: calls.append('snapshot'))
+    monkeypatch.setattr(server_module.MessageServer, '_checkpoint', lambda self: calls.append('checkpoint'))
+    monkeypatch.setattr(server_module.MessageServer, '_submit_sync', lambda self, task: calls.append(task.__name__))
+    srv.berkeley_sync = type('Coordinator', (), {'is_coordinator': True})()
+    
+    for _ in range(server_module.SNAPSHOT_EVERY):
+        srv._trigger_sync()
+    
+    assert calls.count('checkpoint') == server_module.SNAPSHOT_EVERY - 1
+    assert calls[-2:] == ['snapshot', '_run_berkeley_sync']